@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""Columnar (Parquet) copy of report_entries and an optional vectorised engine to query it.
+
+`python main.py export-parquet [pharmacy|all] [year ...]` writes one file per pharmacy and year:
+    <PARQUET_DIR>/<pharmacy>/report_entries_<YYYY>.parquet
+with the columns date, key (canonical metric key, null for unmapped rows), category,
+description and today_value. Rows are sorted by (key, date), so the per-key filters below
+skip most row groups.
+
+ANALYTICS_BACKEND=duckdb or pyarrow makes the year endpoints read closed years from these
+files. The current year always comes from SQLite, because a file is a snapshot as of its
+export; re-export a year after reparsing or re-importing it. Both engines are optional
+imports. Without the configured engine or a year's file, callers use SQLite as before.
+"""
+import datetime
+import os
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import pharmacy_registry
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:  # Optional: needed to export, and for the pyarrow backend
+    pa = pc = pq = None
+
+try:
+    import duckdb
+except ImportError:  # Optional: the duckdb backend
+    duckdb = None
+
+PARQUET_DIR = os.getenv('PARQUET_DIR', os.path.join(pharmacy_registry.PHARMACY_DATA_DIR, 'parquet'))
+ANALYTICS_BACKEND = os.getenv('ANALYTICS_BACKEND', 'sqlite').lower()  # sqlite, duckdb or pyarrow
+
+COLUMNS = ['date', 'key', 'category', 'description', 'today_value']
+
+
+def parquet_path(pharmacy, year: int) -> str:
+    pharmacy = pharmacy_registry.resolve_pharmacy(pharmacy)
+    return os.path.join(PARQUET_DIR, pharmacy, f"report_entries_{year}.parquet")
+
+
+def backend(name: Optional[str] = None) -> Optional[str]:
+    """The configured analytic engine if its package is installed, else None (use SQLite)."""
+    name = (name or ANALYTICS_BACKEND).lower()
+    if name == 'duckdb' and duckdb is not None:
+        return 'duckdb'
+    if name == 'pyarrow' and pq is not None:
+        return 'pyarrow'
+    return None
+
+
+def serves_year(pharmacy, year: int, engine: Optional[str] = None) -> bool:
+    """True when year is closed, has been exported and an analytic engine is available."""
+    return (backend(engine) is not None and year < datetime.date.today().year
+            and os.path.exists(parquet_path(pharmacy, year)))
+
+
+def write_year(pharmacy, year: int, rows: Iterable[Tuple]) -> str:
+    """Writes (date, key, category, description, today_value) rows, sorted by (key, date), as
+    the year's Parquet file. Replaces the file atomically. Returns its path."""
+    if pq is None:
+        raise RuntimeError("export-parquet needs pyarrow (pip install pyarrow)")
+    columns = list(zip(*rows)) or [[] for _ in COLUMNS]
+    table = pa.table({
+        'date': pa.array(columns[0], pa.date32()),
+        'key': pa.array(columns[1], pa.string()),
+        'category': pa.array(columns[2], pa.string()),
+        'description': pa.array(columns[3], pa.string()),
+        'today_value': pa.array(columns[4], pa.float64()),
+    })
+    path = parquet_path(pharmacy, year)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    pq.write_table(table, tmp_path, compression='zstd')
+    os.replace(tmp_path, path)
+    return path
+
+
+_duckdb_connection = None
+_duckdb_lock = threading.Lock()
+
+
+def _duckdb_rows(sql: str, params: List) -> List[Tuple]:
+    """Runs sql on its own cursor of one shared in-memory DuckDB connection. A cursor per call
+    keeps threads apart; connecting once saves ~40 ms per query."""
+    global _duckdb_connection
+    with _duckdb_lock:
+        if _duckdb_connection is None:
+            _duckdb_connection = duckdb.connect()
+    cursor = _duckdb_connection.cursor()
+    try:
+        return cursor.execute(sql, params).fetchall()
+    finally:
+        cursor.close()
+
+
+def _duckdb_source(pharmacy, year: int) -> str:
+    return "read_parquet('{}')".format(parquet_path(pharmacy, year).replace("'", "''"))
+
+
+def year_metric_stats(pharmacy, year: int, keys: List[str], engine: Optional[str] = None) -> Dict[str, Dict[str, float]]:
+    """{key: {'sum': ..., 'avg': ...}} over the year's rows for each key (missing keys omitted)."""
+    engine = backend(engine)
+    if engine == 'duckdb':
+        rows = _duckdb_rows(
+            f"SELECT key, sum(today_value), avg(today_value) FROM {_duckdb_source(pharmacy, year)} "
+            f"WHERE key IN ({', '.join('?' for _ in keys)}) GROUP BY key",
+            list(keys)
+        )
+        return {key: {'sum': total, 'avg': average} for key, total, average in rows}
+    if engine == 'pyarrow':
+        table = pq.read_table(parquet_path(pharmacy, year), columns=['key', 'today_value'],
+                              filters=[('key', 'in', list(keys))])
+        result = table.group_by('key').aggregate([('today_value', 'sum'), ('today_value', 'mean')]).to_pydict()
+        return {key: {'sum': total, 'avg': average} for key, total, average in
+                zip(result['key'], result['today_value_sum'], result['today_value_mean'])}
+    raise RuntimeError(f"Analytic backend {ANALYTICS_BACKEND!r} is not available")
+
+
+def year_daily_totals(pharmacy, year: int, key: str, engine: Optional[str] = None) -> Dict[datetime.date, float]:
+    """{date: sum of the key's non-null values that day} for the year."""
+    engine = backend(engine)
+    if engine == 'duckdb':
+        rows = _duckdb_rows(
+            f"SELECT date, sum(today_value) FROM {_duckdb_source(pharmacy, year)} "
+            "WHERE key = ? AND today_value IS NOT NULL GROUP BY date",
+            [key]
+        )
+        return dict(rows)
+    if engine == 'pyarrow':
+        table = pq.read_table(parquet_path(pharmacy, year), columns=['date', 'today_value'],
+                              filters=[('key', '=', key)])
+        table = table.filter(pc.is_valid(table['today_value']))
+        result = table.group_by('date').aggregate([('today_value', 'sum')]).to_pydict()
+        return dict(zip(result['date'], result['today_value_sum']))
+    raise RuntimeError(f"Analytic backend {ANALYTICS_BACKEND!r} is not available")
@@ -2,17 +2,22 @@
 import os
 import sys
 import datetime
-from flask import Flask, jsonify, request, send_from_directory
+import functools
+import itertools
+from flask import Flask, g, jsonify, request, send_from_directory
 from flask_cors import CORS
-from sqlalchemy import func, create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import func
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 
 # allow imports from project root
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from main import fetch_latest_report, get_today_entries, get_month_to_date_entries, ReportEntry, DATABASE_URL, MonthlyClosingStock
+from main import get_today_entries, get_month_to_date_entries, ReportEntry, DATABASE_URL, MonthlyClosingStock, group_daily_totals, tiered_entries, metric_aggregates, stock_kpi_series, metric_series
+from sync_scheduler import start_scheduler, get_scheduler, run_sync
+import pharmacy_registry
+import analytics
+import response_cache
 
 print(f"--- BACKEND DEBUG: Using DATABASE_URL: {DATABASE_URL} ---")
 
@@ -66,21 +71,59 @@ def load_user(user_id):
     # Load user from our 'database' (the dictionary)
     return users.get(int(user_id))
 
-# --- Pharmacy DB mapping ---
-PHARMACY_DB_MAP = {
-    'reitz': '/data/reports.db',
-    'villiers': '/data/reports_villiers.db',
-    'roos': '/data/reports_roos.db',
-    'tugela': '/data/reports_tugela.db',
-    'winterton': '/data/reports_winterton.db',
-}
+# --- Pharmacy DB sessions (one shared engine per pharmacy, see pharmacy_registry) ---
+def request_pharmacy():
+    """The pharmacy named in the X-Pharmacy header (default reitz)."""
+    return pharmacy_registry.resolve_pharmacy(request.headers.get('X-Pharmacy', 'reitz'))
 
 def get_pharmacy_session():
-    pharmacy = request.headers.get('X-Pharmacy', 'reitz').lower()
-    db_file = PHARMACY_DB_MAP.get(pharmacy, '/data/reports.db')
-    db_url = f"sqlite:///{db_file}"
-    engine = create_engine(db_url, echo=False, future=True)
-    return sessionmaker(bind=engine, autoflush=False, autocommit=False)()
+    """The request's read-only session for the pharmacy named in the X-Pharmacy header (default reitz)."""
+    return pharmacy_registry.get_scoped_session(request_pharmacy(), read_only=True)
+
+@app.teardown_appcontext
+def remove_pharmacy_sessions(exception=None):
+    pharmacy_registry.remove_scoped_sessions()
+
+# --- Response cache for month/year endpoints (invalidated by ingests, see response_cache) ---
+def month_end(month_str):
+    """Last day of a YYYY-MM month, or None if month_str doesn't parse."""
+    try:
+        first = datetime.datetime.strptime(month_str, '%Y-%m').date()
+    except ValueError:
+        return None
+    return (first + datetime.timedelta(days=32)).replace(day=1) - datetime.timedelta(days=1)
+
+def year_end(year_str):
+    try:
+        return datetime.date(int(year_str), 12, 31)
+    except ValueError:
+        return None
+
+def cached_response(range_end):
+    """Serves the view's 200 responses from response_cache. range_end(**view_args) is the last
+    date the response covers; None (an unparseable URL) skips the cache. A view that answers
+    despite a failed query (zeros instead of data) sets g.no_cache so the answer isn't stored."""
+    def decorate(view):
+        @functools.wraps(view)
+        def wrapper(**kwargs):
+            end = range_end(**kwargs) if response_cache.RESPONSE_CACHE_ENABLED else None
+            if end is None:
+                return view(**kwargs)
+            pharmacy = request_pharmacy()
+            key = response_cache.cache_key(request.path, request.args.to_dict(), end)
+            body, version = response_cache.lookup(pharmacy, key)
+            if body is not None:
+                return app.response_class(body, mimetype='application/json', headers={'X-Cache': 'hit'})
+            response = app.make_response(view(**kwargs))
+            if response.status_code == 200 and response.is_json and not g.get('no_cache'):
+                response_cache.store(pharmacy, key, version, end, response.get_data(as_text=True))
+                response.headers['X-Cache'] = 'miss'
+            return response
+        return wrapper
+    return decorate
+
+# --- Background mailbox sync (keeps IMAP out of the request path) ---
+start_scheduler(pharmacy_registry.PHARMACIES)
 
 # --- Authentication API Endpoints ---
 
@@ -127,10 +170,13 @@ def check_auth():
 @app.route('/api/today', methods=['GET'])
 @login_required # <-- Protect this route
 def api_today():
-    # Fetch and save the latest report data
-    fetch_latest_report()
+    # Served from the DB only; the sync scheduler keeps it current
     today = datetime.date.today()
-    entries = get_today_entries(today)
+    session = get_pharmacy_session()
+    try:
+        entries = get_today_entries(today, session)
+    finally:
+        session.close()
     result = [
         {'category': e.category, 'description': e.description, 'today_value': e.today_value}
         for e in entries
@@ -140,10 +186,13 @@ def api_today():
 @app.route('/api/mtd', methods=['GET'])
 @login_required
 def api_mtd():
-    # Fetch and save the latest report data
-    fetch_latest_report()
+    # Served from the DB only; the sync scheduler keeps it current
     today = datetime.date.today()
-    results = get_month_to_date_entries(today)
+    session = get_pharmacy_session()
+    try:
+        results = get_month_to_date_entries(today, session)
+    finally:
+        session.close()
     result = [
         {'category': r[0], 'description': r[1], 'sum_value': r[2]}
         for r in results
@@ -158,7 +207,11 @@ def api_day(date_str):
         d = datetime.datetime.strptime(date_str, '%Y-%m-%d').date()
     except ValueError:
         return jsonify({'error': 'invalid date format'}), 400
-    entries = get_today_entries(d)
+    session = get_pharmacy_session()
+    try:
+        entries = get_today_entries(d, session, tiered_entries(session, request_pharmacy(), d, d))
+    finally:
+        session.close()
     result = [
         {'category': e.category, 'description': e.description, 'today_value': e.today_value}
         for e in entries
@@ -167,6 +220,7 @@ def api_day(date_str):
 
 @app.route('/api/month/<month_str>/turnover', methods=['GET'])
 @login_required
+@cached_response(month_end)
 def api_month_turnover(month_str):
     """Return DAILY turnover totals AND avg basket value for ALL days the given month (YYYY-MM), padding with 0 where no data exists."""
     print(f"--- DEBUG: ENTERING api_month_turnover for {month_str} ---")
@@ -184,65 +238,27 @@ def api_month_turnover(month_str):
         print(f"--- DEBUG: ERROR during date parsing for {month_str}: {e} ---")
         return jsonify({'error': 'invalid month format'}), 400
     
-    print(f"--- DEBUG: Opening database session for {month_str} ---")
     session = get_pharmacy_session()
-    processed_data = {}
+    turnover, basket = [0.0] * num_days, [0.0] * num_days # Returned on error
     try:
-        print(f"--- DEBUG: Executing database query for {month_str} ---")
-        # Query for daily turnover (using LIKE) AND avg basket value (using exact match)
-        rows = session.query(
-            ReportEntry.date,
-            ReportEntry.description,
-            ReportEntry.today_value
-        ).filter(
-            ReportEntry.date >= start_date,
-            ReportEntry.date <= end_date,
-            # Query relevant categories
-            ReportEntry.category.in_(['TURNOVER SUMMARY', 'SALES SUMMARY']),
-            # Use LIKE for turnover, exact for avg value
-            (ReportEntry.description.like('%TOTAL TURNOVER%') | (ReportEntry.description == 'Average Value Per Docket/Basket'))
-        ).all()
-        
-        # Process rows into a dictionary keyed by day
-        for r in rows:
-            day = r.date.day
-            if day not in processed_data:
-                # Initialize with both keys
-                processed_data[day] = {'turnover': 0.0, 'avgBasketValueReported': 0.0} 
-            
-            # Use contains check for turnover, exact for avg value
-            if 'TOTAL TURNOVER' in r.description:
-                # Sum turnover (just in case, though should be unique by date/category)
-                processed_data[day]['turnover'] += (r.today_value or 0.0) 
-            elif r.description == 'Average Value Per Docket/Basket':
-                # Set avg basket value
-                processed_data[day]['avgBasketValueReported'] = (r.today_value or 0.0)
-
+        series = metric_series(session, {'turnover': 'sum', 'avg_basket_value': 'avg'}, start_date, end_date)['series']
+        turnover, basket = series['turnover'], series['avg_basket_value']
     except Exception as e: 
         print(f"--- DEBUG: ERROR during database query for {month_str}: {e} ---")
-        # Return empty data on error
+        g.no_cache = True # Zeros stand in for the data: serve them, don't cache them
     finally:
-        print(f"--- DEBUG: Closing database session for {month_str} ---")
         session.close()
 
-    # Create result array for all days in the month
-    print(f"--- DEBUG: Formatting result for {month_str} ---")
-    result = []
-    for day_num in range(1, num_days + 1):
-        # Ensure default values for both keys if day is missing
-        day_summary = processed_data.get(day_num, {'turnover': 0.0, 'avgBasketValueReported': 0.0})
-        result.append({
-            'day': day_num,
-            'turnover': day_summary.get('turnover', 0.0), # Use .get() for safety
-            'avgBasketValueReported': day_summary.get('avgBasketValueReported', 0.0) # Add avg basket value
-        })
-        
-    print(f"--- DEBUG: Returning result for {month_str} ---")
-    return jsonify(result)
+    # One entry per day of the month, 0 where no data exists
+    return jsonify([
+        {'day': day, 'turnover': value, 'avgBasketValueReported': avg_basket}
+        for day, (value, avg_basket) in enumerate(zip(turnover, basket), 1)
+    ])
 
 # NEW Endpoint for Cumulative Comparison
 @app.route('/api/month/<month_str>/turnover/comparison', methods=['GET'])
 @login_required
+@cached_response(month_end)
 def api_month_turnover_comparison(month_str):
     """Return CUMULATIVE daily turnover totals for the given month and the previous year's same month (YYYY-MM)."""
     try:
@@ -266,61 +282,17 @@ def api_month_turnover_comparison(month_str):
         return jsonify({'error': 'invalid month format or date calculation error'}), 400
     
     session = get_pharmacy_session()
+    def cumulative_by_day(start, end):
+        # Running total for every day up to the last day with data, missing days counting as 0
+        daily = metric_series(session, {'turnover': 'sum'}, start, end, fill=None)['series']['turnover']
+        last_day = max((day for day, value in enumerate(daily, 1) if value is not None), default=0)
+        running = itertools.accumulate(value or 0.0 for value in daily[:last_day])
+        return [{'day': day, 'cumulative_turnover': total} for day, total in enumerate(running, 1)]
+
     try: 
-        # --- Query for current year (Daily) ---
-        rows_current_daily = session.query(
-            ReportEntry.date,
-            func.sum(ReportEntry.today_value).label('daily_turnover') # Get daily turnover
-        ).filter(
-            ReportEntry.category == 'TURNOVER SUMMARY',
-            ReportEntry.description.like('%TOTAL TURNOVER%'),
-            ReportEntry.date >= start_current,
-            ReportEntry.date <= end_current
-        ).group_by(ReportEntry.date).order_by(ReportEntry.date).all()
-        
-        # --- Query for previous year (Daily) ---
-        rows_prev_daily = session.query(
-            ReportEntry.date,
-            func.sum(ReportEntry.today_value).label('daily_turnover') # Get daily turnover
-        ).filter(
-            ReportEntry.category == 'TURNOVER SUMMARY',
-            ReportEntry.description.like('%TOTAL TURNOVER%'),
-            ReportEntry.date >= start_prev,
-            ReportEntry.date <= end_prev
-        ).group_by(ReportEntry.date).order_by(ReportEntry.date).all()
-
-        # --- Calculate Cumulative Turnover for Current Year ---
-        cumulative_current = []
-        current_total = 0.0
-        # Ensure we have entries for every day up to the last day with data, filling gaps
-        days_in_current_data = {r.date.day: r.daily_turnover for r in rows_current_daily}
-        last_day_current = max(days_in_current_data.keys()) if days_in_current_data else 0
-        for day in range(1, last_day_current + 1):
-            daily_val = days_in_current_data.get(day, 0.0)
-            current_total += daily_val
-            cumulative_current.append({
-                'day': day, 
-                'cumulative_turnover': current_total
-            })
-            
-        # --- Calculate Cumulative Turnover for Previous Year ---
-        cumulative_prev = []
-        prev_total = 0.0
-        # Ensure we have entries for every day up to the last day with data, filling gaps
-        days_in_prev_data = {r.date.day: r.daily_turnover for r in rows_prev_daily}
-        last_day_prev = max(days_in_prev_data.keys()) if days_in_prev_data else 0
-        for day in range(1, last_day_prev + 1):
-            daily_val = days_in_prev_data.get(day, 0.0)
-            prev_total += daily_val
-            cumulative_prev.append({
-                'day': day, 
-                'cumulative_turnover': prev_total
-            })
-            
-        # Combine results
         result = {
-            'current_year_cumulative': cumulative_current,
-            'previous_year_cumulative': cumulative_prev
+            'current_year_cumulative': cumulative_by_day(start_current, end_current),
+            'previous_year_cumulative': cumulative_by_day(start_prev, end_prev)
         }
         return jsonify(result)
         
@@ -332,6 +304,7 @@ def api_month_turnover_comparison(month_str):
 
 @app.route('/api/month/<month_str>/cumulative_turnover', methods=['GET'])
 @login_required
+@cached_response(month_end)
 def api_month_cumulative_turnover(month_str):
     """Return cumulative daily turnover totals for the given month (YYYY-MM)."""
     try:
@@ -345,23 +318,20 @@ def api_month_cumulative_turnover(month_str):
         return jsonify({'error': 'invalid month format'}), 400
     
     session = get_pharmacy_session()
-    rows = session.query(
-        ReportEntry.date,
-        func.sum(ReportEntry.today_value).label('daily_turnover')
-    ).filter(
-        ReportEntry.category == 'TURNOVER SUMMARY',
-        ReportEntry.description.like('%TOTAL TURNOVER%'),
-        ReportEntry.date >= start,
-        ReportEntry.date <= end
-    ).group_by(ReportEntry.date).order_by(ReportEntry.date).all()
-    session.close()
+    try:
+        result = metric_series(session, {'turnover': 'sum'}, start, end, fill=None)
+    finally:
+        session.close()
     
+    # Days with a turnover value only
     cumulative_data = []
     cumulative_total = 0.0
-    for r in rows:
-        cumulative_total += r.daily_turnover
+    for day, daily_turnover in zip(result['buckets'], result['series']['turnover']):
+        if daily_turnover is None:
+            continue
+        cumulative_total += daily_turnover
         cumulative_data.append({
-            'date': r.date.isoformat(),
+            'date': day.isoformat(),
             'cumulative_turnover': cumulative_total
         })
         
@@ -369,6 +339,7 @@ def api_month_cumulative_turnover(month_str):
 
 @app.route('/api/month/<month_str>/cumulative_costs', methods=['GET'])
 @login_required
+@cached_response(month_end)
 def api_month_cumulative_costs(month_str):
     """Return cumulative daily Cost of Sales and Purchases for the given month (YYYY-MM)."""
     try:
@@ -381,69 +352,31 @@ def api_month_cumulative_costs(month_str):
         return jsonify({'error': 'invalid month format'}), 400
     
     session = get_pharmacy_session()
-    rows = session.query(
-        ReportEntry.date,
-        func.sum(ReportEntry.today_value).label('value'),
-        ReportEntry.description
-    ).filter(
-        ReportEntry.category == 'STOCK TRADING ACCOUNT',
-        ReportEntry.description.in_(['Cost Of Sales', 'Purchases']),
-        ReportEntry.date >= start,
-        ReportEntry.date <= end
-    ).group_by(ReportEntry.date, ReportEntry.description).order_by(ReportEntry.date).all()
-    session.close()
-    
-    # Process data day by day
-    daily_data = {}
-    all_dates = sorted(list(set(r.date for r in rows)))
-    
-    for r in rows:
-        date_str = r.date.isoformat()
-        if date_str not in daily_data:
-            daily_data[date_str] = {'Cost Of Sales': 0.0, 'Purchases': 0.0}
-        daily_data[date_str][r.description] = r.value
+    try:
+        result = metric_series(session, {'cost_of_sales': 'sum', 'purchases': 'sum'}, start, end)
+    finally:
+        session.close()
+    series = result['series']
 
     cumulative_data = []
     cumulative_cost = 0.0
     cumulative_purchase = 0.0
-    
-    # Ensure all dates within the range are present, even if no data exists
-    current_date = start
-    while current_date <= end:
-        date_str = current_date.isoformat()
-        cost_today = daily_data.get(date_str, {}).get('Cost Of Sales', 0.0)
-        purchase_today = daily_data.get(date_str, {}).get('Purchases', 0.0)
-        
-        # Only add data points if there was activity up to this day
+    for day, cost_today, purchase_today in zip(result['buckets'], series['cost_of_sales'], series['purchases']):
+        # Skip days at the beginning with no data at all; every day after the first activity is included
         if cost_today != 0.0 or purchase_today != 0.0 or cumulative_cost != 0.0 or cumulative_purchase != 0.0:
-             cumulative_cost += cost_today
-             cumulative_purchase += purchase_today
-             cumulative_data.append({
-                 'date': date_str,
-                 'cumulative_cost_of_sales': cumulative_cost,
-                 'cumulative_purchases': cumulative_purchase
-             })
-             
-        # Only advance if we added data or if there was data for this day
-        if not cumulative_data and cost_today == 0.0 and purchase_today == 0.0:
-             # Skip days at the beginning with no data at all
-             pass 
-        elif not any(d['date'] == date_str for d in cumulative_data) and (cost_today != 0.0 or purchase_today != 0.0):
-            # If there was data but we skipped adding it initially, add it now
-             cumulative_cost += cost_today
-             cumulative_purchase += purchase_today
-             cumulative_data.append({
-                 'date': date_str,
-                 'cumulative_cost_of_sales': cumulative_cost,
-                 'cumulative_purchases': cumulative_purchase
-             })
-
-        current_date += datetime.timedelta(days=1)
+            cumulative_cost += cost_today
+            cumulative_purchase += purchase_today
+            cumulative_data.append({
+                'date': day.isoformat(),
+                'cumulative_cost_of_sales': cumulative_cost,
+                'cumulative_purchases': cumulative_purchase
+            })
         
     return jsonify(cumulative_data)
 
 @app.route('/api/month/<month_str>/aggregates', methods=['GET'])
 @login_required
+@cached_response(month_end)
 def api_month_aggregates(month_str):
     """Return monthly aggregates including POS Transactions from SALES SUMMARY."""
     try:
@@ -456,81 +389,37 @@ def api_month_aggregates(month_str):
     except Exception:
         return jsonify({'error': 'invalid month format'}), 400
     session = get_pharmacy_session()
-    # aggregate turnover
-    total_turnover = session.query(func.sum(ReportEntry.today_value)).filter(
-        ReportEntry.category == 'TURNOVER SUMMARY',
-        ReportEntry.description.like('%TOTAL TURNOVER%'),
-        ReportEntry.date >= start,
-        ReportEntry.date <= end
-    ).scalar() or 0.0
-    # aggregate cost of sales
-    total_cost = session.query(func.sum(ReportEntry.today_value)).filter(
-        ReportEntry.category == 'STOCK TRADING ACCOUNT',
-        ReportEntry.description == 'Cost Of Sales',
-        ReportEntry.date >= start,
-        ReportEntry.date <= end
-    ).scalar() or 0.0
-    # aggregate purchases
-    total_purchases = session.query(func.sum(ReportEntry.today_value)).filter(
-        ReportEntry.category == 'STOCK TRADING ACCOUNT',
-        ReportEntry.description == 'Purchases',
-        ReportEntry.date >= start,
-        ReportEntry.date <= end
-    ).scalar() or 0.0
-    # aggregate transactions (Using POS Transactions from SALES SUMMARY)
-    total_transactions = session.query(func.sum(ReportEntry.today_value)).filter(
-        ReportEntry.category == 'SALES SUMMARY',
-        ReportEntry.description == 'POS Transactions',
-        ReportEntry.date >= start,
-        ReportEntry.date <= end
-    ).scalar() or 0
-    # aggregate dispensary turnover
-    dispensary_turnover = session.query(func.sum(ReportEntry.today_value)).filter(
-        ReportEntry.category == 'DISPENSARY SUMMARY',
-        ReportEntry.description == 'Dispensary Turnover/Revenue',
-        ReportEntry.date >= start,
-        ReportEntry.date <= end
-    ).scalar() or 0.0
-
-    # NEW: total scripts (sum where description contains 'Scripts', case-insensitive)
-    total_scripts = session.query(func.sum(ReportEntry.today_value)).filter(
-        ReportEntry.category == 'DISPENSARY SUMMARY',
-        ReportEntry.description.ilike('%scripts%'),
-        ReportEntry.date >= start,
-        ReportEntry.date <= end
-    ).scalar() or 0.0
-
-    # NEW: average reported basket value (avg of daily reported values)
-    avg_basket_value_reported = session.query(func.avg(ReportEntry.today_value)).filter(
-        ReportEntry.category == 'SALES SUMMARY',
-        ReportEntry.description == 'Average Value Per Docket/Basket',
-        ReportEntry.date >= start,
-        ReportEntry.date <= end
-    ).scalar() or 0.0
-
-    # NEW: average reported basket size (avg of daily reported values)
-    avg_basket_size_reported = session.query(func.avg(ReportEntry.today_value)).filter(
-        ReportEntry.category == 'SALES SUMMARY',
-        ReportEntry.description == 'Average Number Of Items per Basket',
-        ReportEntry.date >= start,
-        ReportEntry.date <= end
-    ).scalar() or 0.0
-
-    session.close()
+    try:
+        # Months of archived years are read from their cold files
+        entries = tiered_entries(session, request_pharmacy(), start, end)
+        # Every aggregate in one pass over report_entries
+        totals = metric_aggregates(session, start, end, {
+            'turnover': ('turnover', 'sum'),
+            'cost_of_sales': ('cost_of_sales', 'sum'),
+            'purchases': ('purchases', 'sum'),
+            'transactions': ('pos_transactions', 'sum'),  # POS Transactions from SALES SUMMARY
+            'dispensary_turnover': ('dispensary_turnover', 'sum'),
+            'total_scripts': ('scripts_total', 'sum'),
+            'avg_basket_value': ('avg_basket_value', 'avg'),  # Average of the daily reported values
+            'avg_basket_size': ('avg_basket_size', 'avg'),
+        }, entries)
+    finally:
+        session.close()
     return jsonify({
-        'turnover': total_turnover,
-        'costOfSales': total_cost,
-        'purchases': total_purchases,
-        'transactions': total_transactions,
-        'dispensaryTurnover': dispensary_turnover,
-        'avgBasketValueReported': avg_basket_value_reported,
-        'avgBasketSizeReported': avg_basket_size_reported,
-        'totalScripts': total_scripts
+        'turnover': totals['turnover'] or 0.0,
+        'costOfSales': totals['cost_of_sales'] or 0.0,
+        'purchases': totals['purchases'] or 0.0,
+        'transactions': totals['transactions'] or 0,
+        'dispensaryTurnover': totals['dispensary_turnover'] or 0.0,
+        'avgBasketValueReported': totals['avg_basket_value'] or 0.0,
+        'avgBasketSizeReported': totals['avg_basket_size'] or 0.0,
+        'totalScripts': totals['total_scripts'] or 0.0
     })
 
 # NEW Endpoint for Yearly Daily Turnover Data
 @app.route('/api/year/<year_str>/daily_turnover', methods=['GET'])
 @login_required
+@cached_response(year_end)
 def api_year_daily_turnover(year_str):
     """Return all daily turnover totals for the given year (YYYY) AND the previous year."""
     try:
@@ -548,37 +437,25 @@ def api_year_daily_turnover(year_str):
         return jsonify({'error': 'error processing year'}), 400
 
     session = get_pharmacy_session()
+    pharmacy = request_pharmacy()
     current_year_turnovers = {}
     previous_year_turnovers = {}
+
+    def daily_turnover(y, start, end):
+        # Closed, exported years come from the Parquet files when an analytic backend is configured
+        if analytics.serves_year(pharmacy, y):
+            rows = analytics.year_daily_totals(pharmacy, y, 'turnover').items()
+        else:
+            result = metric_series(session, {'turnover': 'sum'}, start, end, fill=None)
+            rows = zip(result['buckets'], result['series']['turnover'])
+        return {d.isoformat(): value for d, value in sorted(rows) if value is not None}
+
     try:
-        # Query current year
-        rows_current = session.query(
-            ReportEntry.date,
-            func.sum(ReportEntry.today_value).label('turnover')
-        ).filter(
-            ReportEntry.category == 'TURNOVER SUMMARY',
-            ReportEntry.description.like('%TOTAL TURNOVER%'),
-            ReportEntry.date >= start_current,
-            ReportEntry.date <= end_current
-        ).group_by(ReportEntry.date).all()
-        for r in rows_current:
-            current_year_turnovers[r.date.isoformat()] = r.turnover
-
-        # Query previous year
-        rows_prev = session.query(
-            ReportEntry.date,
-            func.sum(ReportEntry.today_value).label('turnover')
-        ).filter(
-            ReportEntry.category == 'TURNOVER SUMMARY',
-            ReportEntry.description.like('%TOTAL TURNOVER%'),
-            ReportEntry.date >= start_prev,
-            ReportEntry.date <= end_prev
-        ).group_by(ReportEntry.date).all()
-        for r in rows_prev:
-            previous_year_turnovers[r.date.isoformat()] = r.turnover
-            
+        current_year_turnovers = daily_turnover(year, start_current, end_current)
+        previous_year_turnovers = daily_turnover(prev_year, start_prev, end_prev)
     except Exception as e:
         print(f"Error during year turnover query: {e}")
+        g.no_cache = True # Zeros stand in for the data: serve them, don't cache them
         # Return potentially empty data on error
     finally:
         session.close()
@@ -593,6 +470,7 @@ def api_year_daily_turnover(year_str):
 # NEW: Endpoint for Yearly Aggregates
 @app.route('/api/year/<year_str>/aggregates', methods=['GET'])
 @login_required
+@cached_response(year_end)
 def api_year_aggregates(year_str):
     """Return key yearly aggregates for the specified year and previous year."""
     try:
@@ -618,73 +496,55 @@ def api_year_aggregates(year_str):
         'avg_basket_value_reported': 0.0,
         'avg_basket_size_reported': 0.0
     }
+    pharmacy = request_pharmacy()
     try:
-        # Current Year Turnover
-        aggregates['current_turnover'] = session.query(func.sum(ReportEntry.today_value)).filter(
-            ReportEntry.category == 'TURNOVER SUMMARY',
-            ReportEntry.description.like('%TOTAL TURNOVER%'),
-            ReportEntry.date >= start_current,
-            ReportEntry.date <= end_current
-        ).scalar() or 0.0
-
-        # Current Year Cost of Sales
-        aggregates['current_cost_of_sales'] = session.query(func.sum(ReportEntry.today_value)).filter(
-            ReportEntry.category == 'STOCK TRADING ACCOUNT',
-            ReportEntry.description == 'Cost Of Sales',
-            ReportEntry.date >= start_current,
-            ReportEntry.date <= end_current
-        ).scalar() or 0.0
-
-        # Previous Year Turnover
-        aggregates['previous_turnover'] = session.query(func.sum(ReportEntry.today_value)).filter(
-            ReportEntry.category == 'TURNOVER SUMMARY',
-            ReportEntry.description.like('%TOTAL TURNOVER%'),
-            ReportEntry.date >= start_prev,
-            ReportEntry.date <= end_prev
-        ).scalar() or 0.0
-        
-        # NEW: Current Year Dispensary Turnover
-        aggregates['current_dispensary_turnover'] = session.query(func.sum(ReportEntry.today_value)).filter(
-            ReportEntry.category == 'DISPENSARY SUMMARY',
-            ReportEntry.description == 'Dispensary Turnover/Revenue',
-            ReportEntry.date >= start_current,
-            ReportEntry.date <= end_current
-        ).scalar() or 0.0
-
-        # NEW: Current Year Purchases
-        aggregates['current_purchases'] = session.query(func.sum(ReportEntry.today_value)).filter(
-            ReportEntry.category == 'STOCK TRADING ACCOUNT',
-            ReportEntry.description == 'Purchases',
-            ReportEntry.date >= start_current,
-            ReportEntry.date <= end_current
-        ).scalar() or 0.0
-        
-        # NEW: Current Year Transactions
-        aggregates['current_transactions'] = session.query(func.sum(ReportEntry.today_value)).filter(
-            ReportEntry.category == 'SALES SUMMARY',
-            ReportEntry.description == 'POS Transactions', 
-            ReportEntry.date >= start_current,
-            ReportEntry.date <= end_current
-        ).scalar() or 0
-
-        # NEW: Average Reported Basket Value (Avg of daily reported values)
-        aggregates['avg_basket_value_reported'] = session.query(func.avg(ReportEntry.today_value)).filter(
-            ReportEntry.category == 'SALES SUMMARY',
-            ReportEntry.description == 'Average Value Per Docket/Basket', 
-            ReportEntry.date >= start_current,
-            ReportEntry.date <= end_current
-        ).scalar() or 0.0
-
-        # NEW: Average Reported Basket Size (Avg of daily reported values)
-        aggregates['avg_basket_size_reported'] = session.query(func.avg(ReportEntry.today_value)).filter(
-            ReportEntry.category == 'SALES SUMMARY',
-            ReportEntry.description == 'Average Number Of Items per Basket', 
-            ReportEntry.date >= start_current,
-            ReportEntry.date <= end_current
-        ).scalar() or 0.0
+        if analytics.serves_year(pharmacy, year):
+            # Closed, exported year: one vectorised pass over its Parquet file
+            stats = analytics.year_metric_stats(pharmacy, year, [
+                'turnover', 'cost_of_sales', 'dispensary_turnover', 'purchases', 'pos_transactions',
+                'avg_basket_value', 'avg_basket_size'])
+            stat = lambda key, agg: (stats.get(key) or {}).get(agg) or 0.0
+            aggregates.update({
+                'current_turnover': stat('turnover', 'sum'),
+                'current_cost_of_sales': stat('cost_of_sales', 'sum'),
+                'current_dispensary_turnover': stat('dispensary_turnover', 'sum'),
+                'current_purchases': stat('purchases', 'sum'),
+                'current_transactions': stat('pos_transactions', 'sum') or 0,
+                'avg_basket_value_reported': stat('avg_basket_value', 'avg'),
+                'avg_basket_size_reported': stat('avg_basket_size', 'avg'),
+            })
+        else:
+            # Every current-year aggregate, plus last year's turnover when SQLite serves it too,
+            # in one pass over report_entries (archived years from their cold files)
+            specs = {
+                'current_turnover': ('turnover', 'sum', (start_current, end_current)),
+                'current_cost_of_sales': ('cost_of_sales', 'sum', (start_current, end_current)),
+                'current_dispensary_turnover': ('dispensary_turnover', 'sum', (start_current, end_current)),
+                'current_purchases': ('purchases', 'sum', (start_current, end_current)),
+                'current_transactions': ('pos_transactions', 'sum', (start_current, end_current)),
+                'avg_basket_value_reported': ('avg_basket_value', 'avg', (start_current, end_current)),
+                'avg_basket_size_reported': ('avg_basket_size', 'avg', (start_current, end_current)),
+            }
+            with_previous = not analytics.serves_year(pharmacy, prev_year)
+            if with_previous:
+                specs['previous_turnover'] = ('turnover', 'sum', (start_prev, end_prev))
+            start = start_prev if with_previous else start_current
+            entries = tiered_entries(session, pharmacy, start, end_current)
+            totals = metric_aggregates(session, start, end_current, specs, entries)
+            aggregates.update({name: value or aggregates[name] for name, value in totals.items()})
+
+        # Previous Year Turnover (unless the query above included it)
+        if analytics.serves_year(pharmacy, prev_year):
+            previous = analytics.year_metric_stats(pharmacy, prev_year, ['turnover']).get('turnover') or {}
+            aggregates['previous_turnover'] = previous.get('sum') or 0.0
+        elif analytics.serves_year(pharmacy, year):
+            entries = tiered_entries(session, pharmacy, start_prev, end_prev)
+            aggregates['previous_turnover'] = metric_aggregates(session, start_prev, end_prev, {
+                'previous_turnover': ('turnover', 'sum')}, entries)['previous_turnover'] or 0.0
 
     except Exception as e:
         print(f"Error during yearly aggregate query: {e}")
+        g.no_cache = True # Zeros stand in for the data: serve them, don't cache them
         # Return 0s on error, frontend can handle it
     finally:
         session.close()
@@ -694,6 +554,7 @@ def api_year_aggregates(year_str):
 # NEW: Endpoint for Monthly Summaries for a Year
 @app.route('/api/year/<year_str>/monthly_summaries', methods=['GET'])
 @login_required
+@cached_response(year_end)
 def api_year_monthly_summaries(year_str):
     """Return monthly summaries (Turnover, Prev Yr Turnover, Transactions, Avg Basket Value/Size Reported) for the given year."""
     try:
@@ -705,54 +566,20 @@ def api_year_monthly_summaries(year_str):
     session = get_pharmacy_session()
     summaries = []
     try:
+        # Both years by month in one query (the monthly_metrics rollup)
+        series = metric_series(session, {
+            'turnover': 'sum', 'pos_transactions': 'sum', 'avg_basket_value': 'avg', 'avg_basket_size': 'avg'
+        }, datetime.date(prev_year, 1, 1), datetime.date(year, 12, 31), grain='month', fill=None)['series']
+
         for month in range(1, 13):
-            start_current = datetime.date(year, month, 1)
-            next_month_date = start_current + datetime.timedelta(days=32) # Go to roughly next month
-            end_current = next_month_date.replace(day=1) - datetime.timedelta(days=1)
-
-            start_prev = datetime.date(prev_year, month, 1)
-            next_month_prev_date = start_prev + datetime.timedelta(days=32)
-            end_prev = next_month_prev_date.replace(day=1) - datetime.timedelta(days=1)
-
-            # Current Month Turnover
-            current_turnover = session.query(func.sum(ReportEntry.today_value)).filter(
-                ReportEntry.category == 'TURNOVER SUMMARY',
-                ReportEntry.description.like('%TOTAL TURNOVER%'),
-                ReportEntry.date >= start_current,
-                ReportEntry.date <= end_current
-            ).scalar() or 0.0
-
-            # Previous Year Month Turnover
-            previous_turnover = session.query(func.sum(ReportEntry.today_value)).filter(
-                ReportEntry.category == 'TURNOVER SUMMARY',
-                ReportEntry.description.like('%TOTAL TURNOVER%'),
-                ReportEntry.date >= start_prev,
-                ReportEntry.date <= end_prev
-            ).scalar() or 0.0
-
-            # Current Month Transactions
-            current_transactions = session.query(func.sum(ReportEntry.today_value)).filter(
-                ReportEntry.category == 'SALES SUMMARY',
-                ReportEntry.description == 'POS Transactions',
-                ReportEntry.date >= start_current,
-                ReportEntry.date <= end_current
-            ).scalar() or 0 # Default to 0
-            
-            # NEW: Monthly Average of Reported Daily Average Basket Value
-            avg_basket_value_reported = session.query(func.avg(ReportEntry.today_value)).filter(
-                ReportEntry.category == 'SALES SUMMARY',
-                ReportEntry.description == 'Average Value Per Docket/Basket',
-                ReportEntry.date >= start_current,
-                ReportEntry.date <= end_current
-            ).scalar() or 0.0
-
-            # NEW: Monthly Average of Reported Daily Average Basket Size
-            avg_basket_size_reported = session.query(func.avg(ReportEntry.today_value)).filter(
-                ReportEntry.category == 'SALES SUMMARY',
-                ReportEntry.description == 'Average Number Of Items per Basket',
-                ReportEntry.date >= start_current,
-                ReportEntry.date <= end_current
-            ).scalar() or 0.0
+            current, previous = 12 + month - 1, month - 1 # Bucket positions
+
+            current_turnover = series['turnover'][current] or 0.0
+            previous_turnover = series['turnover'][previous] or 0.0
+            current_transactions = series['pos_transactions'][current] or 0 # Default to 0
+            # Monthly Average of Reported Daily Average Basket Value / Size
+            avg_basket_value_reported = series['avg_basket_value'][current] or 0.0
+            avg_basket_size_reported = series['avg_basket_size'][current] or 0.0
             
             # Calculate YoY Growth (copied from frontend logic for consistency)
             yoy_growth = 0.0
@@ -784,6 +611,7 @@ def api_year_monthly_summaries(year_str):
 # NEW: Endpoint for Stock KPIs for a given month
 @app.route('/api/month/<month_str>/stock_kpis', methods=['GET'])
 @login_required
+@cached_response(month_end)
 def api_month_stock_kpis(month_str):
     """Return key stock KPIs for the given month (YYYY-MM)."""
     try:
@@ -807,86 +635,12 @@ def api_month_stock_kpis(month_str):
         'dsi': None # NEW
     }
     try:
-        # --- Monthly Sums ---
-        # Cost of Sales
-        kpis['cost_of_sales'] = session.query(func.sum(ReportEntry.today_value)).filter(
-            ReportEntry.category == 'STOCK TRADING ACCOUNT',
-            ReportEntry.description == 'Cost Of Sales',
-            ReportEntry.date >= start_date,
-            ReportEntry.date <= end_date
-        ).scalar() or 0.0
-        
-        # Purchases
-        kpis['purchases'] = session.query(func.sum(ReportEntry.today_value)).filter(
-            ReportEntry.category == 'STOCK TRADING ACCOUNT',
-            ReportEntry.description == 'Purchases',
-            ReportEntry.date >= start_date,
-            ReportEntry.date <= end_date
-        ).scalar() or 0.0
-        
-        # Adjustments (New)
-        kpis['adjustments'] = session.query(func.sum(ReportEntry.today_value)).filter(
-            ReportEntry.category == 'STOCK TRADING ACCOUNT',
-            ReportEntry.description == 'Adjustments', # Changed from 'Stock Adjustment'
-            ReportEntry.date >= start_date,
-            ReportEntry.date <= end_date
-        ).scalar() or 0.0
-        
-        # --- Point-in-Time Values ---
-        # Opening Stock (Value from the first available day of the month)
-        first_available_opening_stock_entry = session.query(
-            ReportEntry.today_value
-        ).filter(
-            ReportEntry.category == 'STOCK TRADING ACCOUNT',
-            ReportEntry.description == 'Opening Stock (@ Cost at the Beginning of the Month)',
-            ReportEntry.date >= start_date,
-            ReportEntry.date <= end_date
-        ).order_by(
-            ReportEntry.date.asc() # Order by date ascending
-        ).first() # Get the first result (earliest date)
-            
-        # Extract the value if an entry was found, otherwise default to 0.0
-        kpis['opening_stock'] = first_available_opening_stock_entry[0] if first_available_opening_stock_entry else 0.0
-
-        # Closing Stock (Value from last day of month)
-        # Find the actual last date with data in the month for closing stock
-        last_data_date_in_month = session.query(func.max(ReportEntry.date)).filter(
-             ReportEntry.category == 'STOCK TRADING ACCOUNT',
-             ReportEntry.description == 'Closing Stock Valued at Cost Now',
-             ReportEntry.date >= start_date,
-             ReportEntry.date <= end_date
-        ).scalar()
-
-        if last_data_date_in_month:
-            last_day_closing = session.query(ReportEntry.today_value).filter(
-                ReportEntry.category == 'STOCK TRADING ACCOUNT',
-                ReportEntry.description == 'Closing Stock Valued at Cost Now',
-                ReportEntry.date == last_data_date_in_month
-            ).scalar()
-            kpis['closing_stock'] = last_day_closing or 0.0
-        else:
-             kpis['closing_stock'] = 0.0 # Use 0 if no closing stock found
-             
-        # --- NEW: Calculate derived KPIs --- 
-        avg_stock = 0.0
-        if (kpis['opening_stock'] + kpis['closing_stock']) > 0:
-            avg_stock = (kpis['opening_stock'] + kpis['closing_stock']) / 2.0
-        
-        # Stock Turnover Ratio
-        if avg_stock > 0 and kpis['cost_of_sales'] is not None:
-            kpis['stock_turnover_ratio'] = kpis['cost_of_sales'] / avg_stock
-        else:
-            kpis['stock_turnover_ratio'] = 0.0 # Or None / Infinity?
-            
-        # Days Sales of Inventory (DSI)
-        if kpis['cost_of_sales'] is not None and kpis['cost_of_sales'] != 0:
-            days_in_month = end_date.day # We calculated end_date earlier
-            kpis['dsi'] = (avg_stock / kpis['cost_of_sales']) * days_in_month
-        else:
-            kpis['dsi'] = None # Indicate infinite or undefined DSI
-             
+        # Opening/closing points, monthly sums and derived KPIs in one window query
+        month_kpis = stock_kpi_series(session, month_str, month_str)[0]
+        kpis.update({key: month_kpis[key] for key in kpis})
     except Exception as e:
         print(f"Error querying stock KPIs for {month_str}: {e}")
+        g.no_cache = True # Zeros stand in for the data: serve them, don't cache them
         # Return 0s on error
     finally:
         session.close()
@@ -896,6 +650,7 @@ def api_month_stock_kpis(month_str):
 # NEW: Endpoint for Daily Stock Movements for a given month
 @app.route('/api/month/<month_str>/daily_stock_movements', methods=['GET'])
 @login_required
+@cached_response(month_end)
 def api_month_daily_stock_movements(month_str):
     """Return daily Purchases and Cost of Sales for the given month (YYYY-MM)."""
     try:
@@ -910,51 +665,26 @@ def api_month_daily_stock_movements(month_str):
         return jsonify({'error': 'invalid month format'}), 400
 
     session = get_pharmacy_session()
-    daily_data = {}
+    purchases, cost_of_sales = [0.0] * num_days, [0.0] * num_days # Returned on error
     try:
-        rows = session.query(
-            ReportEntry.date,
-            ReportEntry.description,
-            func.sum(ReportEntry.today_value).label('value')
-        ).filter(
-            ReportEntry.category == 'STOCK TRADING ACCOUNT',
-            ReportEntry.description.in_(['Purchases', 'Cost Of Sales']),
-            ReportEntry.date >= start_date,
-            ReportEntry.date <= end_date
-        ).group_by(ReportEntry.date, ReportEntry.description).all()
-
-        # Process rows into a dictionary keyed by day
-        for r in rows:
-            day = r.date.day
-            if day not in daily_data:
-                daily_data[day] = {'purchases': 0.0, 'costOfSales': 0.0}
-            
-            if r.description == 'Purchases':
-                daily_data[day]['purchases'] = r.value or 0.0
-            elif r.description == 'Cost Of Sales':
-                daily_data[day]['costOfSales'] = r.value or 0.0
-                
+        series = metric_series(session, {'purchases': 'sum', 'cost_of_sales': 'sum'}, start_date, end_date)['series']
+        purchases, cost_of_sales = series['purchases'], series['cost_of_sales']
     except Exception as e:
         print(f"Error querying daily stock movements for {month_str}: {e}")
-        # Return empty data on error
+        g.no_cache = True # Zeros stand in for the data: serve them, don't cache them
     finally:
         session.close()
         
-    # Create result array for all days in the month, padding missing days
-    result = []
-    for day_num in range(1, num_days + 1):
-        day_summary = daily_data.get(day_num, {'purchases': 0.0, 'costOfSales': 0.0})
-        result.append({
-            'day': day_num,
-            'purchases': day_summary.get('purchases', 0.0),
-            'costOfSales': day_summary.get('costOfSales', 0.0)
-        })
-        
-    return jsonify(result)
+    # One entry per day of the month, 0 where no data exists
+    return jsonify([
+        {'day': day, 'purchases': purchased, 'costOfSales': cost}
+        for day, (purchased, cost) in enumerate(zip(purchases, cost_of_sales), 1)
+    ])
 
 # NEW: Endpoint for Yearly Daily Stock Movements
 @app.route('/api/year/<year_str>/daily_stock_movements', methods=['GET'])
 @login_required
+@cached_response(year_end)
 def api_year_daily_stock_movements(year_str):
     """Return daily Purchases and Cost of Sales for the entire given year (YYYY)."""
     try:
@@ -970,30 +700,16 @@ def api_year_daily_stock_movements(year_str):
     session = get_pharmacy_session()
     yearly_data = {}
     try:
-        rows = session.query(
-            ReportEntry.date,
-            ReportEntry.description,
-            func.sum(ReportEntry.today_value).label('value')
-        ).filter(
-            ReportEntry.category == 'STOCK TRADING ACCOUNT',
-            ReportEntry.description.in_(['Purchases', 'Cost Of Sales']),
-            ReportEntry.date >= start_date,
-            ReportEntry.date <= end_date
-        ).group_by(ReportEntry.date, ReportEntry.description).all()
-
-        # Process rows into a dictionary keyed by ISO date string (YYYY-MM-DD)
-        for r in rows:
-            date_str = r.date.isoformat()
-            if date_str not in yearly_data:
-                yearly_data[date_str] = {'purchases': 0.0, 'costOfSales': 0.0}
-            
-            if r.description == 'Purchases':
-                yearly_data[date_str]['purchases'] = r.value or 0.0
-            elif r.description == 'Cost Of Sales':
-                yearly_data[date_str]['costOfSales'] = r.value or 0.0
+        result = metric_series(session, {'purchases': 'sum', 'cost_of_sales': 'sum'}, start_date, end_date, fill=None)
+        series = result['series']
+        # Keyed by ISO date string (YYYY-MM-DD), only days with either value
+        for day, purchased, cost in zip(result['buckets'], series['purchases'], series['cost_of_sales']):
+            if purchased is not None or cost is not None:
+                yearly_data[day.isoformat()] = {'purchases': purchased or 0.0, 'costOfSales': cost or 0.0}
                 
     except Exception as e:
         print(f"Error querying yearly daily stock movements for {year_str}: {e}")
+        g.no_cache = True # Zeros stand in for the data: serve them, don't cache them
         # Return empty data on error
     finally:
         session.close()
@@ -1004,6 +720,7 @@ def api_year_daily_stock_movements(year_str):
 # NEW: Endpoint for Monthly Stock vs Sales for a Year
 @app.route('/api/year/<year_str>/monthly_stock_sales', methods=['GET'])
 @login_required
+@cached_response(year_end)
 def api_year_monthly_stock_sales(year_str):
     """Return monthly Turnover and Closing Stock for the given year (YYYY)."""
     try:
@@ -1014,45 +731,17 @@ def api_year_monthly_stock_sales(year_str):
     session = get_pharmacy_session()
     results = [] 
     try:
-        for month in range(1, 13):
-            start_date = datetime.date(year, month, 1)
-            # Compute last day of month
-            next_month = month % 12 + 1
-            next_year_for_end = year + (month // 12)
-            end_date = datetime.date(next_year_for_end, next_month, 1) - datetime.timedelta(days=1)
-            
-            # --- Monthly Turnover --- 
-            turnover = session.query(func.sum(ReportEntry.today_value)).filter(
-                ReportEntry.category == 'TURNOVER SUMMARY',
-                ReportEntry.description.like('%TOTAL TURNOVER%'),
-                ReportEntry.date >= start_date,
-                ReportEntry.date <= end_date
-            ).scalar() or 0.0
-            
-            # --- Closing Stock (Value from last day of month with data) ---
-            last_data_date_in_month = session.query(func.max(ReportEntry.date)).filter(
-                 ReportEntry.category == 'STOCK TRADING ACCOUNT',
-                 ReportEntry.description == 'Closing Stock Valued at Cost Now',
-                 ReportEntry.date >= start_date,
-                 ReportEntry.date <= end_date
-            ).scalar()
-
-            closing_stock = 0.0
-            if last_data_date_in_month:
-                closing_stock = session.query(ReportEntry.today_value).filter(
-                    ReportEntry.category == 'STOCK TRADING ACCOUNT',
-                    ReportEntry.description == 'Closing Stock Valued at Cost Now',
-                    ReportEntry.date == last_data_date_in_month
-                ).scalar() or 0.0
-            
-            results.append({
-                'month': month,
-                'sales': turnover,
-                'stock': closing_stock
-            })
+        # Monthly turnover and the last closing stock of each month
+        series = metric_series(session, {'turnover': 'sum', 'closing_stock': 'last'},
+                               datetime.date(year, 1, 1), datetime.date(year, 12, 31), grain='month')['series']
+        results = [
+            {'month': month, 'sales': sales, 'stock': stock}
+            for month, (sales, stock) in enumerate(zip(series['turnover'], series['closing_stock']), 1)
+        ]
             
     except Exception as e:
         print(f"Error querying monthly stock/sales for {year_str}: {e}")
+        g.no_cache = True # Zeros stand in for the data: serve them, don't cache them
         # Return potentially partial data on error
     finally:
         session.close()
@@ -1105,6 +794,79 @@ def api_closing_history():
     finally:
         session.close()
 
+# --- NEW: Stock KPIs for a range of months (one window query) ---
+@app.route('/api/stock/kpi_series')
+@login_required
+def api_stock_kpi_series():
+    """Return opening/closing stock, cost of sales, purchases, adjustments, stock turnover ratio
+    and DSI for every month from ?from= to ?to= (YYYY-MM, default the 12 months to this one)."""
+    today = datetime.date.today()
+    default_from = datetime.date(today.year - 1, today.month, 1) + datetime.timedelta(days=32)
+    try:
+        first_month = request.args.get('from', default_from.strftime('%Y-%m'))
+        last_month = request.args.get('to', today.strftime('%Y-%m'))
+        first = datetime.datetime.strptime(first_month, '%Y-%m').date()
+        last = datetime.datetime.strptime(last_month, '%Y-%m').date()
+    except ValueError:
+        return jsonify({'error': 'Invalid month format. Use YYYY-MM.'}), 400
+    if first > last:
+        return jsonify({'error': "'from' must not be after 'to'."}), 400
+    session = get_pharmacy_session()
+    try:
+        series = stock_kpi_series(session, first.strftime('%Y-%m'), last.strftime('%Y-%m'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        print(f"Error querying stock KPI series {first_month}..{last_month}: {e}")
+        return jsonify({'error': 'Failed to retrieve stock KPI series'}), 500
+    finally:
+        session.close()
+    return jsonify(series)
+
+# --- NEW: Generic metric time series (one statement per request) ---
+@app.route('/api/metrics')
+@login_required
+def api_metrics():
+    """Return bucketed series of canonical metrics.
+    ?metrics=turnover,closing_stock:last (key[:agg], comma separated; agg defaults to ?agg=, sum)
+    &from=YYYY-MM-DD&to=YYYY-MM-DD (default month to date) &grain=day|week|month
+    &cumulative=1 (running totals) &fill=0|null (value for buckets without data, default 0)."""
+    today = datetime.date.today()
+    try:
+        start = datetime.datetime.strptime(request.args.get('from', today.replace(day=1).isoformat()), '%Y-%m-%d').date()
+        end = datetime.datetime.strptime(request.args.get('to', today.isoformat()), '%Y-%m-%d').date()
+    except ValueError:
+        return jsonify({'error': 'Invalid date format. Use YYYY-MM-DD.'}), 400
+    default_agg = request.args.get('agg', 'sum')
+    metrics = {}
+    for item in filter(None, request.args.get('metrics', '').split(',')):
+        key, _, agg = item.strip().partition(':')
+        metrics[key] = agg or default_agg
+    if not metrics:
+        return jsonify({'error': "'metrics' is required, e.g. ?metrics=turnover,purchases"}), 400
+    grain = request.args.get('grain', 'day')
+    cumulative = request.args.get('cumulative', '').lower() in ('1', 'true')
+    fill = None if request.args.get('fill', '0').lower() == 'null' else 0.0
+
+    session = get_pharmacy_session()
+    try:
+        result = metric_series(session, metrics, start, end, grain=grain, fill=fill, cumulative=cumulative)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        print(f"Error querying metric series {metrics} {start}..{end}: {e}")
+        return jsonify({'error': 'Failed to retrieve metric series'}), 500
+    finally:
+        session.close()
+    return jsonify({
+        'from': start.isoformat(),
+        'to': end.isoformat(),
+        'grain': grain,
+        'metrics': metrics,
+        'buckets': [bucket.isoformat() for bucket in result['buckets']],
+        'series': result['series'],
+    })
+
 # --- Add this new endpoint at the end of the file or after other routes ---
 @app.route('/api/fetch_reports', methods=['POST'])
 @login_required
@@ -1112,8 +874,8 @@ def api_fetch_reports():
     new_days_count = 0 # Default value
     try:
         print("--- Fetching latest report triggered via API ---")
-        pharmacy = request.headers.get('X-Pharmacy', 'reitz').lower()
-        new_days_count = fetch_latest_report(pharmacy) # Pass pharmacy to load correct .env
+        pharmacy = request_pharmacy()
+        new_days_count = run_sync(pharmacy) # Waits for any scheduled sync of this pharmacy to finish
         print(f"--- Report fetch process completed, {new_days_count} new days added ---")
 
         # Query for the latest date AFTER fetching
@@ -1132,6 +894,77 @@ def api_fetch_reports():
         print(f"--- Error during API fetch_reports: {e} ---")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/sync_status', methods=['GET'])
+@login_required
+def api_sync_status():
+    """Return the background sync schedule and last result for each pharmacy."""
+    scheduler = get_scheduler()
+    if scheduler is None:
+        return jsonify({'running': False, 'pharmacies': []})
+    return jsonify({'running': True, 'pharmacies': scheduler.status()})
+
+# --- NEW: Group totals across the user's pharmacies (one statement over the ATTACHed files) ---
+@app.route('/api/group/aggregates', methods=['GET'])
+@login_required
+def api_group_aggregates():
+    """Per-pharmacy and group totals between ?from= and ?to= (YYYY-MM-DD, default month to date)
+    for every pharmacy the user may see, or the subset named in ?pharmacies=a,b."""
+    today = datetime.date.today()
+    try:
+        start = datetime.datetime.strptime(request.args.get('from', today.replace(day=1).isoformat()), '%Y-%m-%d').date()
+        end = datetime.datetime.strptime(request.args.get('to', today.isoformat()), '%Y-%m-%d').date()
+    except ValueError:
+        return jsonify({'error': 'Invalid date format. Use YYYY-MM-DD.'}), 400
+    allowed = ALLOWED_PHARMACIES.get(current_user.username, [])
+    requested = [p.strip().lower() for p in request.args.get('pharmacies', '').split(',') if p.strip()]
+    pharmacies = [p for p in allowed if not requested or p in requested]
+    if not pharmacies:
+        return jsonify({'error': 'No permitted pharmacies selected.'}), 403
+    session = pharmacy_registry.get_group_session()
+    try:
+        totals = group_daily_totals(session, pharmacies, start, end)
+    except Exception as e:
+        print(f"Error querying group aggregates: {e}")
+        return jsonify({'error': 'Failed to retrieve group aggregates'}), 500
+    finally:
+        session.close()
+
+    def summary(rows):
+        turnover = sum(r['turnover'] for r in rows)
+        cost_of_sales = sum(r['cost_of_sales'] for r in rows)
+        basket_days = sum(r['basket_days'] for r in rows)
+        return {
+            'days': sum(r['days'] for r in rows),
+            'turnover': turnover,
+            'cost_of_sales': cost_of_sales,
+            'purchases': sum(r['purchases'] for r in rows),
+            'gp_value': turnover - cost_of_sales,
+            'gp_percent': (turnover - cost_of_sales) / turnover * 100 if turnover else 0,
+            'dispensary_turnover': sum(r['dispensary_turnover'] for r in rows),
+            'scripts_total': sum(r['scripts_total'] for r in rows),
+            'pos_transactions': sum(r['pos_transactions'] for r in rows),
+            'avg_basket_value': sum(r['basket_sum'] for r in rows) / basket_days if basket_days else 0,
+        }
+
+    return jsonify({
+        'from': start.isoformat(),
+        'to': end.isoformat(),
+        'pharmacies': {p: summary([totals[p]] if p in totals else []) for p in pharmacies},
+        'group': summary(list(totals.values())),
+    })
+
+@app.route('/api/pool_stats', methods=['GET'])
+@login_required
+def api_pool_stats():
+    """Return connection pool counters for each pharmacy engine (read and write) created so far."""
+    return jsonify(pharmacy_registry.pool_stats())
+
+@app.route('/api/cache_stats', methods=['GET'])
+@login_required
+def api_cache_stats():
+    """Return this worker's response cache counters (hits, misses, stale entries, evictions)."""
+    return jsonify(response_cache.stats())
+
 # --- Add this code to serve the React App ---
 @app.route('/', defaults={'path': ''})
 @app.route('/<path:path>')
@@ -1168,75 +1001,23 @@ def api_dashboard_rolling_window():
             current_date = last_day_prev.replace(day=1)
         months_needed.reverse() # Chronological order
 
-        # Query for all needed months in one go
-        # Select month string, description, and sum(value)
-        query_results = session.query(
-            func.strftime('%Y-%m', ReportEntry.date).label('month_str'),
-            ReportEntry.description,
-            func.sum(ReportEntry.today_value).label('total_value')
-        ).filter(
-            ReportEntry.date >= current_date, # Start date is now the earliest month needed
-            ReportEntry.date <= datetime.date(end_year, end_month, 1).replace(day=28)+datetime.timedelta(days=4), # Ensure we cover the end month
-            func.strftime('%Y-%m', ReportEntry.date).in_(months_needed),
-            ReportEntry.category.in_(['TURNOVER SUMMARY', 'STOCK TRADING ACCOUNT', 'SALES SUMMARY']) # Categories needed
-            # Add filter for specific descriptions needed for the charts
-            # (Turnover, CostOfSales, Purchases, AvgBasketValue)
-            # This might need adjustment based on exact description names
-            # ReportEntry.description.in_([
-            #     'TOTAL TURNOVER', # Assuming this is correct
-            #     'Cost Of Sales',
-            #     'Purchases',
-            #     'Average Value Per Docket/Basket' 
-            # ])
-        ).group_by(
-            'month_str',
-            ReportEntry.description
-        ).all()
-
-        # Initialize results dictionary for each month
-        for month_key in months_needed:
+        # All 12 months from the monthly_metrics rollup in one query
+        first_day = datetime.date(*map(int, months_needed[0].split('-')), 1)
+        last_day = (datetime.date(end_year, end_month, 1) + datetime.timedelta(days=32)).replace(day=1) - datetime.timedelta(days=1)
+        series = metric_series(session, {
+            'turnover': 'sum', 'cost_of_sales': 'sum', 'purchases': 'sum',
+            'avg_basket_value': 'avg', # AVERAGE of the daily reported values for the month, not the SUM
+        }, first_day, last_day, grain='month')['series']
+
+        for i, month_key in enumerate(months_needed):
             results[month_key] = {
                 'month': month_key,
-                'turnover': 0.0,
-                'costOfSales': 0.0,
-                'purchases': 0.0,
-                'avgBasketValueReported': 0.0
+                'turnover': series['turnover'][i],
+                'costOfSales': series['cost_of_sales'][i],
+                'purchases': series['purchases'][i],
+                'avgBasketValueReported': series['avg_basket_value'][i]
             }
 
-        # Process query results
-        for row in query_results:
-            month_key = row.month_str
-            desc = row.description
-            value = row.total_value or 0.0
-
-            if month_key in results: # Should always be true based on filter
-                if 'TOTAL TURNOVER' in desc: # Handle variations if needed
-                    results[month_key]['turnover'] = value
-                elif desc == 'Cost Of Sales':
-                    results[month_key]['costOfSales'] = value
-                elif desc == 'Purchases':
-                    results[month_key]['purchases'] = value
-                elif desc == 'Average Value Per Docket/Basket':
-                     # We need the AVERAGE daily reported value for the month, not the SUM
-                     # This part needs a separate query or different aggregation
-                     pass # Placeholder - Will calculate average separately below
-
-        # --- Calculate Average Basket Value Separately --- 
-        # Query average daily basket value grouped by month
-        avg_basket_results = session.query(
-            func.strftime('%Y-%m', ReportEntry.date).label('month_str'),
-            func.avg(ReportEntry.today_value).label('avg_value')
-        ).filter(
-            func.strftime('%Y-%m', ReportEntry.date).in_(months_needed),
-            ReportEntry.category == 'SALES SUMMARY',
-            ReportEntry.description == 'Average Value Per Docket/Basket'
-        ).group_by('month_str').all()
-        
-        for row in avg_basket_results:
-             if row.month_str in results:
-                 results[row.month_str]['avgBasketValueReported'] = row.avg_value or 0.0
-        # --- End Average Basket Value Calculation ---
-
     except Exception as e:
         print(f"Error querying rolling window data: {e}")
         session.rollback()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""Month and year aggregate endpoints: latency and SQL statements per request.
+
+Builds one pharmacy database with YEARS years of synthetic daily reports (see
+bench_analytics), then requests /api/month/<m>/aggregates for every month of the last
+closed year and /api/year/<y>/aggregates for every closed year. Prints the median latency
+and the number of statements each request sent to SQLite.
+
+Usage:
+    python benchmarks/bench_aggregates.py [years] [repeats]
+"""
+import datetime
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import bench_analytics  # Sets up a temporary PHARMACY_DATA_DIR before the project modules load
+import pharmacy_registry
+from sqlalchemy import event
+
+PHARMACY = bench_analytics.PHARMACY
+
+
+def measure(client, urls, repeats):
+    """(median ms, statements per request) over every url, repeats times each."""
+    engine = pharmacy_registry.get_engine(PHARMACY, read_only=True)
+    statements = []
+    count = lambda *args: statements.append(1)
+    event.listen(engine, 'before_cursor_execute', count)
+    samples, counts = [], []
+    try:
+        for url in urls:
+            for _ in range(repeats):
+                statements.clear()
+                started = time.perf_counter()
+                response = client.get(url, headers={'X-Pharmacy': PHARMACY})
+                samples.append((time.perf_counter() - started) * 1000)
+                counts.append(len(statements))
+                assert response.status_code == 200, url
+    finally:
+        event.remove(engine, 'before_cursor_execute', count)
+    return statistics.median(samples), statistics.median(counts)
+
+
+def main():
+    years = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    started = time.perf_counter()
+    rows = bench_analytics.build(years)
+    print(f"{rows} rows over {years} years built in {time.perf_counter() - started:.1f}s ({bench_analytics.DATA_DIR})")
+
+    import app as backend
+    backend.app.config['LOGIN_DISABLED'] = True
+    client = backend.app.test_client()
+    last_closed = datetime.date.today().year - 1
+    endpoints = {
+        'month aggregates': [f"/api/month/{last_closed}-{m:02d}/aggregates" for m in range(1, 13)],
+        'year aggregates': [f"/api/year/{y}/aggregates" for y in range(last_closed - years + 2, last_closed + 1)],
+    }
+    for name, urls in endpoints.items():
+        median_ms, queries = measure(client, urls, repeats)
+        print(f"{name:<17}: p50 {median_ms:7.2f} ms | {queries:g} statements per request")
+
+
+if __name__ == '__main__':
+    main()
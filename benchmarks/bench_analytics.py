@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""Year endpoints on a 10-year synthetic history: SQLite vs the Parquet backends (see analytics).
+
+Builds one pharmacy database with YEARS years of daily reports (about 70 rows a day),
+exports every year to Parquet, then times /api/year/<y>/aggregates and
+/api/year/<y>/daily_turnover for each closed year under each ANALYTICS_BACKEND.
+Backends whose package isn't installed (duckdb, pyarrow) are reported as skipped.
+
+Usage:
+    python benchmarks/bench_analytics.py [years] [repeats]
+"""
+import datetime
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+DATA_DIR = tempfile.mkdtemp(prefix='bench_analytics_')
+os.environ.update({
+    'PHARMACY_DATA_DIR': DATA_DIR,
+    'PARQUET_DIR': os.path.join(DATA_DIR, 'parquet'),
+    'DATABASE_URL': f"sqlite:///{os.path.join(DATA_DIR, 'default.db')}",
+    'SYNC_SCHEDULER': 'off',
+    'REPORT_ARCHIVE_DIR': '',
+    'RESPONSE_CACHE': 'off',  # Measure the queries, not cache hits
+})
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'backend')]
+
+import analytics
+import pharmacy_registry
+from main import ReportEntry, export_parquet, upgrade_schema
+from report_metrics import METRIC_ALIASES
+
+PHARMACY = 'reitz'
+
+
+def synthetic_rows(years):
+    """One row per (day, line): every aliased metric plus filler lines, like a real report."""
+    rnd = random.Random(0)
+    lines = [(category, text if match == 'exact' else f"Private {text}".strip())
+             for _, category, match, text in METRIC_ALIASES]
+    lines += [('SALES SUMMARY', f"Department {i}") for i in range(60)]
+    first_year = datetime.date.today().year - years
+    day, end = datetime.date(first_year, 1, 1), datetime.date(first_year + years, 1, 1)
+    while day < end:
+        for category, description in lines:
+            yield {'date': day, 'category': category, 'description': description,
+                   'today_value': round(rnd.uniform(0, 50000), 2)}
+        day += datetime.timedelta(days=1)
+
+
+def build(years):
+    engine = pharmacy_registry.get_engine(PHARMACY)
+    rows = list(synthetic_rows(years))
+    with engine.begin() as conn:
+        conn.execute(ReportEntry.__table__.insert(), rows)
+    upgrade_schema(engine)  # Links metric ids and fills daily_metrics / monthly_metrics
+    if analytics.pq is not None:
+        export_parquet(PHARMACY)
+    return len(rows)
+
+
+def timed(client, url, repeats):
+    samples = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        response = client.get(url, headers={'X-Pharmacy': PHARMACY})
+        samples.append((time.perf_counter() - started) * 1000)
+        assert response.status_code == 200, url
+    return statistics.median(samples)
+
+
+def main():
+    years = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    started = time.perf_counter()
+    rows = build(years)
+    print(f"{rows} rows over {years} years built in {time.perf_counter() - started:.1f}s ({DATA_DIR})")
+
+    import app as backend
+    backend.app.config['LOGIN_DISABLED'] = True
+    client = backend.app.test_client()
+    closed_years = range(datetime.date.today().year - years + 1, datetime.date.today().year)
+
+    for name in ('sqlite', 'duckdb', 'pyarrow'):
+        if name != 'sqlite' and analytics.backend(name) is None:
+            print(f"{name:<8}: skipped (pip install {name})")
+            continue
+        analytics.ANALYTICS_BACKEND = name
+        aggregates = [timed(client, f"/api/year/{y}/aggregates", repeats) for y in closed_years]
+        daily = [timed(client, f"/api/year/{y}/daily_turnover", repeats) for y in closed_years]
+        print(f"{name:<8}: year aggregates p50 {statistics.median(aggregates):7.2f} ms | "
+              f"daily turnover p50 {statistics.median(daily):7.2f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""/api/year/<y>/monthly_summaries against the original 60-query implementation.
+
+Builds one pharmacy database with YEARS years of synthetic daily reports (see
+bench_analytics). For every year it compares the endpoint's response with
+reference_monthly_summaries, the original loop that ran five report_entries queries per
+month. It also prints both latencies and statements per request. Exits 1 on any mismatch.
+
+Usage:
+    python benchmarks/bench_monthly_summaries.py [years] [repeats]
+"""
+import datetime
+import math
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import bench_analytics  # Sets up a temporary PHARMACY_DATA_DIR before the project modules load
+import pharmacy_registry
+from main import ReportEntry
+from sqlalchemy import event, func
+
+PHARMACY = bench_analytics.PHARMACY
+
+
+def reference_monthly_summaries(session, year):
+    """The original implementation: 12 months x 5 scalar queries on report_entries."""
+    prev_year = year - 1
+    summaries = []
+    for month in range(1, 13):
+        start_current = datetime.date(year, month, 1)
+        end_current = (start_current + datetime.timedelta(days=32)).replace(day=1) - datetime.timedelta(days=1)
+        start_prev = datetime.date(prev_year, month, 1)
+        end_prev = (start_prev + datetime.timedelta(days=32)).replace(day=1) - datetime.timedelta(days=1)
+
+        def scalar(agg, category, description, start, end, like=False):
+            match = ReportEntry.description.like(description) if like else ReportEntry.description == description
+            return session.query(agg(ReportEntry.today_value)).filter(
+                ReportEntry.category == category, match,
+                ReportEntry.date >= start, ReportEntry.date <= end
+            ).scalar()
+
+        current_turnover = scalar(func.sum, 'TURNOVER SUMMARY', '%TOTAL TURNOVER%', start_current, end_current, like=True) or 0.0
+        previous_turnover = scalar(func.sum, 'TURNOVER SUMMARY', '%TOTAL TURNOVER%', start_prev, end_prev, like=True) or 0.0
+        current_transactions = scalar(func.sum, 'SALES SUMMARY', 'POS Transactions', start_current, end_current) or 0
+        avg_basket_value_reported = scalar(func.avg, 'SALES SUMMARY', 'Average Value Per Docket/Basket', start_current, end_current) or 0.0
+        avg_basket_size_reported = scalar(func.avg, 'SALES SUMMARY', 'Average Number Of Items per Basket', start_current, end_current) or 0.0
+
+        yoy_growth = 0.0
+        if previous_turnover > 0:
+            yoy_growth = ((current_turnover - previous_turnover) / previous_turnover) * 100
+        elif current_turnover > 0:
+            yoy_growth = float('inf')
+        summaries.append({
+            'month': month,
+            'currentTotal': current_turnover,
+            'previousTotal': previous_turnover,
+            'transactions': current_transactions,
+            'avgBasketValueReported': avg_basket_value_reported,
+            'avgBasketSizeReported': avg_basket_size_reported,
+            'yoyGrowth': yoy_growth
+        })
+    return summaries
+
+
+def same(expected, actual):
+    """Equal keys and values; floats to 1e-9 relative (summation order differs)."""
+    if len(expected) != len(actual):
+        return False
+    for want, got in zip(expected, actual):
+        if want.keys() != got.keys():
+            return False
+        for key in want:
+            if not (want[key] == got[key] or math.isclose(want[key], got[key], rel_tol=1e-9)):
+                return False
+    return True
+
+
+def timed(run, repeats):
+    """(median ms, statements per call, last result) for run()."""
+    engine = pharmacy_registry.get_engine(PHARMACY, read_only=True)
+    statements = []
+    count = lambda *args: statements.append(1)
+    event.listen(engine, 'before_cursor_execute', count)
+    samples = []
+    try:
+        for _ in range(repeats):
+            statements.clear()
+            started = time.perf_counter()
+            result = run()
+            samples.append((time.perf_counter() - started) * 1000)
+    finally:
+        event.remove(engine, 'before_cursor_execute', count)
+    return statistics.median(samples), len(statements), result
+
+
+def main():
+    years = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    started = time.perf_counter()
+    rows = bench_analytics.build(years)
+    print(f"{rows} rows over {years} years built in {time.perf_counter() - started:.1f}s ({bench_analytics.DATA_DIR})")
+
+    import app as backend
+    backend.app.config['LOGIN_DISABLED'] = True
+    client = backend.app.test_client()
+    session = pharmacy_registry.get_session(PHARMACY, read_only=True)
+    today = datetime.date.today()
+    mismatches = 0
+    try:
+        # One year before the data through the current year: covers empty and partial years
+        for year in range(today.year - years, today.year + 1):
+            ref_ms, ref_queries, expected = timed(lambda: reference_monthly_summaries(session, year), repeats)
+            api_ms, api_queries, response = timed(
+                lambda: client.get(f"/api/year/{year}/monthly_summaries", headers={'X-Pharmacy': PHARMACY}), repeats)
+            ok = response.status_code == 200 and same(expected, response.get_json())
+            mismatches += not ok
+            print(f"{year}: {'match' if ok else 'MISMATCH'} | reference {ref_ms:7.2f} ms, {ref_queries} statements"
+                  f" | endpoint {api_ms:7.2f} ms, {api_queries} statements")
+    finally:
+        session.close()
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == '__main__':
+    main()
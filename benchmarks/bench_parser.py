@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+"""Per-email parse time: BeautifulSoup + extract_report_data vs report_parser.extract_report_entries.
+
+Usage:
+    python benchmarks/bench_parser.py                 # synthetic DMR email
+    python benchmarks/bench_parser.py saved1.html ... # real report bodies saved to disk
+"""
+import os
+import random
+import sys
+import time
+from typing import Dict, List
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from bs4 import BeautifulSoup
+from report_parser import clean_int_value, extract_report_entries, parse_value
+
+
+# --- The original BeautifulSoup parser, kept here as the reference implementation ---
+def find_table_by_title(soup, title_keyword):
+    """Finds table by checking if title_keyword is in the first td of the first tr."""
+    for table in soup.find_all('table'):
+        first_row = table.find('tr')
+        if first_row:
+             first_td = first_row.find('td')
+             if first_td and title_keyword.lower() in first_td.get_text(strip=True).lower():
+                 return table
+    return None
+
+
+def parse_table(table):
+    """Parses a standard table structure (header on row 2, data from row 3)."""
+    rows_data = []
+    trs = table.find_all('tr')
+    if len(trs) < 2: return rows_data # Need at least title and header row
+
+    # Try to find the header row dynamically ('Description', 'Today', 'This Month')
+    header_row_index = -1
+    potential_header_row = -1
+    for i, tr in enumerate(trs):
+        tds = tr.find_all('td')
+        if len(tds) == 3: # Standard tables have 3 columns
+            # Check if this looks like the header
+            texts = [td.get_text(strip=True) for td in tds]
+            if 'Description' in texts[0] and 'Today' in texts[1] and 'This Month' in texts[2]:
+                header_row_index = i
+                break
+            elif i > 0 and potential_header_row == -1: # Guess header is row index 1 if not found explicitly
+                 potential_header_row = i # Usually the second row (index 1)
+
+    if header_row_index == -1:
+         header_row_index = potential_header_row # Use the guess if specific header not found
+         if header_row_index == -1 or header_row_index >= len(trs)-1:
+              print("Warning: Could not determine header row reliably for a table.")
+              return rows_data # Cannot proceed without headers
+
+    header_cells = [cell.get_text(strip=True) for cell in trs[header_row_index].find_all('td')]
+    if len(header_cells) != 3: # Ensure it has 3 header columns
+         print(f"Warning: Unexpected number of header cells ({len(header_cells)}) found.")
+         return rows_data
+
+    # Data rows start after the header row
+    for tr in trs[header_row_index + 1:]:
+        cells = tr.find_all('td')
+        # Allow for slight variations, but expect 3 columns for data
+        if len(cells) >= 3: # Check if at least 3 cells exist
+            # Map based on found header cells
+            row_dict = {}
+            row_dict[header_cells[0]] = cells[0].get_text(strip=True) # Description
+            row_dict[header_cells[1]] = cells[1].get_text(strip=True) # Today
+            row_dict[header_cells[2]] = cells[2].get_text(strip=True) # This Month
+            rows_data.append(row_dict)
+        elif len(cells) > 0 and cells[0].get_text(strip=True): # Handle rows that might just have a description (like totals)
+            # Append with empty values if needed, or skip based on use case
+            # print(f"Info: Skipping row with insufficient cells: {[c.get_text(strip=True) for c in cells]}")
+            pass
+
+    return rows_data
+
+def extract_report_data(soup) -> List[Dict]: # Return list of dictionaries
+    """Extracts data from standard tables AND the specific Sales Summary data."""
+    selected_titles = ["STOCK TRADING ACCOUNT", "DISPENSARY SUMMARY", "TURNOVER SUMMARY", "SALES SUMMARY"]
+    all_entries = []
+
+    for title in selected_titles:
+        table = find_table_by_title(soup, title)
+        if not table:
+            print(f"Warning: Table '{title}' not found in email.")
+            continue
+
+        print(f"Processing table: {title}")
+        if title == "SALES SUMMARY":
+            pos_transactions_today = 0
+            rows = table.find_all('tr')
+            found_pos_row = False
+            found_avg_value_row = False # Flag for avg value
+            found_avg_size_row = False  # Flag for avg size
+            for row in rows:
+                cells = row.find_all('td')
+                # Check POS Transactions
+                if len(cells) >= 2 and not found_pos_row:
+                    first_cell_text = cells[0].get_text(strip=True)
+                    if "TOTAL POS TURNOVER:" in first_cell_text:
+                        try:
+                            trans_text = cells[1].get_text(strip=True)
+                            pos_transactions_today = clean_int_value(trans_text) or 0
+                            print(f"  Extracted: POS Transactions = {pos_transactions_today}")
+                            all_entries.append({
+                                "category": title, 
+                                "description": "POS Transactions",
+                                "today_value": float(pos_transactions_today)
+                            })
+                            found_pos_row = True # Mark as found
+                            # Don't break yet, continue checking for other rows
+                        except Exception as e:
+                            print(f"Error parsing POS Transactions row: {e}")
+                            
+                # NEW: Check Average Value Per Docket/Basket
+                if len(cells) >= 2 and not found_avg_value_row:
+                    first_cell_text = cells[0].get_text(strip=True)
+                    if "Average Value Per Docket/Basket" in first_cell_text: # Use exact string from report
+                        try:
+                            avg_val_text = cells[1].get_text(strip=True) 
+                            avg_value_today = parse_value(avg_val_text) # Use parse_value for currency/float
+                            print(f"  Extracted: Average Value Per Docket/Basket = {avg_value_today}")
+                            all_entries.append({
+                                "category": title,
+                                "description": "Average Value Per Docket/Basket", 
+                                "today_value": avg_value_today
+                            })
+                            found_avg_value_row = True # Mark as found
+                        except Exception as e:
+                            print(f"Error parsing Average Value row: {e}")
+
+                # NEW: Check Average Number Of Items per Basket
+                if len(cells) >= 2 and not found_avg_size_row:
+                     first_cell_text = cells[0].get_text(strip=True)
+                     if "Average Number Of Items per Basket" in first_cell_text: # Use exact string
+                         try:
+                             avg_size_text = cells[1].get_text(strip=True)
+                             avg_size_today = parse_value(avg_size_text) # Use parse_value as it might be float
+                             print(f"  Extracted: Average Number Of Items per Basket = {avg_size_today}")
+                             all_entries.append({
+                                 "category": title,
+                                 "description": "Average Number Of Items per Basket",
+                                 "today_value": avg_size_today
+                             })
+                             found_avg_size_row = True # Mark as found
+                         except Exception as e:
+                             print(f"Error parsing Average Size row: {e}")
+            
+            # Check if all expected rows were found
+            if not found_pos_row:
+                 print(f"Warning: 'TOTAL POS TURNOVER:' row not found in SALES SUMMARY table.")
+            if not found_avg_value_row:
+                 print(f"Warning: 'Average Value Per Docket/Basket' row not found in SALES SUMMARY table.")
+            if not found_avg_size_row:
+                 print(f"Warning: 'Average Number Of Items per Basket' row not found in SALES SUMMARY table.")
+
+        else: # Handle standard tables
+            parsed_rows = parse_table(table)
+            for row in parsed_rows:
+                # Ensure keys exist before accessing
+                desc = row.get('Description')
+                today_val_str = row.get('Today')
+                if desc: # Only add if description exists
+                     all_entries.append({
+                         "category": title,
+                         "description": desc,
+                         "today_value": today_val_str # Keep as string for save_entries to parse
+                     })
+    return all_entries
+
+
+FILLER_SECTIONS = ["DEPARTMENT SALES", "TILL SUMMARY", "CASHIER SUMMARY", "DEBTORS SUMMARY",
+                   "CREDITORS SUMMARY", "PAYMENT METHODS", "GP SUMMARY", "VAT SUMMARY"]
+
+
+def _table(title, rows):
+    html = f"<table><tr><td colspan='3'><b>{title}</b></td></tr>"
+    html += "<tr><td>Description</td><td>Today</td><td>This Month</td></tr>"
+    for desc, today, month in rows:
+        html += f"<tr><td>{desc}</td><td align='right'>{today}</td><td align='right'>{month}</td></tr>"
+    return html + "</table>"
+
+
+def synthetic_report(seed=0, rows_per_section=25):
+    """A DMR-shaped email: the four parsed sections plus filler sections of similar size."""
+    rnd = random.Random(seed)
+    money = lambda: f"R {rnd.randint(0, 500000):,}.{rnd.randint(0, 99):02d}"
+    html = "<html><body><p>Daily Management Report</p>"
+    sections = ["STOCK TRADING ACCOUNT", "DISPENSARY SUMMARY", "TURNOVER SUMMARY"] + FILLER_SECTIONS
+    rnd.shuffle(sections)
+    for title in sections:
+        rows = [(f"{title.title()} line {i}", money(), money()) for i in range(rows_per_section)]
+        if title == "TURNOVER SUMMARY":
+            rows.append(("TOTAL TURNOVER", money(), money()))
+        if title == "STOCK TRADING ACCOUNT":
+            rows += [("Cost Of Sales", money(), money()), ("Purchases", money(), money()),
+                     ("Closing Stock Valued at Cost Now", money(), money())]
+        html += _table(title, rows)
+    html += ("<table><tr><td>SALES SUMMARY</td></tr>"
+             f"<tr><td>TOTAL POS TURNOVER:</td><td>{rnd.randint(100, 900):,}</td><td>{money()}</td></tr>"
+             f"<tr><td>Average Value Per Docket/Basket</td><td>{money()}</td></tr>"
+             f"<tr><td>Average Number Of Items per Basket</td><td>{rnd.uniform(1, 5):.2f}</td></tr></table>")
+    return html + "</body></html>"
+
+
+def _normalise(entries):
+    out = []
+    for e in entries:
+        value = e['today_value']
+        out.append((e['category'], e['description'], parse_value(value) if isinstance(value, str) else value))
+    return out
+
+
+def _time_per_email(fn, emails, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for html in emails:
+            fn(html)
+        best = min(best, (time.perf_counter() - started) / len(emails))
+    return best
+
+
+def main(paths):
+    if paths:
+        emails = [open(p, encoding='utf-8', errors='replace').read() for p in paths]
+    else:
+        emails = [synthetic_report(seed) for seed in range(20)]
+
+    old = lambda html: extract_report_data(BeautifulSoup(html, 'lxml'))
+    new = extract_report_entries
+
+    devnull = open(os.devnull, 'w')
+    stdout, sys.stdout = sys.stdout, devnull  # both parsers print progress/warnings
+    try:
+        mismatches = sum(_normalise(old(h)) != _normalise(new(h)) for h in emails)
+        old_t = _time_per_email(old, emails, repeat=5)
+        new_t = _time_per_email(new, emails, repeat=5)
+    finally:
+        sys.stdout = stdout
+
+    print(f"emails:                    {len(emails)} ({sum(map(len, emails)) // len(emails):,} chars avg)")
+    print(f"BeautifulSoup (before):    {old_t * 1000:8.3f} ms/email")
+    print(f"lxml single-pass (after):  {new_t * 1000:8.3f} ms/email")
+    print(f"speed-up:                  {old_t / new_t:8.1f}x")
+    print(f"output mismatches:         {mismatches}")
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""Dashboard read latency while an ingest is writing: SQLite defaults vs pharmacy_registry.SQLITE_PROFILE.
+
+A writer thread imports synthetic reports (one transaction per WRITE_BATCH_SIZE reports,
+like the history import) while reader threads repeat a month-to-date style aggregate.
+Readers use query_only connections, like the API.
+
+Usage:
+    python benchmarks/bench_sqlite_profile.py [days_preloaded] [days_ingested] [readers]
+"""
+import datetime
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+os.environ.setdefault('DATABASE_URL', 'sqlite://')  # main.py creates tables on import
+
+from sqlalchemy import create_engine, func
+from sqlalchemy.orm import sessionmaker
+
+import pharmacy_registry
+from main import Base, ReportEntry, WRITE_BATCH_SIZE, bulk_save_entries
+
+DEFAULTS = {'busy_timeout': 5000}  # Only the timeout, so readers wait rather than fail
+START = datetime.date(2015, 1, 1)
+
+
+def synthetic_entries(rnd, rows=60):
+    categories = ["STOCK TRADING ACCOUNT", "DISPENSARY SUMMARY", "TURNOVER SUMMARY", "SALES SUMMARY"]
+    entries = [{'category': categories[i % 4], 'description': f"Line {i}", 'today_value': rnd.uniform(0, 50000)}
+               for i in range(rows)]
+    entries.append({'category': "TURNOVER SUMMARY", 'description': "TOTAL TURNOVER", 'today_value': rnd.uniform(0, 90000)})
+    return entries
+
+
+def _engine(path, profile, query_only=False):
+    engine = create_engine(f"sqlite:///{path}", future=True, connect_args={'check_same_thread': False})
+    return pharmacy_registry.apply_sqlite_profile(engine, profile, query_only=query_only)
+
+
+def run(profile_name, profile, preload, ingest, readers):
+    path = os.path.join(tempfile.mkdtemp(prefix='bench_sqlite_'), 'reports.db')
+    writer = _engine(path, profile)
+    Base.metadata.create_all(bind=writer)
+    WriteSession = sessionmaker(bind=writer)
+    ReadSession = sessionmaker(bind=_engine(path, profile, query_only=True))
+    rnd = random.Random(0)
+
+    with WriteSession() as session:
+        for day in range(preload):
+            bulk_save_entries(synthetic_entries(rnd), START + datetime.timedelta(days=day), session, commit=False)
+        session.commit()
+
+    done = threading.Event()
+    latencies = []
+    lock = threading.Lock()
+
+    def reader():
+        with ReadSession() as session:
+            while not done.is_set():
+                started = time.perf_counter()
+                session.query(func.sum(ReportEntry.today_value)).filter(
+                    ReportEntry.description == "TOTAL TURNOVER",
+                    ReportEntry.date >= START,
+                ).scalar()
+                session.rollback()  # End the read transaction so WAL checkpoints can progress
+                with lock:
+                    latencies.append(time.perf_counter() - started)
+
+    threads = [threading.Thread(target=reader) for _ in range(readers)]
+    for t in threads:
+        t.start()
+    started = time.perf_counter()
+    with WriteSession() as session:
+        for i, day in enumerate(range(preload, preload + ingest), 1):
+            bulk_save_entries(synthetic_entries(rnd), START + datetime.timedelta(days=day), session, commit=False)
+            if i % WRITE_BATCH_SIZE == 0:
+                session.commit()
+        session.commit()
+    ingest_seconds = time.perf_counter() - started
+    done.set()
+    for t in threads:
+        t.join()
+
+    ms = sorted(x * 1000 for x in latencies)
+    print(f"{profile_name:>8}: ingest {ingest} days in {ingest_seconds:6.2f}s | {len(ms):6d} reads | "
+          f"p50 {statistics.median(ms):7.2f} ms  p95 {ms[int(len(ms) * 0.95) - 1]:7.2f} ms  max {ms[-1]:8.2f} ms")
+
+
+def main():
+    preload = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    ingest = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    readers = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+    print(f"{preload} days preloaded, {ingest} days ingested, {readers} reader threads")
+    run('default', DEFAULTS, preload, ingest, readers)
+    run('profile', pharmacy_registry.SQLITE_PROFILE, preload, ingest, readers)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""Hot/cold tiering of report_entries: closed years live in per-year SQLite files.
+
+`python main.py archive-years [pharmacy|all]` moves every year older than the last
+ARCHIVE_KEEP_YEARS (default 2: this year and last) out of the pharmacy's report_entries into
+    <COLD_DB_DIR>/<pharmacy>/report_entries_<YYYY>.db
+then VACUUMs and ANALYZEs the hot file, so it and its indexes stay small enough for the page
+cache. daily_metrics, monthly_metrics and monthly_closing_stock keep every year, so the
+day- and month-level endpoints never touch the cold files.
+
+Queries over raw report_entries whose date range reaches an archived year ATTACH that year's
+file (as schema cold_<YYYY>) on the connection they run on. The file stays attached to that
+pooled connection for later requests, up to COLD_MAX_ATTACHED files per connection.
+"""
+import datetime
+import os
+import re
+from typing import Dict, List, Tuple
+
+import pharmacy_registry
+
+COLD_DB_DIR = os.getenv('COLD_DB_DIR', os.path.join(pharmacy_registry.PHARMACY_DATA_DIR, 'cold'))
+ARCHIVE_KEEP_YEARS = int(os.getenv('ARCHIVE_KEEP_YEARS', '2'))
+# SQLite attaches at most 10 files per connection by default
+COLD_MAX_ATTACHED = int(os.getenv('COLD_MAX_ATTACHED', '8'))
+
+_COLD_FILE = re.compile(r'^report_entries_(\d{4})\.db$')
+
+
+def cold_db_file(pharmacy, year: int) -> str:
+    pharmacy = pharmacy_registry.resolve_pharmacy(pharmacy)
+    return os.path.join(COLD_DB_DIR, pharmacy, f"report_entries_{year}.db")
+
+
+def schema_name(year: int) -> str:
+    return f"cold_{year}"
+
+
+def first_hot_year(keep_years=None, today=None) -> int:
+    """Years before this one are archived by archive-years (the current year is always hot)."""
+    today = today or datetime.date.today()
+    keep_years = ARCHIVE_KEEP_YEARS if keep_years is None else int(keep_years)
+    return today.year - max(keep_years, 1) + 1
+
+
+def cold_years(pharmacy) -> List[int]:
+    """The years with an archive file for pharmacy, oldest first."""
+    directory = os.path.dirname(cold_db_file(pharmacy, 0))
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    return sorted(int(m.group(1)) for m in map(_COLD_FILE.match, names) if m)
+
+
+def cold_years_between(pharmacy, start: datetime.date, end: datetime.date) -> List[int]:
+    """The archived years that overlap [start, end]."""
+    return [year for year in cold_years(pharmacy) if start.year <= year <= end.year]
+
+
+def _file_id(path) -> Tuple[str, int]:
+    """(path, inode): a file restored and archived again is attached afresh."""
+    try:
+        return path, os.stat(path).st_ino
+    except FileNotFoundError:
+        return path, 0
+
+
+def attach_years(connection, pharmacy, years) -> List[str]:
+    """ATTACHes the cold files of years to connection (a SQLAlchemy Connection) unless they are
+    already attached, and returns their schema names. Attachments are remembered in the pooled
+    DBAPI connection's info; when a new file would go over COLD_MAX_ATTACHED, the ones this
+    call doesn't need are detached first. Must run outside a write transaction."""
+    attached: Dict[str, Tuple[str, int]] = connection.info.setdefault('cold_attached', {})
+    wanted = {schema_name(year): _file_id(cold_db_file(pharmacy, year)) for year in years}
+    for schema, file_id in list(attached.items()):
+        if schema in wanted and file_id != wanted[schema]:  # Other pharmacy's file, or re-created since
+            connection.exec_driver_sql(f'DETACH DATABASE "{schema}"')
+            del attached[schema]
+    missing = [schema for schema in wanted if schema not in attached]
+    if missing and len(attached) + len(missing) > COLD_MAX_ATTACHED:
+        for schema in [s for s in attached if s not in wanted]:
+            connection.exec_driver_sql(f'DETACH DATABASE "{schema}"')
+            del attached[schema]
+    for schema in missing:
+        connection.exec_driver_sql(f'ATTACH DATABASE ? AS "{schema}"', (wanted[schema][0],))
+        attached[schema] = wanted[schema]
+    return list(wanted)
+
+
+def detach_all(connection):
+    """DETACHes every cold file attach_years attached to connection."""
+    attached = connection.info.get('cold_attached', {})
+    for schema in list(attached):
+        connection.exec_driver_sql(f'DETACH DATABASE "{schema}"')
+        del attached[schema]
@@ -1,17 +1,30 @@
 #!/usr/bin/env python3
 import os
 import datetime
-import email
 from imapclient import IMAPClient, SEEN # Import SEEN here
-from bs4 import BeautifulSoup
-from dotenv import load_dotenv
+from dotenv import load_dotenv, dotenv_values
 import json
-from sqlalchemy import create_engine, Column, Integer, String, Date, Float, func, UniqueConstraint # Added UniqueConstraint
-from sqlalchemy.orm import sessionmaker, declarative_base, Session # Added Session
+from sqlalchemy import create_engine, Column, Integer, String, Date, DateTime, Float, func, UniqueConstraint, Index, ForeignKey, MetaData, inspect, literal, select, text, union_all, and_, or_, case, type_coerce, exists # Added UniqueConstraint
+from sqlalchemy.orm import sessionmaker, declarative_base, Session, aliased # Added Session
 from email.utils import parsedate_to_datetime
 import sys
-from typing import Optional, List, Dict # Added typing
-from sqlalchemy.exc import IntegrityError # Added IntegrityError
+import time
+import queue
+import threading
+import itertools
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass, field
+from typing import Optional, List, Dict, Tuple # Added typing
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from report_parser import parse_value, parse_report_message
+from report_archive import open_report_archive
+from report_metrics import canonical_metric_key, METRIC_KEYS
+import analytics
+import cold_tier
+import pharmacy_registry
+from pharmacy_registry import PHARMACY_ENV_FILES
 
 # Explicitly load .env from project root
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
@@ -21,9 +34,24 @@ load_dotenv(dotenv_path)
 # Database configuration
 DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite:////data/reports.db')
 engine = create_engine(DATABASE_URL, echo=False, future=True) # Keep future=True if using SQLAlchemy 1.4+
+if pharmacy_registry.SQLITE_PROFILE_ENABLED:
+    pharmacy_registry.apply_sqlite_profile(engine)
 SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
 Base = declarative_base()
 
+# Number of UIDs requested per IMAP FETCH command
+FETCH_BATCH_SIZE = int(os.getenv('FETCH_BATCH_SIZE', '50'))
+# IMAP IDLE watch mode: idle_check poll, IDLE re-issue (servers drop IDLE after ~29 min), reconnect backoff
+IDLE_CHECK_SECONDS = int(os.getenv('IDLE_CHECK_SECONDS', '30'))
+IDLE_RENEW_SECONDS = int(os.getenv('IDLE_RENEW_SECONDS', str(20 * 60)))
+IDLE_RETRY_SECONDS = float(os.getenv('IDLE_RETRY_SECONDS', '5'))
+IDLE_MAX_BACKOFF_SECONDS = float(os.getenv('IDLE_MAX_BACKOFF_SECONDS', '300'))
+# History import pipeline: parse worker processes and reports written per transaction
+HISTORY_PARSE_WORKERS = int(os.getenv('HISTORY_PARSE_WORKERS', str(os.cpu_count() or 2)))
+WRITE_BATCH_SIZE = int(os.getenv('WRITE_BATCH_SIZE', '25'))
+# spawn starts parse workers as fresh interpreters: safe next to the IMAP fetch thread on every OS
+HISTORY_PARSE_START_METHOD = os.getenv('HISTORY_PARSE_START_METHOD', 'spawn')
+
 class ReportEntry(Base):
     __tablename__ = 'report_entries'
     id = Column(Integer, primary_key=True, index=True)
@@ -31,9 +59,62 @@ class ReportEntry(Base):
     category = Column(String, index=True, nullable=False)
     description = Column(String, nullable=False)
     today_value = Column(Float, nullable=True) # Allow nulls
+    metric_id = Column(Integer, ForeignKey('metrics.id'), nullable=True) # Set at ingest; backfilled by upgrade_schema
 
     # Add unique constraint if it wasn't there before
-    __table_args__ = (UniqueConstraint('date', 'category', 'description', name='_date_category_desc_uc'),)
+    __table_args__ = (
+        UniqueConstraint('date', 'category', 'description', name='_date_category_desc_uc'),
+        # Covering index for "sum metric X over a date range": the API never touches the table rows
+        Index('ix_report_entries_metric_id_date', 'metric_id', 'date', 'today_value'),
+    )
+
+# Indexes replaced by newer ones; upgrade_schema drops them from existing databases
+OBSOLETE_INDEXES = ['ix_report_entries_metric_date']
+# The ON CONFLICT target of every write; databases created before the constraint get a unique index
+UNIQUE_ENTRY_COLUMNS = ('date', 'category', 'description')
+
+# --- NEW: Metric model (one row per raw category/description, see report_metrics) ---
+class Metric(Base):
+    __tablename__ = 'metrics'
+    id = Column(Integer, primary_key=True)
+    category = Column(String, nullable=False)
+    description = Column(String, nullable=False)
+    key = Column(String, index=True, nullable=True)  # Canonical metric key, None if unmapped
+    __table_args__ = (UniqueConstraint('category', 'description', name='_metric_category_desc_uc'),)
+
+# --- NEW: DailyMetrics model (wide: one row per report date, one column per canonical metric key) ---
+class DailyMetrics(Base):
+    __tablename__ = 'daily_metrics'
+    id = Column(Integer, primary_key=True)
+    date = Column(Date, nullable=False)
+    # Sum of today_value over the day's rows with that key; None when the report had no such row
+    turnover = Column(Float, nullable=True)
+    cost_of_sales = Column(Float, nullable=True)
+    purchases = Column(Float, nullable=True)
+    adjustments = Column(Float, nullable=True)
+    opening_stock = Column(Float, nullable=True)
+    closing_stock = Column(Float, nullable=True)
+    dispensary_turnover = Column(Float, nullable=True)
+    scripts_total = Column(Float, nullable=True)
+    pos_transactions = Column(Float, nullable=True)
+    avg_basket_value = Column(Float, nullable=True)
+    avg_basket_size = Column(Float, nullable=True)
+    __table_args__ = (UniqueConstraint('date', name='_daily_metrics_date_uc'),)
+
+# --- NEW: MonthlyMetrics model (rollup of daily_metrics per month and metric key) ---
+class MonthlyMetrics(Base):
+    __tablename__ = 'monthly_metrics'
+    id = Column(Integer, primary_key=True)
+    month = Column(String, nullable=False)  # Format: 'YYYY-MM'
+    key = Column(String, nullable=False)  # Canonical metric key
+    total = Column(Float, nullable=True)
+    average = Column(Float, nullable=True)  # Mean of the daily values
+    days = Column(Integer, nullable=False)  # Days in the month with a value
+    first_date = Column(Date, nullable=True)
+    first_value = Column(Float, nullable=True)
+    last_date = Column(Date, nullable=True)
+    last_value = Column(Float, nullable=True)
+    __table_args__ = (UniqueConstraint('month', 'key', name='_monthly_metrics_month_key_uc'),)
 
 # --- NEW: MonthlyClosingStock model ---
 class MonthlyClosingStock(Base):
@@ -44,292 +125,634 @@ class MonthlyClosingStock(Base):
     source_date = Column(Date, nullable=False)  # The date this value was taken from
     __table_args__ = (UniqueConstraint('month', name='_month_uc'),)
 
-# Create tables
-Base.metadata.create_all(bind=engine)
+# --- NEW: SyncState model (per-folder IMAP checkpoint) ---
+class SyncState(Base):
+    __tablename__ = 'sync_state'
+    id = Column(Integer, primary_key=True)
+    folder = Column(String, nullable=False)
+    uidvalidity = Column(Integer, nullable=False)
+    last_uid = Column(Integer, nullable=False, default=0)  # Highest UID already processed
+    updated_at = Column(DateTime, nullable=True)
+    __table_args__ = (UniqueConstraint('folder', name='_sync_folder_uc'),)
+
+# --- Data version: one row per commit that changed report data (see response_cache) ---
+class DataVersion(Base):
+    __tablename__ = 'data_versions'
+    version = Column(Integer, primary_key=True)
+    first_date = Column(Date, nullable=False)  # Earliest report date the commit changed
+    committed_at = Column(DateTime, nullable=True)
+
+
+def record_data_change(session, first_date):
+    """Bumps the pharmacy's data version, in the caller's transaction. Cached responses whose
+    range ends on or after first_date are stale from then on."""
+    session.execute(DataVersion.__table__.insert().values(first_date=first_date, committed_at=datetime.datetime.now()))
+
+def sync_metrics(conn) -> Tuple[int, int]:
+    """Adds a metrics row for every raw (category, description) in report_entries, re-applies
+    the alias rules to all metrics, and fills report_entries.metric_id where it is missing.
+    Returns (report_entries rows linked, metrics whose key changed)."""
+    metrics, entries = Metric.__table__, ReportEntry.__table__
+    conn.execute(metrics.insert().from_select(
+        ['category', 'description'],
+        select(entries.c.category, entries.c.description).distinct().where(
+            ~select(metrics.c.id).where(
+                metrics.c.category == entries.c.category, metrics.c.description == entries.c.description
+            ).exists()
+        )
+    ))
+    rekeyed = 0
+    for metric_id, category, description, key in conn.execute(
+            select(metrics.c.id, metrics.c.category, metrics.c.description, metrics.c.key)).all():
+        canonical = canonical_metric_key(category, description)
+        if canonical != key:
+            conn.execute(metrics.update().where(metrics.c.id == metric_id).values(key=canonical))
+            rekeyed += 1
+    linked = conn.execute(entries.update().where(entries.c.metric_id.is_(None)).values(
+        metric_id=select(metrics.c.id).where(
+            metrics.c.category == entries.c.category, metrics.c.description == entries.c.description
+        ).scalar_subquery()
+    )).rowcount
+    return linked, rekeyed
+
+
+def refresh_daily_metrics(conn, dates) -> int:
+    """Recomputes the daily_metrics rows for dates from report_entries (one grouped query per
+    500 dates) and upserts them; dates left with no entries lose their row. Works on a
+    Session or a Connection, inside the caller's transaction. Returns the number of dates."""
+    entries, metrics, daily = ReportEntry.__table__, Metric.__table__, DailyMetrics.__table__
+    dates = sorted(set(dates))
+    dialect = (conn.get_bind() if isinstance(conn, Session) else conn).dialect.name
+    insert = postgresql_insert if dialect == 'postgresql' else sqlite_insert
+    for i in range(0, len(dates), 500):
+        chunk = dates[i:i + 500]
+        wide = {}
+        for day, key, value in conn.execute(
+            select(entries.c.date, metrics.c.key, func.sum(entries.c.today_value))
+            .join(metrics, entries.c.metric_id == metrics.c.id)
+            .where(entries.c.date.in_(chunk), metrics.c.key.is_not(None))
+            .group_by(entries.c.date, metrics.c.key)
+        ):
+            wide.setdefault(day, dict.fromkeys(METRIC_KEYS))[key] = value
+        present = set(conn.execute(select(entries.c.date).where(entries.c.date.in_(chunk)).distinct()).scalars())
+        for day in present:
+            wide.setdefault(day, dict.fromkeys(METRIC_KEYS)) # Report without any mapped metric
+        gone = [day for day in chunk if day not in present]
+        if gone:
+            conn.execute(daily.delete().where(daily.c.date.in_(gone)))
+        if wide:
+            stmt = insert(daily)
+            conn.execute(
+                stmt.on_conflict_do_update(index_elements=['date'], set_={k: stmt.excluded[k] for k in METRIC_KEYS}),
+                [{'date': day, **values} for day, values in wide.items()]
+            )
+    return len(dates)
+
+
+def refresh_monthly_metrics(conn, dates) -> int:
+    """Rebuilds the monthly_metrics rows of every month that contains one of dates, from that
+    month's daily_metrics rows. Works on a Session or a Connection inside the caller's
+    transaction. Returns the number of months."""
+    daily, monthly = DailyMetrics.__table__, MonthlyMetrics.__table__
+    months = sorted({(d.year, d.month) for d in dates})
+    for year, month in months:
+        start = datetime.date(year, month, 1)
+        end = (start + datetime.timedelta(days=32)).replace(day=1)
+        rows = conn.execute(
+            select(daily).where(daily.c.date >= start, daily.c.date < end).order_by(daily.c.date)
+        ).mappings().all()
+        month_str = start.strftime('%Y-%m')
+        values = []
+        for key in METRIC_KEYS:
+            points = [(row['date'], row[key]) for row in rows if row[key] is not None]
+            if not points:
+                continue
+            total = sum(value for _, value in points)
+            values.append({
+                'month': month_str, 'key': key, 'total': total, 'average': total / len(points),
+                'days': len(points), 'first_date': points[0][0], 'first_value': points[0][1],
+                'last_date': points[-1][0], 'last_value': points[-1][1],
+            })
+        conn.execute(monthly.delete().where(monthly.c.month == month_str))
+        if values:
+            conn.execute(monthly.insert(), values)
+    return len(months)
+
+
+def upgrade_schema(bind):
+    """Idempotent startup upgrade: creates missing tables, and the columns and indexes added to
+    existing tables since (create_all skips those), drops OBSOLETE_INDEXES, adds the unique index
+    the upserts need if the table predates _date_category_desc_uc (removing duplicate rows
+    first), links rows to their metrics, then refreshes the planner statistics."""
+    Base.metadata.create_all(bind=bind)
+    changes = []
+    table = ReportEntry.__table__
+    inspector = inspect(bind)
+    columns = {col['name'] for col in inspector.get_columns(table.name)}
+    existing = {ix['name'] for ix in inspector.get_indexes(table.name)}
+    unique_sets = [set(uc['column_names']) for uc in inspector.get_unique_constraints(table.name)]
+    unique_sets += [set(ix['column_names']) for ix in inspector.get_indexes(table.name) if ix.get('unique')]
+    with bind.begin() as conn:
+        for column in table.columns:
+            if column.name not in columns:
+                column_type = column.type.compile(dialect=bind.dialect)
+                references = ''.join(f" REFERENCES {fk.column.table.name} ({fk.column.name})" for fk in column.foreign_keys)
+                conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}{references}"))
+                changes.append(f"column {column.name}")
+        for name in OBSOLETE_INDEXES:
+            if name in existing:
+                conn.execute(text(f"DROP INDEX {name}"))
+                changes.append(f"dropped {name}")
+        deduplicated = []
+        if set(UNIQUE_ENTRY_COLUMNS) not in unique_sets:
+            # Keep the first row stored for each key, as ON CONFLICT DO NOTHING would have
+            keep = select(func.min(table.c.id)).group_by(*[table.c[c] for c in UNIQUE_ENTRY_COLUMNS])
+            deduplicated = conn.execute(select(table.c.date).distinct().where(table.c.id.not_in(keep))).scalars().all()
+            removed = conn.execute(table.delete().where(table.c.id.not_in(keep))).rowcount
+            conn.execute(text(f"CREATE UNIQUE INDEX IF NOT EXISTS _date_category_desc_uc ON {table.name} ({', '.join(UNIQUE_ENTRY_COLUMNS)})"))
+            changes.append(f"unique index _date_category_desc_uc ({removed} duplicate rows removed)")
+        linked, rekeyed = sync_metrics(conn)
+        if linked:
+            changes.append(f"linked {linked} rows to metrics")
+        daily, entries = DailyMetrics.__table__, table
+        if linked or rekeyed:
+            stale = select(entries.c.date).distinct() # Metric mapping changed: rebuild every day
+        else:
+            stale = select(entries.c.date).distinct().where(~entries.c.date.in_(select(daily.c.date)))
+        stale_dates = sorted(set(conn.execute(stale).scalars().all()) | set(deduplicated))
+        refreshed = refresh_daily_metrics(conn, stale_dates)
+        if refreshed:
+            changes.append(f"rebuilt daily_metrics for {refreshed} days")
+        # Months touched above, plus any month of daily_metrics the rollup has never seen
+        rolled_up = set(conn.execute(select(MonthlyMetrics.__table__.c.month).distinct()).scalars())
+        stale_dates += [day for day in conn.execute(select(daily.c.date)).scalars()
+                        if day.strftime('%Y-%m') not in rolled_up]
+        rolled = refresh_monthly_metrics(conn, stale_dates)
+        if rolled:
+            changes.append(f"rolled up {rolled} months")
+        if refreshed or rolled:
+            record_data_change(conn, min(stale_dates))
+    for index in table.indexes:
+        if index.name not in existing:
+            index.create(bind=bind, checkfirst=True)
+            changes.append(index.name)
+    if bind.dialect.name == 'sqlite':
+        with bind.begin() as conn:
+            # Full ANALYZE after a structural change; otherwise the cheap incremental variant
+            conn.execute(text("ANALYZE" if changes else "PRAGMA optimize"))
+    if changes:
+        print(f"Schema upgrade on {bind.url.database}: {', '.join(changes)}; ran ANALYZE.")
+
+# Create tables (not in history parse workers, which re-import this module under spawn)
+if multiprocessing.parent_process() is None:
+    upgrade_schema(engine)
+# ...and in every pharmacy database, once per engine (picks up newer tables like sync_state)
+pharmacy_registry.on_engine_created(upgrade_schema)
+
+def _entry_value(value_input) -> Optional[float]:
+    """Float for a pre-parsed number, parse_value for a string, None otherwise."""
+    if isinstance(value_input, (float, int)):
+        return float(value_input) # Use pre-parsed float/int
+    if isinstance(value_input, str):
+        return parse_value(value_input) # Parse if it's a string
+    return None # Handled by DB nullability
+
+
+def _upsert_statement(session, on_conflict='nothing'):
+    """INSERT INTO report_entries ... ON CONFLICT(date, category, description) DO NOTHING / DO UPDATE."""
+    dialect = session.get_bind().dialect.name
+    insert = postgresql_insert if dialect == 'postgresql' else sqlite_insert
+    table = ReportEntry.__table__ # Core table, so the result carries a rowcount
+    stmt = insert(table)
+    conflict_cols = ['date', 'category', 'description'] # _date_category_desc_uc
+    if on_conflict == 'update':
+        return stmt.on_conflict_do_update(
+            index_elements=conflict_cols,
+            set_={'today_value': stmt.excluded.today_value},
+            # Only count (and write) rows whose value actually changed
+            where=table.c.today_value.is_distinct_from(stmt.excluded.today_value)
+        )
+    return stmt.on_conflict_do_nothing(index_elements=conflict_cols)
+
+
+def resolve_metric_ids(session, pairs) -> Dict[Tuple[str, str], int]:
+    """metrics.id for each (category, description), inserting (with its canonical key) any pair
+    seen for the first time. The metrics table is small, so it is read whole."""
+    known = {(c, d): i for i, c, d in session.query(Metric.id, Metric.category, Metric.description)}
+    missing = [pair for pair in dict.fromkeys(pairs) if pair not in known]
+    if missing:
+        dialect = session.get_bind().dialect.name
+        insert = postgresql_insert if dialect == 'postgresql' else sqlite_insert
+        session.execute(
+            insert(Metric.__table__).on_conflict_do_nothing(index_elements=['category', 'description']),
+            [{'category': c, 'description': d, 'key': canonical_metric_key(c, d)} for c, d in missing]
+        )
+        known = {(c, d): i for i, c, d in session.query(Metric.id, Metric.category, Metric.description)}
+    return known
+
+
+def metric_ids(session, *keys) -> Dict[int, str]:
+    """{metrics.id: key} for the given canonical metric keys (several raw rows may share a key)."""
+    return dict(session.query(Metric.id, Metric.key).filter(Metric.key.in_(keys)).all())
+
+
+def metric_filter(session, *keys, entries=ReportEntry):
+    """WHERE clause for the report_entries rows of the given canonical metric keys: metric_id IN
+    (literal ids), which SQLite serves as a covering range scan of ix_report_entries_metric_id_date
+    (with a subquery it tends to prefer the date index for GROUP BY date). Pass entries to filter
+    a tiered_entries alias instead of the hot table."""
+    return entries.metric_id.in_(list(metric_ids(session, *keys)))
+
+
+AGGREGATES = {'sum': func.sum, 'avg': func.avg}
+
+
+def metric_aggregates_query(session, start, end, specs, entries=ReportEntry):
+    """One-row query with every aggregate in specs over [start, end], in one pass over the
+    covering index: a SUM/AVG(CASE WHEN metric_id IN (<key's ids>) THEN today_value END) column
+    per spec. The id lists are uncorrelated subqueries on metrics, which SQLite evaluates once.
+    specs is {name: (metric key, 'sum' or 'avg')}, optionally with a (period_start, period_end)
+    sub-range of [start, end] as a third item. entries may be a tiered_entries alias."""
+    ids = lambda *keys: select(Metric.id).where(Metric.key.in_(keys)).scalar_subquery()
+    columns = []
+    for name, (key, agg, *period) in specs.items():
+        condition = entries.metric_id.in_(ids(key))
+        if period:
+            condition = and_(condition, entries.date >= period[0][0], entries.date <= period[0][1])
+        columns.append(AGGREGATES[agg](case((condition, entries.today_value))).label(name))
+    return session.query(*columns).filter(
+        entries.metric_id.in_(ids(*{spec[0] for spec in specs.values()})),
+        entries.date >= start,
+        entries.date <= end
+    )
+
+
+def metric_aggregates(session, start, end, specs, entries=ReportEntry) -> Dict[str, Optional[float]]:
+    """{name: value} for metric_aggregates_query (one statement); None where no row matched."""
+    return dict(metric_aggregates_query(session, start, end, specs, entries).one()._mapping)
+
+
+def bulk_save_entries(entries: List[Dict], report_date: datetime.date, session, on_conflict='nothing', commit=True) -> Dict[str, int]:
+    """Writes a whole report in one executemany INSERT ... ON CONFLICT and one transaction.
+    on_conflict='nothing' keeps existing rows, 'update' overwrites changed values.
+    With commit=False the caller owns the transaction (e.g. to write several reports at once).
+    Returns {'inserted': n, 'updated': n, 'skipped': n}. Raises on database errors (after rollback).
+    """
+    rows = {}
+    for entry_data in entries:
+        category, description = entry_data.get('category'), entry_data.get('description')
+        if not category or not description:
+            continue
+        key = (category, description)
+        if key in rows and on_conflict != 'update':
+            continue # First occurrence wins, like the row-by-row path did
+        rows[key] = {
+            'date': report_date,
+            'category': category,
+            'description': description,
+            'today_value': _entry_value(entry_data.get('today_value'))
+        }
+    if not rows:
+        return {'inserted': 0, 'updated': 0, 'skipped': 0}
 
-def parse_value(val_str: Optional[str]) -> Optional[float]:
-    """Convert string with currency, commas, and percent signs to float."""
-    if val_str is None: return None
-    s = val_str.replace('R', '').replace(',', '').replace('%', '').strip()
-    # Handle potential negative sign placement
-    if s.startswith('-') and s.count('-') > 1: s = '-' + s.replace('-', '', 1)
-    elif s.count('-') > 0 and not s.startswith('-'): s = s.replace('-', '')
     try:
-        return float(s) if s else 0.0
-    except ValueError:
-        print(f"Warning: Could not parse value '{val_str}'")
-        return None
+        metric_ids = resolve_metric_ids(session, rows)
+        for key, row in rows.items():
+            row['metric_id'] = metric_ids[key]
+        existing = 0
+        if on_conflict == 'update':
+            existing = sum(
+                1 for key in session.query(ReportEntry.category, ReportEntry.description)
+                .filter(ReportEntry.date == report_date) if tuple(key) in rows
+            )
+        changed = session.execute(_upsert_statement(session, on_conflict), list(rows.values())).rowcount
+        if changed:
+            # Same transaction as the entries: the day's wide row, then its month's rollup
+            refresh_daily_metrics(session, [report_date])
+            refresh_monthly_metrics(session, [report_date])
+            record_data_change(session, report_date)
+        if commit:
+            session.commit()
+    except Exception:
+        session.rollback()
+        raise
+
+    if on_conflict == 'update':
+        inserted = len(rows) - existing
+        updated = changed - inserted
+    else:
+        inserted, updated = changed, 0
+    return {'inserted': inserted, 'updated': updated, 'skipped': len(rows) - inserted - updated}
 
-def clean_int_value(value_str: Optional[str]) -> Optional[int]:
-    """Removes commas, spaces and converts to int. Returns None if conversion fails."""
-    if not value_str: return 0
-    cleaned = value_str.replace(',', '').replace(' ', '')
-    try:
-        return int(cleaned) if cleaned else 0
-    except ValueError:
-        print(f"Warning: Could not convert '{value_str}' to int.")
-        return None
 
-def save_entries(entries: List[Dict], report_date: datetime.date, session=None): # Added optional session
+def save_entries(entries: List[Dict], report_date: datetime.date, session=None, on_conflict='nothing', raise_errors=False): # Added optional session
     """Saves a list of extracted report entries for a specific date to the database.
-    Optionally uses a provided session.
-    Returns True if new entries were committed, False otherwise.
+    Optionally uses a provided session. Duplicates are skipped (or overwritten with on_conflict='update').
+    Returns True if new entries were committed, False otherwise. With raise_errors=True a failed
+    write is re-raised (after the rollback) instead of also returning False.
     """
     close_session_locally = False
     if session is None:
         session = SessionLocal()
         close_session_locally = True
 
-    added_count = 0
-    skipped_count = 0
     committed = False # Flag to track if commit happened
     try:
-        # Optional: Delete existing entries for this date if you want to overwrite
-        # session.query(ReportEntry).filter(ReportEntry.date == report_date).delete()
-        # session.commit() # Commit deletion before adding new ones
-
-        for entry_data in entries:
-            # --- Robust Value Parsing --- 
-            value_input = entry_data.get('today_value')
-            value = None
-            if isinstance(value_input, (float, int)):
-                value = float(value_input) # Use pre-parsed float/int
-            elif isinstance(value_input, str):
-                value = parse_value(value_input) # Parse if it's a string
-            # If value_input is None or other type, value remains None (handled by DB nullability)
-            # --- End Robust Value Parsing ---
-
-            entry = ReportEntry(
-                date=report_date,
-                category=entry_data.get('category'),
-                description=entry_data.get('description'),
-                today_value=value
-            )
-
-            # Simplified check: Use DB constraints to handle uniqueness
-            # Attempt to add; let the DB handle potential duplicates if constraint exists
-            # This assumes the UniqueConstraint _date_category_desc_uc is working
-            session.add(entry)
-            try:
-                 session.flush() # Try to flush to catch potential constraint violations early
-                 added_count += 1
-            except IntegrityError:
-                 session.rollback() # Rollback the failed add
-                 skipped_count += 1
-                 # print(f"Skipped duplicate entry: {report_date} - {entry.category} - {entry.description}") # Optional: more verbose logging
-                 # Re-query to ensure no partial state? Or just continue.
-            except Exception as e:
-                 print(f"Error during flush for {entry.description}: {e}")
-                 session.rollback()
-                 # Decide how to handle other flush errors
-
-        if added_count > 0:
-            session.commit()
-            committed = True # Mark as committed
-            print(f"Committed {added_count} new entries for {report_date}.")
-        if skipped_count > 0:
-             print(f"Skipped {skipped_count} duplicate entries for {report_date}.")
-
+        counts = bulk_save_entries(entries, report_date, session, on_conflict)
+        committed = counts['inserted'] + counts['updated'] > 0
+        if counts['inserted']:
+            print(f"Committed {counts['inserted']} new entries for {report_date}.")
+        if counts['updated']:
+            print(f"Updated {counts['updated']} entries for {report_date}.")
+        if counts['skipped']:
+            print(f"Skipped {counts['skipped']} duplicate entries for {report_date}.")
     except Exception as e:
         print(f"Error saving entries for {report_date}: {e}")
-        session.rollback()
+        if raise_errors:
+            raise
     finally:
         if close_session_locally:
             session.close()
     return committed # Return commit status
 
 
-def find_table_by_title(soup, title_keyword):
-    """Finds table by checking if title_keyword is in the first td of the first tr."""
-    for table in soup.find_all('table'):
-        first_row = table.find('tr')
-        if first_row:
-             first_td = first_row.find('td')
-             if first_td and title_keyword.lower() in first_td.get_text(strip=True).lower():
-                 return table
-    return None
+def fetch_in_batches(client, uids, data_items, batch_size=None):
+    """Fetches uids in chunks of batch_size (one FETCH per chunk) and yields (uid, data) pairs.
+    Results are handed to the caller chunk by chunk, so parsing starts before the whole range is downloaded.
+    """
+    batch_size = batch_size or FETCH_BATCH_SIZE
+    uids = list(uids)
+    for i in range(0, len(uids), batch_size):
+        chunk = uids[i:i + batch_size]
+        print(f"Fetching UIDs {chunk[0]}..{chunk[-1]} ({len(chunk)} messages)...")
+        response = client.fetch(chunk, data_items)
+        for uid in chunk:
+            data = response.pop(uid, None)
+            if data is None:
+                print(f"Could not fetch UID {uid}. Skipping.")
+                continue
+            yield uid, data
 
 
-def parse_table(table):
-    """Parses a standard table structure (header on row 2, data from row 3)."""
-    rows_data = []
-    trs = table.find_all('tr')
-    if len(trs) < 2: return rows_data # Need at least title and header row
-
-    # Try to find the header row dynamically ('Description', 'Today', 'This Month')
-    header_row_index = -1
-    potential_header_row = -1
-    for i, tr in enumerate(trs):
-        tds = tr.find_all('td')
-        if len(tds) == 3: # Standard tables have 3 columns
-            # Check if this looks like the header
-            texts = [td.get_text(strip=True) for td in tds]
-            if 'Description' in texts[0] and 'Today' in texts[1] and 'This Month' in texts[2]:
-                header_row_index = i
-                break
-            elif i > 0 and potential_header_row == -1: # Guess header is row index 1 if not found explicitly
-                 potential_header_row = i # Usually the second row (index 1)
-
-    if header_row_index == -1:
-         header_row_index = potential_header_row # Use the guess if specific header not found
-         if header_row_index == -1 or header_row_index >= len(trs)-1:
-              print("Warning: Could not determine header row reliably for a table.")
-              return rows_data # Cannot proceed without headers
-
-    header_cells = [cell.get_text(strip=True) for cell in trs[header_row_index].find_all('td')]
-    if len(header_cells) != 3: # Ensure it has 3 header columns
-         print(f"Warning: Unexpected number of header cells ({len(header_cells)}) found.")
-         return rows_data
-
-    # Data rows start after the header row
-    for tr in trs[header_row_index + 1:]:
-        cells = tr.find_all('td')
-        # Allow for slight variations, but expect 3 columns for data
-        if len(cells) >= 3: # Check if at least 3 cells exist
-            # Map based on found header cells
-            row_dict = {}
-            row_dict[header_cells[0]] = cells[0].get_text(strip=True) # Description
-            row_dict[header_cells[1]] = cells[1].get_text(strip=True) # Today
-            row_dict[header_cells[2]] = cells[2].get_text(strip=True) # This Month
-            rows_data.append(row_dict)
-        elif len(cells) > 0 and cells[0].get_text(strip=True): # Handle rows that might just have a description (like totals)
-            # Append with empty values if needed, or skip based on use case
-            # print(f"Info: Skipping row with insufficient cells: {[c.get_text(strip=True) for c in cells]}")
-            pass
-
-    return rows_data
-
-def extract_report_data(soup) -> List[Dict]: # Return list of dictionaries
-    """Extracts data from standard tables AND the specific Sales Summary data."""
-    selected_titles = ["STOCK TRADING ACCOUNT", "DISPENSARY SUMMARY", "TURNOVER SUMMARY", "SALES SUMMARY"]
-    all_entries = []
-
-    for title in selected_titles:
-        table = find_table_by_title(soup, title)
-        if not table:
-            print(f"Warning: Table '{title}' not found in email.")
-            continue
+@dataclass(frozen=True)
+class PharmacyConfig:
+    """Mailbox credentials for one pharmacy, read from its .env file without touching os.environ."""
+    name: str
+    gmail_username: Optional[str]
+    gmail_app_password: Optional[str] = field(repr=False)
+    report_sender: Optional[str]
+    report_subject: Optional[str]
 
-        print(f"Processing table: {title}")
-        if title == "SALES SUMMARY":
-            pos_transactions_today = 0
-            rows = table.find_all('tr')
-            found_pos_row = False
-            found_avg_value_row = False # Flag for avg value
-            found_avg_size_row = False  # Flag for avg size
-            for row in rows:
-                cells = row.find_all('td')
-                # Check POS Transactions
-                if len(cells) >= 2 and not found_pos_row:
-                    first_cell_text = cells[0].get_text(strip=True)
-                    if "TOTAL POS TURNOVER:" in first_cell_text:
-                        try:
-                            trans_text = cells[1].get_text(strip=True)
-                            pos_transactions_today = clean_int_value(trans_text) or 0
-                            print(f"  Extracted: POS Transactions = {pos_transactions_today}")
-                            all_entries.append({
-                                "category": title, 
-                                "description": "POS Transactions",
-                                "today_value": float(pos_transactions_today)
-                            })
-                            found_pos_row = True # Mark as found
-                            # Don't break yet, continue checking for other rows
-                        except Exception as e:
-                            print(f"Error parsing POS Transactions row: {e}")
-                            
-                # NEW: Check Average Value Per Docket/Basket
-                if len(cells) >= 2 and not found_avg_value_row:
-                    first_cell_text = cells[0].get_text(strip=True)
-                    if "Average Value Per Docket/Basket" in first_cell_text: # Use exact string from report
-                        try:
-                            avg_val_text = cells[1].get_text(strip=True) 
-                            avg_value_today = parse_value(avg_val_text) # Use parse_value for currency/float
-                            print(f"  Extracted: Average Value Per Docket/Basket = {avg_value_today}")
-                            all_entries.append({
-                                "category": title,
-                                "description": "Average Value Per Docket/Basket", 
-                                "today_value": avg_value_today
-                            })
-                            found_avg_value_row = True # Mark as found
-                        except Exception as e:
-                            print(f"Error parsing Average Value row: {e}")
-
-                # NEW: Check Average Number Of Items per Basket
-                if len(cells) >= 2 and not found_avg_size_row:
-                     first_cell_text = cells[0].get_text(strip=True)
-                     if "Average Number Of Items per Basket" in first_cell_text: # Use exact string
-                         try:
-                             avg_size_text = cells[1].get_text(strip=True)
-                             avg_size_today = parse_value(avg_size_text) # Use parse_value as it might be float
-                             print(f"  Extracted: Average Number Of Items per Basket = {avg_size_today}")
-                             all_entries.append({
-                                 "category": title,
-                                 "description": "Average Number Of Items per Basket",
-                                 "today_value": avg_size_today
-                             })
-                             found_avg_size_row = True # Mark as found
-                         except Exception as e:
-                             print(f"Error parsing Average Size row: {e}")
-            
-            # Check if all expected rows were found
-            if not found_pos_row:
-                 print(f"Warning: 'TOTAL POS TURNOVER:' row not found in SALES SUMMARY table.")
-            if not found_avg_value_row:
-                 print(f"Warning: 'Average Value Per Docket/Basket' row not found in SALES SUMMARY table.")
-            if not found_avg_size_row:
-                 print(f"Warning: 'Average Number Of Items per Basket' row not found in SALES SUMMARY table.")
-
-        else: # Handle standard tables
-            parsed_rows = parse_table(table)
-            for row in parsed_rows:
-                # Ensure keys exist before accessing
-                desc = row.get('Description')
-                today_val_str = row.get('Today')
-                if desc: # Only add if description exists
-                     all_entries.append({
-                         "category": title,
-                         "description": desc,
-                         "today_value": today_val_str # Keep as string for save_entries to parse
-                     })
-    return all_entries
-
-
-def load_pharmacy_env(pharmacy):
-    env_map = {
-        'reitz': '.env.reitz',
-        'villiers': '.env.villiers',
-        'roos': '.env.roos',
-        'tugela': '.env.tugela',
-        'winterton': '.env.winterton',
-    }
-    env_file = env_map.get(pharmacy, '.env.reitz')
-    print(f"Loading env file: {env_file} for pharmacy: {pharmacy}")  # DEBUG PRINT
-    load_dotenv(env_file, override=True)
+    def is_complete(self) -> bool:
+        return all([self.gmail_username, self.gmail_app_password, self.report_sender, self.report_subject])
+
+
+def load_pharmacy_config(pharmacy) -> PharmacyConfig:
+    """Loads .env.<pharmacy> into a PharmacyConfig. Values missing from the file fall back to the process environment."""
+    env_file = PHARMACY_ENV_FILES.get(pharmacy, '.env.reitz')
+    print(f"Loading env file: {env_file} for pharmacy: {pharmacy}")
+    values = dotenv_values(os.path.join(BASE_DIR, env_file))
+
+    def get(key):
+        return values.get(key) or os.getenv(key)
+
+    return PharmacyConfig(
+        name=pharmacy,
+        gmail_username=get('GMAIL_USERNAME'),
+        gmail_app_password=get('GMAIL_APP_PASSWORD'),
+        report_sender=get('REPORT_SENDER'),
+        report_subject=get('REPORT_SUBJECT'),
+    )
 
 
 def get_pharmacy_session(pharmacy):
-    db_map = {
-        'reitz': '/data/reports.db',
-        'villiers': '/data/reports_villiers.db',
-        'roos': '/data/reports_roos.db',
-        'tugela': '/data/reports_tugela.db',
-        'winterton': '/data/reports_winterton.db',
+    """A session on the pharmacy's shared engine (see pharmacy_registry). The caller closes it."""
+    return pharmacy_registry.get_session(pharmacy)
+
+
+def report_date_from_headers(envelope, internal_date=None) -> Optional[datetime.date]:
+    """Report date from the envelope Date header, falling back to INTERNALDATE."""
+    if envelope and envelope.date:
+        return envelope.date.date() # Already a datetime object
+    if internal_date:
+        return internal_date.date()
+    return None
+
+
+def plan_report_fetch(client, uids, session, start_date, end_date, archive=None):
+    """Phase one of a sync: fetches only ENVELOPE/INTERNALDATE for uids and diffs the
+    report dates against the dates already stored (one query).
+    With an archive, dates stored in the DB but missing from the archive are fetched once more to fill it.
+    Returns [(uid, report_date, envelope)] for the messages whose bodies still need fetching.
+    """
+    candidates = []
+    for uid, data in fetch_in_batches(client, uids, ['ENVELOPE', 'INTERNALDATE']):
+        envelope = data.get(b'ENVELOPE')
+        report_date = report_date_from_headers(envelope, data.get(b'INTERNALDATE'))
+        if not report_date:
+            print(f"UID {uid}: Could not determine date. Skipping.")
+            continue
+        # Handles cases where IMAP SINCE/BEFORE might be slightly inexact
+        if report_date < start_date or report_date > end_date:
+            print(f"UID {uid}: Email date {report_date} outside target range ({start_date} to {end_date}). Skipping.")
+            continue
+        candidates.append((uid, report_date, envelope))
+
+    # daily_metrics has a row for every stored report, including years moved to cold files
+    stored_dates = {
+        row[0] for row in session.query(DailyMetrics.date).filter(
+            DailyMetrics.date >= start_date,
+            DailyMetrics.date <= end_date
+        )
     }
-    db_file = db_map.get(pharmacy, '/data/reports.db')
-    db_url = f"sqlite:///{db_file}"
-    engine = create_engine(db_url, echo=False, future=True)
-    return sessionmaker(bind=engine, autoflush=False, autocommit=False)()
-
-
-def fetch_latest_report(pharmacy='reitz'):
-    load_pharmacy_env(pharmacy)
-    user = os.getenv('GMAIL_USERNAME')
-    password = os.getenv('GMAIL_APP_PASSWORD')
-    sender = os.getenv('REPORT_SENDER')
-    subject = os.getenv('REPORT_SUBJECT')
-    if not all([user, password, sender, subject]):
-        print("Please set GMAIL_USERNAME, GMAIL_APP_PASSWORD, REPORT_SENDER, and REPORT_SUBJECT in .env file.")
-        return 0 # Return 0 days added
+    pending = [
+        c for c in candidates
+        if c[1] not in stored_dates or (archive is not None and not archive.has_date(c[1]))
+    ]
+    print(f"{len(candidates) - len(pending)} of {len(candidates)} reports already in DB. Fetching {len(pending)} bodies...")
+    return pending
+
+
+def ingest_report_message(uid, msg_data, subject_line, report_date, session, on_conflict='nothing') -> bool:
+    """Parses one raw report email and saves its entries. Returns True if entries were committed,
+    False if the email is not a report or its entries are already stored. Save errors propagate."""
+    print(f"UID {uid}: Extracting data for {report_date}...")
+    _, extracted_entries, skip_reason = parse_report_message(uid, msg_data, subject_line)
+    if not extracted_entries:
+        print(f"UID {uid}: Skipping email for {report_date}: {skip_reason}.")
+        return False
+
+    print(f"UID {uid}: Saving {len(extracted_entries)} entries for {report_date}...")
+    if save_entries(extracted_entries, report_date, session, on_conflict, raise_errors=True):
+        print(f"UID {uid}: Successfully saved entries for {report_date}.")
+        return True
+    print(f"UID {uid}: Entries for {report_date} were duplicates.")
+    return False
+
+
+def sync_report_bodies(client, pending, session, archive=None, failed_uids=None) -> set:
+    """Phase two of a sync: fetches BODY[] only for the pending (uid, report_date, envelope) list,
+    archiving each raw message when an archive is given. Returns the set of dates that were saved.
+    UIDs whose report could not be parsed or saved are added to failed_uids (if given).
+    """
+    saved_dates = set()
+    headers = {uid: (report_date, envelope) for uid, report_date, envelope in pending}
+    for uid, data in fetch_in_batches(client, list(headers), ['BODY[]']):
+        report_date, envelope = headers[uid]
+        subject_line = envelope.subject.decode(errors='replace') if envelope and envelope.subject else ""
+        if archive is not None:
+            try:
+                archive.put(uid, report_date, data[b'BODY[]'], subject_line)
+            except OSError as e:
+                print(f"UID {uid}: Could not archive message: {e}")
+        if report_date in saved_dates:
+            print(f"UID {uid}: Report for date {report_date} already saved in this run. Skipping.")
+            continue
+        try:
+            if ingest_report_message(uid, data[b'BODY[]'], subject_line, report_date, session):
+                saved_dates.add(report_date)
+        except Exception as e:
+            print(f"UID {uid}: An unexpected error occurred: {e}. Skipping this email.")
+            if failed_uids is not None:
+                failed_uids.add(uid)
+    return saved_dates
+
+
+def _write_report_batch(session, batch, saved_dates, failed_dates):
+    """Single-writer step of the history pipeline: one transaction for a batch of parsed reports.
+    If the batch fails it is retried one report per transaction, so one bad report (or a
+    transient "database is locked") costs only its own date, which is added to failed_dates."""
+    written = set()
+    try:
+        for uid, report_date, entries in batch:
+            if report_date in saved_dates or report_date in written:
+                continue # One report per date
+            counts = bulk_save_entries(entries, report_date, session, commit=False)
+            if counts['inserted']:
+                written.add(report_date)
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        print(f"Error writing batch of {len(batch)} reports: {e}. Retrying one report at a time.")
+        written = set()
+        for uid, report_date, entries in batch:
+            if report_date in saved_dates or report_date in written:
+                continue
+            try:
+                if bulk_save_entries(entries, report_date, session)['inserted']:
+                    written.add(report_date)
+            except Exception as e:
+                print(f"UID {uid}: Error writing report for {report_date}: {e}")
+                failed_dates.add(report_date)
+    saved_dates.update(written)
+    print(f"Wrote {len(written)} new reports ({len(saved_dates)} so far).")
+
+
+def import_reports_pipelined(client, pending, session, archive=None, workers=None, failed_dates=None) -> set:
+    """Pipelined phase two for large imports: one IMAP fetch thread feeds a bounded queue,
+    a process pool parses the emails, and this thread writes parsed reports in batches.
+    At most ~2x workers messages are in flight, so memory stays flat on multi-year backfills.
+    Returns the set of dates that were saved; dates whose report could not be parsed or
+    written are added to failed_dates (if given).
+    """
+    failed_dates = set() if failed_dates is None else failed_dates
+    workers = workers or HISTORY_PARSE_WORKERS
+    headers = {uid: (report_date, envelope) for uid, report_date, envelope in pending}
+    raw_queue = queue.Queue(maxsize=workers * 2)
+    fetch_error = []
+
+    def produce():
+        try:
+            for uid, data in fetch_in_batches(client, list(headers), ['BODY[]']):
+                report_date, envelope = headers[uid]
+                subject_line = envelope.subject.decode(errors='replace') if envelope and envelope.subject else ""
+                if archive is not None:
+                    try:
+                        archive.put(uid, report_date, data[b'BODY[]'], subject_line)
+                    except OSError as e:
+                        print(f"UID {uid}: Could not archive message: {e}")
+                raw_queue.put((uid, report_date, subject_line, data[b'BODY[]']))
+        except Exception as e:
+            fetch_error.append(e)
+        finally:
+            raw_queue.put(None) # Sentinel: no more messages
+
+    saved_dates = set()
+    batch = []
+
+    def collect(futures):
+        for future in futures:
+            report_date = in_flight.pop(future)
+            try:
+                uid, entries, skip_reason = future.result()
+            except Exception as e:
+                print(f"Error parsing report for {report_date}: {e}")
+                failed_dates.add(report_date)
+                continue
+            if not entries:
+                print(f"UID {uid}: Skipping email for {report_date}: {skip_reason}.")
+                continue
+            batch.append((uid, report_date, entries))
+        if len(batch) >= WRITE_BATCH_SIZE:
+            _write_report_batch(session, batch, saved_dates, failed_dates)
+            batch.clear()
+
+    in_flight = {}
+    context = multiprocessing.get_context(HISTORY_PARSE_START_METHOD)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        # Start every worker before the fetch thread exists, so none is forked from a threaded process
+        wait([pool.submit(os.getpid) for _ in range(workers)])
+        fetcher = threading.Thread(target=produce, name='imap-fetch', daemon=True)
+        fetcher.start()
+        while True:
+            item = raw_queue.get()
+            if item is None:
+                break
+            uid, report_date, subject_line, msg_data = item
+            in_flight[pool.submit(parse_report_message, uid, msg_data, subject_line)] = report_date
+            if len(in_flight) >= workers * 2:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done)
+        collect(list(in_flight))
+    if batch:
+        _write_report_batch(session, batch, saved_dates, failed_dates)
+    fetcher.join()
+    if fetch_error:
+        raise fetch_error[0]
+    return saved_dates
+
+
+def get_sync_checkpoint(session, folder, uidvalidity) -> Optional[int]:
+    """Returns the last processed UID for folder, or None if there is no usable checkpoint
+    (first sync, or the server reset UIDVALIDITY so the stored UIDs are meaningless)."""
+    state = session.query(SyncState).filter_by(folder=folder).first()
+    if state is None:
+        return None
+    if state.uidvalidity != uidvalidity:
+        print(f"UIDVALIDITY for {folder} changed ({state.uidvalidity} -> {uidvalidity}). Falling back to date-window scan.")
+        return None
+    return state.last_uid
+
+
+def save_sync_checkpoint(session, folder, uidvalidity, last_uid):
+    """Upserts the UID checkpoint for folder."""
+    state = session.query(SyncState).filter_by(folder=folder).first()
+    if state is None:
+        state = SyncState(folder=folder)
+        session.add(state)
+    state.uidvalidity = uidvalidity
+    state.last_uid = last_uid
+    state.updated_at = datetime.datetime.now()
+    session.commit()
+
+
+def sync_mailbox(client, config: PharmacyConfig, folder='INBOX') -> set:
+    """Incremental sync over an already logged-in client: selects folder, searches past the
+    UID checkpoint (or the last 14 days without one), ingests new reports and advances the
+    checkpoint. Returns the set of dates saved.
+    """
+    pharmacy = config.name
+    sender, subject = config.report_sender, config.report_subject
 
     # --- Calculate date range for the last 14 days --- 
     end_date = datetime.date.today()
@@ -337,133 +760,77 @@ def fetch_latest_report(pharmacy='reitz'):
     since_str = start_date.strftime('%d-%b-%Y')
     # Optional: Add a BEFORE clause for precision (day after end_date)
     # before_str = (end_date + datetime.timedelta(days=1)).strftime('%d-%b-%Y')
-    print(f"Searching for emails since: {since_str}")
     # --- End date range calculation ---
 
-    saved_dates = set() # Keep track of dates with successful saves
+    folder_info = client.select_folder(folder)
+    uidvalidity = folder_info.get(b'UIDVALIDITY')
+    uidnext = folder_info.get(b'UIDNEXT')
 
-    with IMAPClient(host='imap.gmail.com', ssl=True) as client:
-        print(f"Logging in as {user}...")
-        client.login(user, password)
-        client.select_folder('INBOX') # Or specify a different folder/label if needed
-
-        # Search based on FROM, SUBJECT, and SINCE date
-        criteria = [
-            # 'UNSEEN', # REMOVED UNSEEN flag
-            'FROM', sender,
-            'SUBJECT', subject,
-            'SINCE', since_str, # Add SINCE criterion
-            # Optional: 'BEFORE', before_str 
-        ]
+    session = get_pharmacy_session(pharmacy) # Create session outside the loop
+    try:
+        last_uid = get_sync_checkpoint(session, folder, uidvalidity)
+        if last_uid is not None:
+            # Incremental: only mail that arrived after the checkpoint, whatever its report date
+            criteria = ['FROM', sender, 'SUBJECT', subject, 'UID', f'{last_uid + 1}:*']
+            start_date, end_date = datetime.date.min, datetime.date.max
+        else:
+            # Search based on FROM, SUBJECT, and SINCE date
+            criteria = [
+                # 'UNSEEN', # REMOVED UNSEEN flag
+                'FROM', sender,
+                'SUBJECT', subject,
+                'SINCE', since_str, # Add SINCE criterion
+                # Optional: 'BEFORE', before_str 
+            ]
         print(f"Searching for emails with criteria: {criteria}...")
-        uids = client.search(criteria)
-        if not uids:
-            print(f"No emails found for subject '{subject}' from '{sender}' since {since_str}.")
-            return 0 # Return 0 days added
+        # 'n:*' always matches the highest UID, even when it is below n
+        uids = [uid for uid in client.search(criteria) if last_uid is None or uid > last_uid]
+
+        saved_dates, failed_uids = set(), set()
+        if uids:
+            print(f"Found {len(uids)} new emails. Processing...")
+            archive = open_report_archive(pharmacy)
+            pending = plan_report_fetch(client, uids, session, start_date, end_date, archive)
+            saved_dates = sync_report_bodies(client, pending, session, archive, failed_uids)
+        else:
+            print(f"No new emails found for subject '{subject}' from '{sender}'.")
+
+        # Everything below UIDNEXT (as of SELECT) has now been searched
+        checkpoint = max([last_uid or 0, (uidnext or 1) - 1] + uids)
+        if failed_uids:
+            # Stay below the first report that failed, so the next sync fetches it again
+            checkpoint = min(checkpoint, min(failed_uids) - 1)
+            print(f"{len(failed_uids)} reports failed to save; checkpoint held at UID {checkpoint}.")
+        if uidvalidity is not None:
+            save_sync_checkpoint(session, folder, uidvalidity, checkpoint)
+    finally:
+        session.close() # Close session after processing all emails
+    return saved_dates
 
-        print(f"Found {len(uids)} emails in the date range. Processing...")
-        session = get_pharmacy_session(pharmacy) # Create session outside the loop
 
-        for uid in uids:
-            report_date = None # Reset for each email
-            try:
-                print(f"Fetching email UID {uid}...")
-                # Fetch BODY[] and ENVELOPE (which contains Date header)
-                response = client.fetch([uid], ['BODY[]', 'ENVELOPE'])
-                if uid not in response:
-                    print(f"Could not fetch UID {uid}. Skipping.")
-                    # No need to mark as read if not using UNSEEN
-                    continue
-
-                msg_data = response[uid][b'BODY[]']
-                envelope = response[uid][b'ENVELOPE']
-
-                # Try parsing date from Envelope's Date header
-                if envelope and envelope.date:
-                    report_date = envelope.date.date() # Already a datetime object
-                    print(f"UID {uid}: Parsed date from header: {report_date}")
-                else:
-                    print(f"UID {uid}: Could not parse date from header. Skipping.")
-                    continue # Cannot process without a date
-
-                # --- Optional but recommended: Check if parsed date is within our target range ---
-                # This handles cases where IMAP SINCE might be slightly inexact
-                if report_date < start_date or report_date > end_date:
-                    print(f"UID {uid}: Email date {report_date} outside target range ({start_date} to {end_date}). Skipping.")
-                    continue
-                # --- End optional date range check ---
-
-                # --- Check if report for this date already exists ---
-                existing_report = session.query(ReportEntry).filter(ReportEntry.date == report_date).first()
-                if existing_report:
-                    print(f"UID {uid}: Report for date {report_date} already exists in DB. Skipping.")
-                    # No need to mark as read
-                    continue # Skip processing
-
-                # --- If report doesn't exist, proceed with parsing and saving ---
-                message = email.message_from_bytes(msg_data)
-                subject_line = envelope.subject.decode() if envelope and envelope.subject else ""
-                html_content = None
-                if message.is_multipart():
-                    for part in message.walk():
-                        if part.get_content_type() == 'text/html':
-                            try:
-                                html_content = part.get_payload(decode=True).decode(
-                                    part.get_content_charset() or 'utf-8', errors='replace'
-                                )
-                                break
-                            except Exception as e:
-                                print(f"UID {uid}: Error decoding part: {e}")
-                elif message.get_content_type() == 'text/html':
-                    try:
-                        html_content = message.get_payload(decode=True).decode(
-                            message.get_content_charset() or 'utf-8', errors='replace'
-                        )
-                    except Exception as e:
-                        print(f"UID {uid}: Error decoding body: {e}")
-
-                if (
-                    "Daily Management Report" not in subject_line
-                    and (not html_content or "Daily Management Report" not in html_content)
-                ):
-                    print(f"UID {uid}: Skipping email, does not contain 'Daily Management Report'.")
-                    continue
-
-                if html_content:
-                    soup = BeautifulSoup(html_content, 'lxml')
-                    print(f"UID {uid}: Extracting data for {report_date}...")
-                    extracted_entries = extract_report_data(soup)
-                    if extracted_entries:
-                        print(f"UID {uid}: Saving {len(extracted_entries)} entries for {report_date}...")
-                        save_successful = save_entries(extracted_entries, report_date, session)
-                        if save_successful:
-                             print(f"UID {uid}: Successfully saved entries for {report_date}.")
-                             saved_dates.add(report_date) # Add date to set if saved
-                        else:
-                             print(f"UID {uid}: Entries for {report_date} were duplicates or failed to save.")
-                    else:
-                         print(f"UID {uid}: No data extracted for {report_date}. Skipping.")
-                else:
-                    print(f"UID {uid}: No HTML content found. Skipping.")
+def fetch_latest_report(pharmacy='reitz', config: Optional[PharmacyConfig] = None):
+    config = config or load_pharmacy_config(pharmacy)
+    pharmacy = config.name
+    if not config.is_complete():
+        print("Please set GMAIL_USERNAME, GMAIL_APP_PASSWORD, REPORT_SENDER, and REPORT_SUBJECT in .env file.")
+        return 0 # Return 0 days added
 
-            except Exception as e:
-                print(f"UID {uid}: An unexpected error occurred: {e}. Skipping this email.")
-                continue # Skip to the next email
+    with IMAPClient(host='imap.gmail.com', ssl=True) as client:
+        print(f"Logging in as {config.gmail_username}...")
+        client.login(config.gmail_username, config.gmail_app_password)
+        saved_dates = sync_mailbox(client, config)
 
-        session.close() # Close session after processing all emails
-        print(f"Fetch complete. Added data for {len(saved_dates)} new dates.")
-        populate_monthly_closing_stock(pharmacy)
-        return len(saved_dates) # Return the count of unique dates saved
+    print(f"Fetch complete. Added data for {len(saved_dates)} new dates.")
+    populate_monthly_closing_stock(pharmacy, saved_dates) # Only the months just written
+    return len(saved_dates) # Return the count of unique dates saved
 
 
 def fetch_and_save_history(start_date_str, end_date_str, pharmacy='reitz'):
     """Fetch all report emails between start and end (inclusive) and save to DB."""
-    load_pharmacy_env(pharmacy)
-    user = os.getenv('GMAIL_USERNAME')
-    password = os.getenv('GMAIL_APP_PASSWORD')
-    sender = os.getenv('REPORT_SENDER')
-    subject = os.getenv('REPORT_SUBJECT')
-    if not all([user, password, sender, subject]):
+    config = load_pharmacy_config(pharmacy)
+    user, password = config.gmail_username, config.gmail_app_password
+    sender, subject = config.report_sender, config.report_subject
+    if not config.is_complete():
         print("Set required GMAIL env vars.")
         return
 
@@ -482,91 +849,173 @@ def fetch_and_save_history(start_date_str, end_date_str, pharmacy='reitz'):
         uids = client.search(criteria)
         print(f"Found {len(uids)} messages matching criteria.")
 
-        for uid in uids:
-            resp = client.fetch([uid], ['BODY[]', 'INTERNALDATE', 'ENVELOPE']) # Fetch ENVELOPE for better date parsing
-            if uid not in resp:
-                print(f"Could not fetch UID {uid}. Skipping.")
-                continue
+        session = get_pharmacy_session(pharmacy)
+        try:
+            archive = open_report_archive(pharmacy)
+            pending = plan_report_fetch(client, uids, session, start_date, end_date, archive)
+            failed_dates = set()
+            saved_dates = import_reports_pipelined(client, pending, session, archive, failed_dates=failed_dates)
+        finally:
+            session.close()
+        print(f"Saved reports for {len(saved_dates)} new dates.")
+        failed_dates -= saved_dates # Another email for the same date was saved
+        if failed_dates:
+            print(f"Failed to import {len(failed_dates)} dates (run the import again to retry): "
+                  f"{', '.join(d.isoformat() for d in sorted(failed_dates))}")
 
-            # Prefer INTERNALDATE for sorting/filtering, but parse 'Date' header for report_date
-            msg_data = resp[uid][b'BODY[]']
-            internal_date = resp[uid][b'INTERNALDATE']
-            envelope = resp[uid][b'ENVELOPE'] # Envelope contains parsed headers like Date
+    print("History import completed." if not failed_dates else "History import completed with errors.")
+    populate_monthly_closing_stock(pharmacy, saved_dates)
 
-            # Try parsing date from Envelope first
-            report_date = None
-            if envelope and envelope.date:
-                 report_date = envelope.date.date() # Already a datetime object
-            elif internal_date: # Fallback to internal date
-                 report_date = internal_date.date()
 
-            if not report_date:
-                print(f"Could not determine date for UID {uid}. Skipping.")
-                continue
+def reparse_archive(pharmacy='reitz', start_date_str=None, end_date_str=None, replace=False):
+    """Rebuilds report_entries from the local email archive, with no network access.
+    Existing rows are updated in place; with replace=True each archived date is cleared first
+    (in the same transaction) so rows the parser no longer produces disappear.
+    Returns the number of dates written.
+    """
+    archive = open_report_archive(pharmacy)
+    if archive is None or not len(archive):
+        print(f"No archived emails for {pharmacy}.")
+        return 0
+    start_date = datetime.date.fromisoformat(start_date_str) if start_date_str else None
+    end_date = datetime.date.fromisoformat(end_date_str) if end_date_str else None
+
+    print(f"Reparsing {len(archive)} archived emails for {pharmacy}...")
+    session = get_pharmacy_session(pharmacy)
+    written = set()
+    try:
+        for uid, report_date, subject_line, msg_data in archive.iter_messages(start_date, end_date):
+            if report_date in written:
+                continue # One message per date, like a live sync
+            if replace:
+                session.query(ReportEntry).filter(ReportEntry.date == report_date).delete()
+            try:
+                if ingest_report_message(uid, msg_data, subject_line, report_date, session, on_conflict='update'):
+                    written.add(report_date)
+                else:
+                    session.rollback() # Undo the delete if nothing replaced it
+            except Exception as e:
+                session.rollback()
+                print(f"UID {uid}: Error reparsing archived email: {e}")
+    finally:
+        session.close()
 
-            # Check if report_date is within the desired range (redundant with search but good practice)
-            if report_date < start_date or report_date > end_date:
-                continue
+    print(f"Reparse complete. Wrote data for {len(written)} dates.")
+    populate_monthly_closing_stock(pharmacy, written)
+    return len(written)
 
-            print(f"Processing UID {uid} for date: {report_date}")
-            msg = email.message_from_bytes(msg_data)
-
-            subject_line = envelope.subject.decode() if envelope and envelope.subject else ""
-            html = None
-            if msg.is_multipart():
-                for part in msg.walk():
-                    if part.get_content_type() == 'text/html':
-                        try:
-                             html = part.get_payload(decode=True).decode(
-                                 part.get_content_charset() or 'utf-8', errors='replace')
-                             break
-                        except Exception as e:
-                             print(f"Error decoding part for UID {uid}: {e}")
-            elif msg.get_content_type() == 'text/html':
-                 try:
-                    html = msg.get_payload(decode=True).decode(
-                        msg.get_content_charset() or 'utf-8', errors='replace')
-                 except Exception as e:
-                     print(f"Error decoding body for UID {uid}: {e}")
-
-            if (
-                "Daily Management Report" not in subject_line
-                and (not html or "Daily Management Report" not in html)
-            ):
-                print(f"UID {uid}: Skipping email, does not contain 'Daily Management Report'.")
-                continue
 
-            if not html:
-                print(f"No HTML content found for UID {uid}. Skipping.")
-                continue
+def fetch_all_pharmacies(pharmacies=None, max_workers=None) -> Dict[str, Dict]:
+    """Runs fetch_latest_report for every pharmacy concurrently, one IMAP connection and DB session each.
+    Returns {pharmacy: {'new_days': int, 'seconds': float, 'error': str|None}}.
+    """
+    pharmacies = list(pharmacies or PHARMACY_ENV_FILES)
+    configs = [load_pharmacy_config(p) for p in pharmacies]
+
+    def run(config):
+        started = time.perf_counter()
+        try:
+            new_days, error = fetch_latest_report(config=config), None
+        except Exception as e:
+            new_days, error = 0, str(e)
+        return config.name, {'new_days': new_days, 'seconds': time.perf_counter() - started, 'error': error}
+
+    with ThreadPoolExecutor(max_workers=max_workers or len(configs)) as pool:
+        results = dict(pool.map(run, configs))
+
+    print("\n--- Sync summary ---")
+    for name, r in results.items():
+        status = f"error: {r['error']}" if r['error'] else f"{r['new_days']} new days"
+        print(f"{name:<10} {r['seconds']:7.2f}s  {status}")
+    return results
 
-            soup = BeautifulSoup(html, 'lxml')
-            extracted_entries = extract_report_data(soup)
-            if not extracted_entries:
-                print(f"No data extracted for UID {uid} ({report_date}). Skipping.")
-                continue
 
-            print(f"Saving {len(extracted_entries)} entries for {report_date} (UID: {uid})...")
-            session = get_pharmacy_session(pharmacy)
-            save_entries(extracted_entries, report_date, session) # Pass the list
+def _default_imap_client():
+    return IMAPClient(host='imap.gmail.com', ssl=True)
 
-    print("History import completed.")
-    populate_monthly_closing_stock(pharmacy)
+
+def _idle_until_new_mail(client, stop_event, renew_seconds) -> bool:
+    """One IDLE session: returns True as soon as the server announces EXISTS (new mail),
+    False when the session is due for renewal or stop_event is set."""
+    client.idle()
+    try:
+        renew_at = time.monotonic() + renew_seconds
+        while not stop_event.is_set() and time.monotonic() < renew_at:
+            responses = client.idle_check(timeout=IDLE_CHECK_SECONDS)
+            if any(len(r) > 1 and r[1] == b'EXISTS' for r in responses):
+                return True
+        return False
+    finally:
+        client.idle_done()
+
+
+def watch_pharmacy(pharmacy, client_factory=None, stop_event=None, folder='INBOX'):
+    """Long-running push ingestion for one pharmacy: holds an IMAP connection in IDLE and runs
+    sync_mailbox whenever new mail arrives (and once on every (re)connect, to catch up).
+    Reconnects with exponential backoff; returns when stop_event is set.
+    client_factory() must return a context-managed IMAPClient-like object (defaults to Gmail).
+    """
+    config = load_pharmacy_config(pharmacy)
+    if not config.is_complete():
+        print(f"[{pharmacy}] Missing mailbox settings. Not watching.")
+        return
+    client_factory = client_factory or _default_imap_client
+    stop_event = stop_event or threading.Event()
+    failures = 0
+    while not stop_event.is_set():
+        try:
+            with client_factory() as client:
+                client.login(config.gmail_username, config.gmail_app_password)
+                print(f"[{pharmacy}] Connected. Watching {folder} for new reports...")
+                while not stop_event.is_set():
+                    saved_dates = sync_mailbox(client, config, folder)
+                    failures = 0
+                    if saved_dates:
+                        print(f"[{pharmacy}] Ingested reports for {sorted(d.isoformat() for d in saved_dates)}.")
+                        populate_monthly_closing_stock(pharmacy, saved_dates)
+                    while not stop_event.is_set() and not _idle_until_new_mail(client, stop_event, IDLE_RENEW_SECONDS):
+                        pass # IDLE renewed with no new mail
+        except Exception as e:
+            failures += 1
+            delay = min(IDLE_MAX_BACKOFF_SECONDS, IDLE_RETRY_SECONDS * 2 ** (failures - 1))
+            print(f"[{pharmacy}] Connection lost ({e}). Reconnecting in {delay:.0f}s...")
+            stop_event.wait(delay)
+
+
+def watch_all_pharmacies(pharmacies=None, client_factory=None, stop_event=None):
+    """Runs watch_pharmacy for each pharmacy on its own thread until stop_event is set (or Ctrl-C)."""
+    stop_event = stop_event or threading.Event()
+    threads = [
+        threading.Thread(target=watch_pharmacy, args=(p, client_factory, stop_event), name=f'watch-{p}', daemon=True)
+        for p in (pharmacies or PHARMACY_ENV_FILES)
+    ]
+    for t in threads:
+        t.start()
+    try:
+        while any(t.is_alive() for t in threads):
+            for t in threads:
+                t.join(timeout=1)
+    except KeyboardInterrupt:
+        stop_event.set()
 
 
 # --- Backend API Helper Functions ---
 # (get_today_entries and get_month_to_date_entries remain the same as your provided code)
-def get_today_entries(report_date):
-    """Retrieve all entries for a specific date."""
-    session = SessionLocal()
-    entries = session.query(ReportEntry).filter(ReportEntry.date == report_date).all()
-    session.close()
+def get_today_entries(report_date, session=None, entries=ReportEntry):
+    """Retrieve all entries for a specific date (from session's database, default DATABASE_URL).
+    entries may be a tiered_entries alias, for dates in archived years."""
+    own_session = session is None
+    session = session or SessionLocal()
+    entries = session.query(entries).filter(entries.date == report_date).all()
+    if own_session:
+        session.close()
     return entries
 
-def get_month_to_date_entries(report_date):
+def get_month_to_date_entries(report_date, session=None):
     """Retrieve sum of today_value grouped by category and description for the month to date."""
     first_day = report_date.replace(day=1)
-    session = SessionLocal()
+    own_session = session is None
+    session = session or SessionLocal()
     results = session.query(
         ReportEntry.category,
         ReportEntry.description,
@@ -575,55 +1024,492 @@ def get_month_to_date_entries(report_date):
         ReportEntry.date >= first_day,
         ReportEntry.date <= report_date
     ).group_by(ReportEntry.category, ReportEntry.description).all()
-    session.close()
+    if own_session:
+        session.close()
     return results
 
 # --- NEW: Populate MonthlyClosingStock from ReportEntry ---
-def populate_monthly_closing_stock(pharmacy='reitz'):
+def month_closing_stock(session, dates=None):
+    """(month 'YYYY-MM', source_date, closing_stock) for each month: the last closing stock entry
+    of the month, picked with one ROW_NUMBER() window query. With dates, only their months."""
+    month = func.strftime('%Y-%m', ReportEntry.date)
+    ranked = session.query(
+        month.label('month'),
+        ReportEntry.date.label('source_date'),
+        ReportEntry.today_value.label('closing_stock'),
+        func.row_number().over(partition_by=month, order_by=ReportEntry.date.desc()).label('rn')
+    ).filter(
+        metric_filter(session, 'closing_stock'),
+        ReportEntry.today_value.is_not(None)
+    )
+    if dates is not None:
+        starts = sorted({datetime.date(d.year, d.month, 1) for d in dates})
+        ranked = ranked.filter(or_(*[
+            and_(ReportEntry.date >= start, ReportEntry.date < (start + datetime.timedelta(days=32)).replace(day=1))
+            for start in starts
+        ]))
+    ranked = ranked.subquery()
+    return session.query(ranked.c.month, ranked.c.source_date, ranked.c.closing_stock).filter(ranked.c.rn == 1).all()
+
+
+def populate_monthly_closing_stock(pharmacy='reitz', dates=None):
+    """Upserts MonthlyClosingStock. With dates (e.g. the dates an ingest just saved) only their
+    months are recomputed; without, every month is rebuilt from one window query."""
+    if dates is not None and not dates:
+        return
     session = get_pharmacy_session(pharmacy)
     try:
-        min_date = session.query(func.min(ReportEntry.date)).scalar()
-        max_date = session.query(func.max(ReportEntry.date)).scalar()
-        if not min_date or not max_date:
-            print("No data in ReportEntry.")
+        rows = month_closing_stock(session, dates)
+        if not rows:
+            print("No closing stock data in ReportEntry.")
             return
-
-        current = datetime.date(min_date.year, min_date.month, 1)
-        end = datetime.date(max_date.year, max_date.month, 1)
-        while current <= end:
-            # Find the last day in this month with a closing stock entry
-            last_date = session.query(func.max(ReportEntry.date)).filter(
-                ReportEntry.category == 'STOCK TRADING ACCOUNT',
-                ReportEntry.description == 'Closing Stock Valued at Cost Now',
-                func.strftime('%Y-%m', ReportEntry.date) == current.strftime('%Y-%m')
-            ).scalar()
-            if last_date:
-                closing_stock = session.query(ReportEntry.today_value).filter(
-                    ReportEntry.category == 'STOCK TRADING ACCOUNT',
-                    ReportEntry.description == 'Closing Stock Valued at Cost Now',
-                    ReportEntry.date == last_date
-                ).scalar()
-                # Upsert
-                month_str = current.strftime('%Y-%m')
-                existing = session.query(MonthlyClosingStock).filter_by(month=month_str).first()
-                if existing:
-                    existing.closing_stock = closing_stock
-                    existing.source_date = last_date
-                else:
-                    session.add(MonthlyClosingStock(
-                        month=month_str,
-                        closing_stock=closing_stock,
-                        source_date=last_date
-                    ))
-            current = (current.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+        dialect = session.get_bind().dialect.name
+        insert = postgresql_insert if dialect == 'postgresql' else sqlite_insert
+        stmt = insert(MonthlyClosingStock.__table__)
+        session.execute(
+            stmt.on_conflict_do_update(
+                index_elements=['month'],
+                set_={'closing_stock': stmt.excluded.closing_stock, 'source_date': stmt.excluded.source_date}
+            ),
+            [{'month': month, 'source_date': source_date, 'closing_stock': closing_stock}
+             for month, source_date, closing_stock in rows]
+        )
+        record_data_change(session, min(datetime.datetime.strptime(month, '%Y-%m').date() for month, _, _ in rows))
         session.commit()
-        print(f"Monthly closing stock table populated for {pharmacy}.")
+        print(f"Monthly closing stock table populated for {pharmacy} ({len(rows)} months).")
     except Exception as e:
         session.rollback()
         print("Error populating monthly closing stock:", e)
     finally:
         session.close()
 
+# --- Stock KPIs per month (opening/closing points and movements from daily_metrics) ---
+def stock_kpis(opening_stock, closing_stock, cost_of_sales, days_in_month) -> Dict[str, Optional[float]]:
+    """Stock turnover ratio (cost of sales over average stock) and days sales of inventory."""
+    avg_stock = 0.0
+    if (opening_stock + closing_stock) > 0:
+        avg_stock = (opening_stock + closing_stock) / 2.0
+    ratio = cost_of_sales / avg_stock if avg_stock > 0 else 0.0
+    dsi = (avg_stock / cost_of_sales) * days_in_month if cost_of_sales else None # Undefined without sales
+    return {'stock_turnover_ratio': ratio, 'dsi': dsi}
+
+
+def stock_kpi_series(session, first_month, last_month) -> List[Dict]:
+    """Opening stock (first value of the month), closing stock (last value), the cost of sales,
+    purchases and adjustments totals, and stock_kpis for every month from first_month to
+    last_month ('YYYY-MM'), in order. One statement: FIRST_VALUE windows partitioned by month
+    (ordered nulls last, since SQLite has no IGNORE NULLS) and windowed sums over daily_metrics.
+    Months without data come back as zeros. Raises ValueError for more than MAX_SERIES_BUCKETS months."""
+    first_year, first = map(int, first_month.split('-'))
+    last_year, last = map(int, last_month.split('-'))
+    months = (last_year - first_year) * 12 + last - first + 1
+    if months > MAX_SERIES_BUCKETS:
+        raise ValueError(f"{months} months requested; the limit is {MAX_SERIES_BUCKETS}")
+    start = datetime.date(first_year, first, 1)
+    end = (datetime.date(last_year, last, 1) + datetime.timedelta(days=32)).replace(day=1) - datetime.timedelta(days=1)
+    month = func.strftime('%Y-%m', DailyMetrics.date)
+    point = lambda column, latest: func.first_value(column).over(
+        partition_by=month, order_by=[column.is_(None), DailyMetrics.date.desc() if latest else DailyMetrics.date])
+    total = lambda column: func.sum(column).over(partition_by=month)
+    rows = session.query(
+        month.label('month'),
+        point(DailyMetrics.opening_stock, latest=False).label('opening_stock'),
+        point(DailyMetrics.closing_stock, latest=True).label('closing_stock'),
+        total(DailyMetrics.cost_of_sales).label('cost_of_sales'),
+        total(DailyMetrics.purchases).label('purchases'),
+        total(DailyMetrics.adjustments).label('adjustments'),
+    ).filter(DailyMetrics.date >= start, DailyMetrics.date <= end).distinct().all()
+    by_month = {row.month: row for row in rows}
+
+    series = []
+    day = start
+    while day <= end:
+        month_str = day.strftime('%Y-%m')
+        next_month = (day + datetime.timedelta(days=32)).replace(day=1)
+        row = by_month.get(month_str)
+        values = {
+            'month': month_str,
+            'opening_stock': (row.opening_stock if row else None) or 0.0,
+            'closing_stock': (row.closing_stock if row else None) or 0.0,
+            'cost_of_sales': (row.cost_of_sales if row else None) or 0.0,
+            'purchases': (row.purchases if row else None) or 0.0,
+            'adjustments': (row.adjustments if row else None) or 0.0,
+        }
+        values.update(stock_kpis(values['opening_stock'], values['closing_stock'], values['cost_of_sales'],
+                                 (next_month - day).days))
+        series.append(values)
+        day = next_month
+    return series
+
+# --- Generic metric time series (/api/metrics): one statement per request ---
+SERIES_GRAINS = ('day', 'week', 'month')
+SERIES_AGGS = ('sum', 'avg', 'last')
+MAX_SERIES_BUCKETS = int(os.getenv('MAX_SERIES_BUCKETS', '5000'))
+
+
+def bucket_starts(start, end, grain) -> List[datetime.date]:
+    """The first day of every day/week (Monday)/month bucket that overlaps [start, end]."""
+    if grain == 'day':
+        first, step = start, lambda d: d + datetime.timedelta(days=1)
+    elif grain == 'week':
+        first, step = start - datetime.timedelta(days=start.weekday()), lambda d: d + datetime.timedelta(days=7)
+    else:
+        first, step = start.replace(day=1), lambda d: (d + datetime.timedelta(days=32)).replace(day=1)
+    buckets = []
+    while first <= end:
+        buckets.append(first)
+        first = step(first)
+    return buckets
+
+
+def _daily_series_rows(session, metrics, start, end, grain):
+    """[(bucket date, {key: value})] from daily_metrics, grouped by bucket. With any 'last'
+    aggregate every column is a window partitioned by bucket instead (still one statement)."""
+    if grain == 'day':
+        bucket = DailyMetrics.date
+    elif grain == 'week':
+        bucket = type_coerce(func.date(DailyMetrics.date, '-6 days', 'weekday 1'), Date) # Monday on or before
+    else:
+        bucket = type_coerce(func.date(DailyMetrics.date, 'start of month'), Date)
+    columns = {key: getattr(DailyMetrics, key) for key in metrics}
+    in_range = (DailyMetrics.date >= start, DailyMetrics.date <= end)
+    if 'last' not in metrics.values():
+        aggregate = {'sum': func.sum, 'avg': func.avg}
+        query = session.query(bucket, *[aggregate[agg](columns[key]) for key, agg in metrics.items()]
+                              ).filter(*in_range).group_by(bucket)
+    else:
+        def window(key, agg):
+            if agg == 'last': # Last non-null value: SQLite has no IGNORE NULLS, so order nulls first out
+                return func.first_value(columns[key]).over(
+                    partition_by=bucket, order_by=[columns[key].is_(None), DailyMetrics.date.desc()])
+            return (func.sum if agg == 'sum' else func.avg)(columns[key]).over(partition_by=bucket)
+        query = session.query(bucket, *[window(key, agg) for key, agg in metrics.items()]).filter(*in_range).distinct()
+    return [(row[0], dict(zip(metrics, row[1:]))) for row in query]
+
+
+def _monthly_series_rows(session, metrics, start, end):
+    """[(first day of month, {key: value})] from the monthly_metrics rollup (whole months only)."""
+    field = {'sum': 'total', 'avg': 'average', 'last': 'last_value'}
+    rows = {}
+    for row in session.query(MonthlyMetrics).filter(
+            MonthlyMetrics.month >= start.strftime('%Y-%m'),
+            MonthlyMetrics.month <= end.strftime('%Y-%m'),
+            MonthlyMetrics.key.in_(list(metrics))):
+        month = datetime.date(int(row.month[:4]), int(row.month[5:7]), 1)
+        rows.setdefault(month, {})[row.key] = getattr(row, field[metrics[row.key]])
+    return list(rows.items())
+
+
+def metric_series(session, metrics, start, end, grain='day', fill=0.0, cumulative=False) -> Dict:
+    """Time series of canonical metrics over [start, end] in one statement.
+    metrics is {key: 'sum' | 'avg' | 'last'} (the aggregate within each bucket); grain is
+    'day', 'week' (Monday-based) or 'month'. Whole-month ranges at month grain read the
+    monthly_metrics rollup, anything else groups daily_metrics. Returns
+    {'buckets': [first day of each bucket], 'series': {key: [value per bucket]}}: every bucket
+    in range is present, and buckets or values without data are fill. cumulative=True returns
+    running totals instead (missing values count as 0)."""
+    unknown = [key for key in metrics if key not in METRIC_KEYS]
+    if unknown:
+        raise ValueError(f"Unknown metrics: {', '.join(unknown)}")
+    if grain not in SERIES_GRAINS or any(agg not in SERIES_AGGS for agg in metrics.values()):
+        raise ValueError(f"grain must be one of {SERIES_GRAINS} and agg one of {SERIES_AGGS}")
+    if start > end:
+        raise ValueError("start must not be after end")
+    buckets = bucket_starts(start, end, grain)
+    if len(buckets) > MAX_SERIES_BUCKETS:
+        raise ValueError(f"{len(buckets)} buckets requested; the limit is {MAX_SERIES_BUCKETS}")
+
+    whole_months = start.day == 1 and (end + datetime.timedelta(days=1)).day == 1
+    if grain == 'month' and whole_months:
+        rows = _monthly_series_rows(session, metrics, start, end)
+    else:
+        rows = _daily_series_rows(session, metrics, start, end, grain)
+
+    # Zero-fill: every bucket gets a slot, then the rows that exist are dropped into place
+    position = {bucket: i for i, bucket in enumerate(buckets)}
+    series = {key: [None] * len(buckets) for key in metrics}
+    for bucket, values in rows:
+        i = position[bucket]
+        for key, value in values.items():
+            series[key][i] = value
+    for key, values in series.items():
+        if cumulative:
+            series[key] = list(itertools.accumulate(value or 0.0 for value in values))
+        elif fill is not None:
+            series[key] = [fill if value is None else value for value in values]
+    return {'buckets': buckets, 'series': series}
+
+# --- Cross-pharmacy queries (every pharmacy's file ATTACHed, see pharmacy_registry) ---
+_group_tables: Dict[Tuple[str, str], object] = {}
+
+
+def pharmacy_table(model, pharmacy):
+    """model's table in the ATTACHed schema of one pharmacy (e.g. villiers.daily_metrics)."""
+    key = (model.__tablename__, pharmacy)
+    if key not in _group_tables:
+        _group_tables[key] = model.__table__.to_metadata(MetaData(), schema=pharmacy)
+    return _group_tables[key]
+
+
+def group_union(model, pharmacies, *columns):
+    """UNION ALL of model's table across pharmacies, with a leading `pharmacy` column."""
+    selects = []
+    for pharmacy in pharmacies:
+        table = pharmacy_table(model, pharmacy)
+        selects.append(select(literal(pharmacy).label('pharmacy'), *[table.c[c] for c in columns]))
+    return union_all(*selects).subquery()
+
+
+def group_daily_totals(session, pharmacies, start, end) -> Dict[str, Dict]:
+    """Per-pharmacy totals of the daily_metrics columns between start and end (inclusive),
+    answered by one grouped statement over the ATTACHed files. session is a group session."""
+    sums = ['turnover', 'cost_of_sales', 'purchases', 'dispensary_turnover', 'scripts_total', 'pos_transactions']
+    union = group_union(DailyMetrics, pharmacies, 'date', 'avg_basket_value', *sums)
+    rows = session.execute(
+        select(
+            union.c.pharmacy,
+            func.count(union.c.date),
+            func.sum(union.c.avg_basket_value),
+            func.count(union.c.avg_basket_value),
+            *[func.sum(union.c[c]) for c in sums]
+        ).where(union.c.date >= start, union.c.date <= end).group_by(union.c.pharmacy)
+    ).all()
+    totals = {}
+    for pharmacy, days, basket_sum, basket_days, *values in rows:
+        totals[pharmacy] = dict(zip(sums, (v or 0 for v in values)))
+        totals[pharmacy].update(days=days, basket_sum=basket_sum or 0, basket_days=basket_days)
+    return totals
+
+# --- Hot/cold tiering: closed years in per-year archive files (see cold_tier) ---
+_cold_tables: Dict[int, object] = {}
+
+
+def cold_table(year):
+    """report_entries in the ATTACHed cold file of year (schema cold_<YYYY>)."""
+    if year not in _cold_tables:
+        _cold_tables[year] = ReportEntry.__table__.to_metadata(MetaData(), schema=cold_tier.schema_name(year))
+    return _cold_tables[year]
+
+
+def tiered_entries(session, pharmacy, start, end):
+    """ReportEntry when [start, end] is all hot; otherwise an alias of it over the hot rows
+    UNION ALL the cold rows of each archived year in range, whose files are ATTACHed on the
+    session's connection. A date with hot rows (re-ingested after archiving) is read from the
+    hot file only. Query it like ReportEntry, with metric_filter(..., entries=alias)."""
+    years = cold_tier.cold_years_between(pharmacy, start, end)
+    if not years:
+        return ReportEntry
+    cold_tier.attach_years(session.connection(), pharmacy, years)
+    hot = ReportEntry.__table__
+    hot_dates = select(hot.c.date).where(hot.c.date >= start, hot.c.date <= end)
+    selects = [select(hot).where(hot.c.date >= start, hot.c.date <= end)]
+    for year in years:
+        cold = cold_table(year)
+        selects.append(select(cold).where(cold.c.date >= start, cold.c.date <= end, cold.c.date.not_in(hot_dates)))
+    return aliased(ReportEntry, union_all(*selects).subquery('report_entries'))
+
+
+def _move_year(engine, pharmacy, year, to_cold=True) -> int:
+    """Moves one year of report_entries between the hot file and its cold file. Hot wins both
+    ways, as it does for reads: archiving replaces the cold rows of the dates it moves, and
+    restoring skips dates that already have hot rows (re-ingested after archiving), whose cold
+    rows are simply dropped. Restored dates get their daily_metrics/monthly_metrics rebuilt and
+    a data version bump. The copy and the delete commit separately: across WAL files a crash
+    can only leave a date in both tiers (reads prefer hot; re-run to finish), never in neither.
+    Archiving only deletes dates whose hot rows all reached the cold file unchanged, so a date
+    written in between (an import or reparse) stays hot whole. A restore removes the cold file
+    once it has no rows left. Returns the number of rows copied."""
+    path = cold_tier.cold_db_file(pharmacy, year)
+    if to_cold and not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        cold_engine = create_engine(f"sqlite:///{path}", future=True)
+        ReportEntry.__table__.create(bind=cold_engine, checkfirst=True) # Same unique key and covering index
+        cold_engine.dispose()
+    hot, cold = ReportEntry.__table__, cold_table(year)
+    source, target = (hot, cold) if to_cold else (cold, hot)
+    columns = [c.name for c in hot.columns if c.name != 'id'] # The target numbers its own rows
+    in_year = lambda t: and_(t.c.date >= datetime.date(year, 1, 1), t.c.date <= datetime.date(year, 12, 31))
+    with engine.connect() as conn:
+        cold_tier.attach_years(conn, pharmacy, [year])
+        try:
+            if to_cold:
+                moving = select(source.c.date).where(in_year(source)).distinct()
+                conn.execute(target.delete().where(in_year(target), target.c.date.in_(moving)))
+                moved = conn.execute(target.insert().from_select(
+                    columns, select(*[source.c[c] for c in columns]).where(in_year(source)))).rowcount
+                conn.commit()
+                # Dates written since the copy: a source row without an identical target row, or
+                # the reverse. Aliases keep these subqueries from correlating with the DELETE.
+                s, t = source.alias('s'), target.alias('t')
+                same = lambda a, b: and_(*[a.c[c].is_not_distinct_from(b.c[c]) for c in columns])
+                changed = union_all(
+                    select(s.c.date).where(in_year(s), ~exists().where(same(t, s))),
+                    select(t.c.date).where(in_year(t), ~exists().where(same(s, t))),
+                )
+                conn.execute(source.delete().where(in_year(source), source.c.date.not_in(changed)))
+                conn.commit()
+                conn.exec_driver_sql(f'ANALYZE "{cold_tier.schema_name(year)}"')
+                left = None
+            else:
+                hot_dates = select(target.c.date).where(in_year(target))
+                restored = conn.execute(
+                    select(source.c.date).where(in_year(source), source.c.date.not_in(hot_dates)).distinct()
+                ).scalars().all()
+                moved = 0
+                if restored:
+                    moved = conn.execute(target.insert().from_select(
+                        columns, select(*[source.c[c] for c in columns]).where(source.c.date.in_(restored)))).rowcount
+                    refresh_daily_metrics(conn, restored)
+                    refresh_monthly_metrics(conn, restored)
+                    record_data_change(conn, min(restored))
+                conn.commit()
+                # Every cold date now has hot rows, which reads prefer: the cold copies are dead
+                conn.execute(source.delete().where(in_year(source), source.c.date.in_(hot_dates)))
+                conn.commit()
+                left = conn.execute(select(func.count()).select_from(source)).scalar()
+        finally:
+            conn.rollback()
+            cold_tier.detach_all(conn)
+    if left == 0:
+        os.remove(path)
+    elif left:
+        print(f"{left} rows of {year} lost their hot copy during the restore and stay in {path}; run the restore again.")
+    return moved
+
+
+def _compact(engine):
+    """VACUUM (returns the freed pages to the filesystem) and ANALYZE, outside any transaction."""
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        conn.exec_driver_sql('VACUUM')
+        conn.exec_driver_sql('ANALYZE')
+
+
+def archive_closed_years(pharmacy='reitz', keep_years=None) -> Dict[int, int]:
+    """Moves report_entries of every year before the last keep_years (default
+    ARCHIVE_KEEP_YEARS) into per-year cold files, then VACUUMs and ANALYZEs the hot file.
+    Also picks up rows re-ingested into an archived year. Returns {year: rows moved}."""
+    engine = pharmacy_registry.get_engine(pharmacy)
+    first_hot = cold_tier.first_hot_year(keep_years)
+    with engine.connect() as conn:
+        years = sorted(int(y) for y in conn.execute(
+            select(func.strftime('%Y', ReportEntry.date)).where(ReportEntry.date < datetime.date(first_hot, 1, 1)).distinct()
+        ).scalars())
+    if not years:
+        print(f"No closed years to archive for {pharmacy} (hot from {first_hot}).")
+        return {}
+    size_before = os.path.getsize(engine.url.database)
+    moved = {}
+    for year in years:
+        moved[year] = _move_year(engine, pharmacy, year, to_cold=True)
+        print(f"Archived {moved[year]} rows of {year} for {pharmacy} to {cold_tier.cold_db_file(pharmacy, year)}")
+    _compact(engine)
+    size_after = os.path.getsize(engine.url.database)
+    print(f"{engine.url.database}: {size_before / 2**20:.1f} MiB -> {size_after / 2**20:.1f} MiB after VACUUM.")
+    return moved
+
+
+def restore_cold_years(pharmacy='reitz', years=None) -> Dict[int, int]:
+    """Moves archived years (default: all) back into the hot file and deletes their emptied cold
+    files, e.g. before changing the metric alias rules so upgrade_schema rebuilds their days.
+    Returns {year: rows moved}."""
+    engine = pharmacy_registry.get_engine(pharmacy)
+    archived = cold_tier.cold_years(pharmacy)
+    moved = {}
+    for year in sorted(int(y) for y in years) if years else archived:
+        if year not in archived:
+            print(f"{year} is not archived for {pharmacy}, skipping.")
+            continue
+        moved[year] = _move_year(engine, pharmacy, year, to_cold=False)
+        print(f"Restored {moved[year]} rows of {year} for {pharmacy}.")
+    if moved:
+        with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            conn.exec_driver_sql('ANALYZE')
+    return moved
+
+# --- Columnar export for multi-year analysis (see analytics) ---
+def export_parquet(pharmacy='reitz', years=None) -> List[str]:
+    """Writes each year's report_entries (default: every year with entries) to Parquet,
+    with the canonical metric key alongside the raw category/description. Returns the paths."""
+    session = get_pharmacy_session(pharmacy)
+    written = []
+    try:
+        if not years:
+            years = [int(y) for (y,) in session.query(func.strftime('%Y', ReportEntry.date)).distinct()]
+            years += cold_tier.cold_years(pharmacy)
+        for year in sorted({int(y) for y in years}):
+            start, end = datetime.date(year, 1, 1), datetime.date(year, 12, 31)
+            entries = tiered_entries(session, pharmacy, start, end)
+            rows = session.query(
+                entries.date, Metric.key, entries.category, entries.description, entries.today_value
+            ).outerjoin(Metric, Metric.id == entries.metric_id).filter(
+                entries.date >= start,
+                entries.date <= end
+            ).order_by(Metric.key, entries.date).all()
+            if not rows:
+                print(f"No entries for {pharmacy} in {year}, skipping.")
+                continue
+            written.append(analytics.write_year(pharmacy, year, rows))
+            print(f"Exported {len(rows)} rows for {pharmacy} {year} to {written[-1]}")
+    finally:
+        session.close()
+    return written
+
+# --- Query plan check for the API's metric queries ---
+def _metric_plan_queries(session, start, end):
+    """The shapes the dashboard endpoints run against report_entries, keyed by a short name."""
+    in_range = (ReportEntry.date >= start, ReportEntry.date <= end)
+    return {
+        'turnover sum': session.query(func.sum(ReportEntry.today_value)).filter(metric_filter(session, 'turnover'), *in_range),
+        'daily turnover series': session.query(ReportEntry.date, func.sum(ReportEntry.today_value)).filter(
+            metric_filter(session, 'turnover'), *in_range
+        ).group_by(ReportEntry.date).order_by(ReportEntry.date),
+        'cost of sales sum': session.query(func.sum(ReportEntry.today_value)).filter(metric_filter(session, 'cost_of_sales'), *in_range),
+        'basket value avg': session.query(func.avg(ReportEntry.today_value)).filter(metric_filter(session, 'avg_basket_value'), *in_range),
+        'scripts sum': session.query(func.sum(ReportEntry.today_value)).filter(metric_filter(session, 'scripts_total'), *in_range),
+        'cost/purchases series': session.query(ReportEntry.date, ReportEntry.metric_id, func.sum(ReportEntry.today_value)).filter(
+            metric_filter(session, 'cost_of_sales', 'purchases'), *in_range
+        ).group_by(ReportEntry.date, ReportEntry.metric_id),
+        'aggregates (one pass)': metric_aggregates_query(session, start, end, {
+            'turnover': ('turnover', 'sum'), 'cost_of_sales': ('cost_of_sales', 'sum'),
+            'avg_basket_value': ('avg_basket_value', 'avg'),
+        }),
+        'last closing stock': session.query(ReportEntry.today_value).filter(
+            metric_filter(session, 'closing_stock'), ReportEntry.date == end),
+    }
+
+
+def explain_query_plan(session, query) -> List[str]:
+    """SQLite's EXPLAIN QUERY PLAN detail lines for an ORM query."""
+    sql = str(query.statement.compile(session.get_bind(), compile_kwargs={'literal_binds': True}))
+    return [row[-1] for row in session.execute(text('EXPLAIN QUERY PLAN ' + sql))]
+
+
+def _plan_kind(plan: List[str]) -> str:
+    """'covering' (index-only range scan), 'index' (index seek plus row lookups) or 'scan'."""
+    lines = [line for line in plan if 'report_entries' in line]
+    if any(line.startswith('SCAN') for line in lines):
+        return 'scan'
+    if lines and all('COVERING INDEX' in line for line in lines):
+        return 'covering'
+    return 'index'
+
+
+def check_query_plans(pharmacy='reitz') -> bool:
+    """Prints the plan of each metric query. Returns True when every one is an index-only
+    range scan (SEARCH ... USING COVERING INDEX)."""
+    session = get_pharmacy_session(pharmacy)
+    today = datetime.date.today()
+    all_ok = True
+    try:
+        for name, query in _metric_plan_queries(session, today.replace(day=1), today).items():
+            plan = explain_query_plan(session, query)
+            kind = _plan_kind(plan)
+            all_ok = all_ok and kind == 'covering'
+            print(f"[{kind}] {name}: {' | '.join(plan)}")
+    finally:
+        session.close()
+    return all_ok
+
 # --- Main Execution ---
 if __name__ == '__main__':
     # Handle optional history import
@@ -637,6 +1523,48 @@ if __name__ == '__main__':
         pharmacy = sys.argv[2] if len(sys.argv) > 2 else 'reitz'
         populate_monthly_closing_stock(pharmacy)
         sys.exit(0)
+    # Show the query plans of the API's metric queries (exit status 1 if any scans the table)
+    if len(sys.argv) >= 2 and sys.argv[1] == 'explain':
+        sys.exit(0 if check_query_plans(sys.argv[2] if len(sys.argv) > 2 else 'reitz') else 1)
+    # Write per-year Parquet files for the analytic backend (needs pyarrow)
+    if len(sys.argv) >= 2 and sys.argv[1] == 'export-parquet':
+        target = sys.argv[2] if len(sys.argv) > 2 else 'reitz'
+        for name in (pharmacy_registry.PHARMACIES if target == 'all' else [target]):
+            export_parquet(name, sys.argv[3:])
+        sys.exit(0)
+    # Move closed years to per-year cold files (or --restore them), then VACUUM/ANALYZE
+    if len(sys.argv) >= 2 and sys.argv[1] == 'archive-years':
+        args = [a for a in sys.argv[2:] if not a.startswith('--')]
+        target = args[0] if args else 'reitz'
+        for name in (pharmacy_registry.PHARMACIES if target == 'all' else [target]):
+            if '--restore' in sys.argv:
+                restore_cold_years(name, args[1:])
+            else:
+                archive_closed_years(name, args[1] if len(args) > 1 else None)
+        sys.exit(0)
+    # Rebuild report_entries from the local email archive (no IMAP)
+    if len(sys.argv) >= 2 and sys.argv[1] == 'reparse':
+        args = [a for a in sys.argv[2:] if not a.startswith('--')]
+        reparse_archive(args[0] if args else 'reitz', *args[1:3], replace='--replace' in sys.argv)
+        sys.exit(0)
+    # Run the background sync scheduler in the foreground (sidecar mode)
+    if len(sys.argv) >= 2 and sys.argv[1] == 'schedule':
+        from sync_scheduler import start_scheduler
+        if start_scheduler(sys.argv[2:] or list(PHARMACY_ENV_FILES), force=True) is None:
+            sys.exit(1)
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            sys.exit(0)
+    # Push mode: hold an IMAP IDLE connection per pharmacy and ingest reports as they arrive
+    if len(sys.argv) >= 2 and sys.argv[1] == 'watch':
+        watch_all_pharmacies(sys.argv[2:] or None)
+        sys.exit(0)
+    # Sync every pharmacy concurrently
+    if len(sys.argv) >= 2 and sys.argv[1] == 'all':
+        fetch_all_pharmacies(sys.argv[2:] or None)
+        sys.exit(0)
     # Default: fetch and save today's report
     fetch_latest_report()
 
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""Single source of truth for the pharmacies, their files, and their database engines.
+
+Each pharmacy's engine (and its connection pool) is created lazily on first use and
+reused for the life of the process. Scripts take plain sessions from get_session();
+the API takes thread-scoped sessions from get_scoped_session() and releases them with
+remove_scoped_sessions() at the end of each request.
+
+Every SQLite connection gets SQLITE_PROFILE (WAL, synchronous=NORMAL, mmap, a larger
+page cache, in-memory temp tables) through a connect event. API reads use a separate
+read-only engine per pharmacy whose connections are PRAGMA query_only, so in WAL mode
+dashboard reads run alongside an ingest instead of queueing behind it.
+
+get_group_session() is a read-only session whose connections ATTACH every pharmacy file
+under its own schema name (reitz.daily_metrics, villiers.daily_metrics, ...), so
+group-level questions are one SQL statement instead of one request per pharmacy.
+"""
+import os
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session, scoped_session, sessionmaker
+from sqlalchemy.pool import QueuePool
+
+DEFAULT_PHARMACY = 'reitz'
+PHARMACY_DATA_DIR = os.getenv('PHARMACY_DATA_DIR', '/data')
+
+PHARMACY_DB_FILES = {
+    'reitz': 'reports.db',
+    'villiers': 'reports_villiers.db',
+    'roos': 'reports_roos.db',
+    'tugela': 'reports_tugela.db',
+    'winterton': 'reports_winterton.db',
+}
+
+PHARMACY_ENV_FILES = {
+    'reitz': '.env.reitz',
+    'villiers': '.env.villiers',
+    'roos': '.env.roos',
+    'tugela': '.env.tugela',
+    'winterton': '.env.winterton',
+}
+
+PHARMACIES: List[str] = list(PHARMACY_DB_FILES)
+
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '5'))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '10'))
+
+# Per-connection PRAGMAs; SQLITE_PROFILE=off keeps SQLite's defaults
+SQLITE_PROFILE_ENABLED = os.getenv('SQLITE_PROFILE', 'on').lower() != 'off'
+SQLITE_PROFILE = {
+    'journal_mode': os.getenv('SQLITE_JOURNAL_MODE', 'WAL'),
+    'synchronous': os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL'),
+    'mmap_size': int(os.getenv('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024))),
+    'cache_size': int(os.getenv('SQLITE_CACHE_SIZE', '-65536')),  # Negative = KiB, so 64 MiB
+    'temp_store': os.getenv('SQLITE_TEMP_STORE', 'MEMORY'),
+    'busy_timeout': int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000')),
+}
+
+_lock = threading.Lock()
+# Keyed by (pharmacy, read_only)
+_engines: Dict[Tuple[str, bool], Engine] = {}
+_session_factories: Dict[Tuple[str, bool], sessionmaker] = {}
+_scoped_sessions: Dict[Tuple[str, bool], scoped_session] = {}
+_engine_hooks: List[Callable[[Engine], None]] = []
+_group_engine: Optional[Engine] = None
+_group_sessions: Optional[scoped_session] = None
+
+
+def resolve_pharmacy(pharmacy) -> str:
+    """Normalises a pharmacy name; unknown or empty names fall back to the default pharmacy."""
+    pharmacy = (pharmacy or '').lower()
+    return pharmacy if pharmacy in PHARMACY_DB_FILES else DEFAULT_PHARMACY
+
+
+def db_file(pharmacy) -> str:
+    return os.path.join(PHARMACY_DATA_DIR, PHARMACY_DB_FILES[resolve_pharmacy(pharmacy)])
+
+
+def db_url(pharmacy) -> str:
+    return f"sqlite:///{db_file(pharmacy)}"
+
+
+def on_engine_created(hook: Callable[[Engine], None]):
+    """Registers hook(engine), run once for every engine the registry creates (e.g. create_all)."""
+    _engine_hooks.append(hook)
+    return hook
+
+
+def apply_sqlite_profile(engine: Engine, profile: Optional[Dict] = None, query_only: bool = False) -> Engine:
+    """Runs the profile's PRAGMAs on every new DBAPI connection of a SQLite engine.
+    query_only=True makes the connections refuse writes (API read engines)."""
+    if engine.dialect.name != 'sqlite':
+        return engine
+    profile = SQLITE_PROFILE if profile is None else profile
+
+    @event.listens_for(engine, 'connect')
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for pragma in ('busy_timeout', 'journal_mode', 'synchronous', 'mmap_size', 'cache_size', 'temp_store'):
+                if profile.get(pragma) is not None:
+                    cursor.execute(f"PRAGMA {pragma}={profile[pragma]}")
+            if query_only:
+                cursor.execute("PRAGMA query_only=ON")
+        finally:
+            cursor.close()
+
+    return engine
+
+
+def get_engine(pharmacy, read_only: bool = False) -> Engine:
+    """The pharmacy's engine, created on first use and shared by every thread afterwards.
+    read_only=True returns the separate query_only engine used for API reads."""
+    pharmacy = resolve_pharmacy(pharmacy)
+    key = (pharmacy, read_only)
+    engine = _engines.get(key)
+    if engine is not None:
+        return engine
+    if read_only:
+        get_engine(pharmacy) # The writer engine's hooks create the tables first
+    with _lock:
+        engine = _engines.get(key)
+        if engine is None:
+            engine = create_engine(
+                db_url(pharmacy), echo=False, future=True,
+                pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW,
+                connect_args={'check_same_thread': False},
+            )
+            if SQLITE_PROFILE_ENABLED:
+                apply_sqlite_profile(engine, query_only=read_only)
+            if not read_only:
+                for hook in _engine_hooks:
+                    hook(engine)
+            _engines[key] = engine
+            _session_factories[key] = sessionmaker(bind=engine, autoflush=False, autocommit=False)
+            _scoped_sessions[key] = scoped_session(_session_factories[key])
+    return engine
+
+
+def get_session(pharmacy, read_only: bool = False) -> Session:
+    """A new session on the pharmacy's shared engine. The caller closes it."""
+    pharmacy = resolve_pharmacy(pharmacy)
+    get_engine(pharmacy, read_only)
+    return _session_factories[(pharmacy, read_only)]()
+
+
+def get_scoped_session(pharmacy, read_only: bool = False) -> Session:
+    """The current thread's session for pharmacy (one per request in the API)."""
+    pharmacy = resolve_pharmacy(pharmacy)
+    get_engine(pharmacy, read_only)
+    return _scoped_sessions[(pharmacy, read_only)]()
+
+
+def get_group_engine() -> Engine:
+    """Read-only engine whose connections ATTACH every pharmacy's database as a schema named
+    after the pharmacy (SQLite allows 10 attached files by default)."""
+    global _group_engine, _group_sessions
+    if _group_engine is not None:
+        return _group_engine
+    for pharmacy in PHARMACIES:
+        get_engine(pharmacy) # Creates missing files and brings their schema up to date
+    with _lock:
+        if _group_engine is None:
+            engine = create_engine(
+                'sqlite://', echo=False, future=True, poolclass=QueuePool,
+                pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW,
+                connect_args={'check_same_thread': False},
+            )
+
+            @event.listens_for(engine, 'connect')
+            def _attach_pharmacies(dbapi_connection, connection_record):
+                cursor = dbapi_connection.cursor()
+                try:
+                    for pharmacy in PHARMACIES:
+                        cursor.execute(f'ATTACH DATABASE ? AS "{pharmacy}"', (db_file(pharmacy),))
+                finally:
+                    cursor.close()
+
+            if SQLITE_PROFILE_ENABLED:
+                apply_sqlite_profile(engine, query_only=True)
+            _group_sessions = scoped_session(sessionmaker(bind=engine, autoflush=False, autocommit=False))
+            _group_engine = engine
+    return _group_engine
+
+
+def get_group_session() -> Session:
+    """The current thread's session on the all-pharmacies engine."""
+    get_group_engine()
+    return _group_sessions()
+
+
+def remove_scoped_sessions():
+    """Closes and discards the current thread's scoped sessions (call at request teardown)."""
+    for registry in list(_scoped_sessions.values()):
+        registry.remove()
+    if _group_sessions is not None:
+        _group_sessions.remove()
+
+
+def pool_stats() -> Dict[str, Dict]:
+    """Connection pool counters for every engine created so far."""
+    stats = {}
+    engines = [(f"{pharmacy}:{'read' if read_only else 'write'}", db_file(pharmacy), engine)
+               for (pharmacy, read_only), engine in list(_engines.items())]
+    if _group_engine is not None:
+        engines.append(('group:read', None, _group_engine))
+    for name, path, engine in engines:
+        pool = engine.pool
+        stats[name] = {
+            'db_file': path,
+            'pool_class': type(pool).__name__,
+            'size': pool.size() if hasattr(pool, 'size') else None,
+            'checked_in': pool.checkedin() if hasattr(pool, 'checkedin') else None,
+            'checked_out': pool.checkedout() if hasattr(pool, 'checkedout') else None,
+            'overflow': pool.overflow() if hasattr(pool, 'overflow') else None,
+            'status': pool.status(),
+        }
+    return stats
+
+
+def dispose_all():
+    """Closes every pooled connection (e.g. before forking or at shutdown)."""
+    global _group_engine, _group_sessions
+    with _lock:
+        if _group_engine is not None:
+            _group_sessions.remove()
+            _group_engine.dispose()
+            _group_engine = _group_sessions = None
+        for registry in _scoped_sessions.values():
+            registry.remove()
+        for engine in _engines.values():
+            engine.dispose()
+        _engines.clear()
+        _session_factories.clear()
+        _scoped_sessions.clear()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""On-disk archive of raw report emails, so the database can be rebuilt without IMAP.
+
+Layout (one directory per pharmacy):
+    <root>/<pharmacy>/index.jsonl                 one JSON line per archived message
+    <root>/<pharmacy>/<YYYY>/<YYYY-MM-DD>_<uid>.eml.gz   gzip-compressed raw MIME bytes
+"""
+import datetime
+import gzip
+import json
+import os
+import threading
+from typing import Dict, Iterator, Optional, Tuple
+
+ARCHIVE_DIR = os.getenv('REPORT_ARCHIVE_DIR', '/data/archive')  # Set to '' to disable archiving
+
+
+class ReportArchive:
+    """Raw MIME messages for one pharmacy, keyed by UID and report date."""
+
+    def __init__(self, root: str, pharmacy: str):
+        self.pharmacy = pharmacy
+        self.path = os.path.join(root, pharmacy)
+        self.index_path = os.path.join(self.path, 'index.jsonl')
+        self._lock = threading.Lock()
+        self._index: Dict[Tuple[str, int], Dict] = {}
+        os.makedirs(self.path, exist_ok=True)
+        if os.path.exists(self.index_path):
+            with open(self.index_path, encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        self._index[(record['report_date'], record['uid'])] = record
+        self._dates = {report_date for report_date, _ in self._index}
+
+    def __len__(self):
+        return len(self._index)
+
+    def has_date(self, report_date: datetime.date) -> bool:
+        return report_date.isoformat() in self._dates
+
+    def put(self, uid: int, report_date: datetime.date, msg_data: bytes, subject: str = '') -> str:
+        """Compresses and stores one message (idempotent). Returns the file path."""
+        date_str = report_date.isoformat()
+        rel_path = os.path.join(date_str[:4], f"{date_str}_{uid}.eml.gz")
+        file_path = os.path.join(self.path, rel_path)
+        with self._lock:
+            if (date_str, uid) in self._index:
+                return file_path
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            tmp_path = file_path + '.tmp'
+            with gzip.open(tmp_path, 'wb', compresslevel=6) as f:
+                f.write(msg_data)
+            os.replace(tmp_path, file_path)
+            record = {'uid': uid, 'report_date': date_str, 'file': rel_path, 'subject': subject,
+                      'size': len(msg_data)}
+            with open(self.index_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record) + '\n')
+            self._index[(date_str, uid)] = record
+            self._dates.add(date_str)
+        return file_path
+
+    def iter_messages(self, start_date: Optional[datetime.date] = None,
+                      end_date: Optional[datetime.date] = None) -> Iterator[Tuple[int, datetime.date, str, bytes]]:
+        """Yields (uid, report_date, subject, raw bytes) in date order."""
+        for (date_str, uid), record in sorted(self._index.items()):
+            report_date = datetime.date.fromisoformat(date_str)
+            if (start_date and report_date < start_date) or (end_date and report_date > end_date):
+                continue
+            with gzip.open(os.path.join(self.path, record['file']), 'rb') as f:
+                yield uid, report_date, record.get('subject', ''), f.read()
+
+
+def open_report_archive(pharmacy: str, root: Optional[str] = None) -> Optional[ReportArchive]:
+    """The archive for pharmacy, or None when archiving is disabled or the directory is unusable."""
+    root = ARCHIVE_DIR if root is None else root
+    if not root:
+        return None
+    try:
+        return ReportArchive(root, pharmacy)
+    except OSError as e:
+        print(f"Warning: report archive unavailable at {root}: {e}")
+        return None
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+"""Canonical metric keys for the raw (category, description) rows of the Daily Management Report.
+
+Every distinct raw pair gets one row in the `metrics` table, and report_entries.metric_id
+points at it. METRIC_ALIASES decides which canonical key (if any) a raw pair belongs to.
+Several raw descriptions may share a key (e.g. every "... Scripts" line is scripts_total).
+The API filters by key, so an alias change only touches the small metrics table.
+"""
+from typing import Optional
+
+# (key, category, match, text): match is 'exact' or 'contains'; both are case-insensitive,
+# like the LIKE/ILIKE filters they replace
+METRIC_ALIASES = [
+    ('turnover', 'TURNOVER SUMMARY', 'contains', 'TOTAL TURNOVER'),
+    ('cost_of_sales', 'STOCK TRADING ACCOUNT', 'exact', 'Cost Of Sales'),
+    ('purchases', 'STOCK TRADING ACCOUNT', 'exact', 'Purchases'),
+    ('adjustments', 'STOCK TRADING ACCOUNT', 'exact', 'Adjustments'),
+    ('opening_stock', 'STOCK TRADING ACCOUNT', 'exact', 'Opening Stock (@ Cost at the Beginning of the Month)'),
+    ('closing_stock', 'STOCK TRADING ACCOUNT', 'exact', 'Closing Stock Valued at Cost Now'),
+    ('dispensary_turnover', 'DISPENSARY SUMMARY', 'exact', 'Dispensary Turnover/Revenue'),
+    ('scripts_total', 'DISPENSARY SUMMARY', 'contains', 'scripts'),
+    ('pos_transactions', 'SALES SUMMARY', 'exact', 'POS Transactions'),
+    ('avg_basket_value', 'SALES SUMMARY', 'exact', 'Average Value Per Docket/Basket'),
+    ('avg_basket_size', 'SALES SUMMARY', 'exact', 'Average Number Of Items per Basket'),
+]
+
+METRIC_KEYS = [key for key, _, _, _ in METRIC_ALIASES]
+
+
+def canonical_metric_key(category: str, description: str) -> Optional[str]:
+    """The canonical key for a raw report row, or None for rows the API doesn't use by name."""
+    description = (description or '').lower()
+    for key, alias_category, match, text in METRIC_ALIASES:
+        if category != alias_category:
+            continue
+        if (match == 'exact' and description == text.lower()) or \
+                (match == 'contains' and text.lower() in description):
+            return key
+    return None
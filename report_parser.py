@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""Single-pass lxml parser for the Daily Management Report email.
+
+Produces the same entries as the original BeautifulSoup parser (extract_report_data, now
+in benchmarks/bench_parser.py), but walks the document once: every section table is
+indexed by title in one pass over <table> elements, each cell's text is read exactly once,
+and values are parsed to floats as they are emitted.
+"""
+import email
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import lxml.html
+from lxml.etree import ParserError
+
+REPORT_SECTIONS = ["STOCK TRADING ACCOUNT", "DISPENSARY SUMMARY", "TURNOVER SUMMARY", "SALES SUMMARY"]
+
+# SALES SUMMARY rows we keep: (marker in first cell, stored description, integer count?)
+SALES_SUMMARY_ROWS = [
+    ("TOTAL POS TURNOVER:", "POS Transactions", True),
+    ("Average Value Per Docket/Basket", "Average Value Per Docket/Basket", False),
+    ("Average Number Of Items per Basket", "Average Number Of Items per Basket", False),
+]
+
+_HTML_PARSER = lxml.html.HTMLParser(encoding='utf-8')
+
+
+def parse_value(val_str: Optional[str]) -> Optional[float]:
+    """Convert string with currency, commas, and percent signs to float."""
+    if val_str is None: return None
+    s = val_str.replace('R', '').replace(',', '').replace('%', '').strip()
+    # Handle potential negative sign placement
+    if s.startswith('-') and s.count('-') > 1: s = '-' + s.replace('-', '', 1)
+    elif s.count('-') > 0 and not s.startswith('-'): s = s.replace('-', '')
+    try:
+        return float(s) if s else 0.0
+    except ValueError:
+        print(f"Warning: Could not parse value '{val_str}'")
+        return None
+
+
+def clean_int_value(value_str: Optional[str]) -> Optional[int]:
+    """Removes commas, spaces and converts to int. Returns None if conversion fails."""
+    if not value_str: return 0
+    cleaned = value_str.replace(',', '').replace(' ', '')
+    try:
+        return int(cleaned) if cleaned else 0
+    except ValueError:
+        print(f"Warning: Could not convert '{value_str}' to int.")
+        return None
+
+
+def _cell_text(element) -> str:
+    """Same result as BeautifulSoup's get_text(strip=True)."""
+    return ''.join(s.strip() for s in element.itertext() if s.strip())
+
+
+def _table_rows(table) -> List[List[str]]:
+    """Text of every <td> for every <tr> under table (descendants, like find_all)."""
+    return [[_cell_text(td) for td in tr.iter('td')] for tr in table.iter('tr')]
+
+
+def index_report_tables(doc, titles=REPORT_SECTIONS) -> Dict[str, List[List[str]]]:
+    """One pass over the document's tables. Maps each title to the cell text of the first
+    table whose first cell contains it (case-insensitive), matching find_table_by_title."""
+    wanted = {title: title.lower() for title in titles}
+    found = {}
+    for table in doc.iter('table'):
+        if not wanted:
+            break
+        first_row = next(table.iter('tr'), None)
+        if first_row is None:
+            continue
+        first_td = next(first_row.iter('td'), None)
+        if first_td is None:
+            continue
+        heading = _cell_text(first_td).lower()
+        for title, key in list(wanted.items()):
+            if key in heading:
+                found[title] = _table_rows(table)
+                del wanted[title]
+    return found
+
+
+def _standard_rows(rows: List[List[str]]) -> Iterator[Tuple[str, Optional[str]]]:
+    """(description, today) pairs from a Description/Today/This Month table; mirrors bench_parser.parse_table."""
+    header_row_index = -1
+    potential_header_row = -1
+    for i, texts in enumerate(rows):
+        if len(texts) == 3:
+            if 'Description' in texts[0] and 'Today' in texts[1] and 'This Month' in texts[2]:
+                header_row_index = i
+                break
+            elif i > 0 and potential_header_row == -1:
+                potential_header_row = i
+
+    if header_row_index == -1:
+        header_row_index = potential_header_row
+        if header_row_index == -1 or header_row_index >= len(rows) - 1:
+            print("Warning: Could not determine header row reliably for a table.")
+            return
+
+    header_cells = rows[header_row_index]
+    for cells in rows[header_row_index + 1:]:
+        if len(cells) >= 3:
+            row_dict = {header_cells[0]: cells[0], header_cells[1]: cells[1], header_cells[2]: cells[2]}
+            desc = row_dict.get('Description')
+            if desc:
+                yield desc, row_dict.get('Today')
+
+
+def _sales_summary_rows(rows: List[List[str]]) -> Iterator[Tuple[str, Optional[float]]]:
+    """POS transactions and the two basket averages from the SALES SUMMARY table."""
+    pending = list(SALES_SUMMARY_ROWS)
+    for cells in rows:
+        if len(cells) < 2:
+            continue
+        for item in list(pending):
+            marker, description, is_count = item
+            if marker in cells[0]:
+                value = float(clean_int_value(cells[1]) or 0) if is_count else parse_value(cells[1])
+                pending.remove(item)
+                yield description, value
+    for marker, _, _ in pending:
+        print(f"Warning: '{marker}' row not found in SALES SUMMARY table.")
+
+
+def iter_report_rows(html) -> Iterator[Tuple[str, str, Optional[float]]]:
+    """Yields typed (category, description, value) tuples for a report's HTML (str or bytes)."""
+    if isinstance(html, str):
+        html = html.encode('utf-8')
+    try:
+        doc = lxml.html.fromstring(html, parser=_HTML_PARSER)
+    except ParserError:
+        return
+    tables = index_report_tables(doc)
+    for title in REPORT_SECTIONS:
+        rows = tables.get(title)
+        if rows is None:
+            print(f"Warning: Table '{title}' not found in email.")
+            continue
+        if title == "SALES SUMMARY":
+            for description, value in _sales_summary_rows(rows):
+                yield title, description, value
+        else:
+            for description, today in _standard_rows(rows):
+                yield title, description, parse_value(today)
+
+
+def extract_report_entries(html) -> List[Dict]:
+    """Drop-in for extract_report_data(BeautifulSoup(html)): same entries, values already parsed."""
+    return [
+        {"category": category, "description": description, "today_value": value}
+        for category, description, value in iter_report_rows(html)
+    ]
+
+
+def extract_html_content(message, uid=None) -> Optional[str]:
+    """Returns the decoded text/html part of an email message, or None if there isn't one."""
+    parts = message.walk() if message.is_multipart() else [message]
+    for part in parts:
+        if part.get_content_type() == 'text/html':
+            try:
+                return part.get_payload(decode=True).decode(
+                    part.get_content_charset() or 'utf-8', errors='replace'
+                )
+            except Exception as e:
+                print(f"UID {uid}: Error decoding part: {e}")
+    return None
+
+
+def parse_report_message(uid, msg_data: bytes, subject_line: str = '') -> Tuple[int, Optional[List[Dict]], str]:
+    """Decodes a raw report email and parses it: (uid, entries or None, reason skipped).
+    Only depends on this module, so it can run in a process pool.
+    """
+    message = email.message_from_bytes(msg_data)
+    html_content = extract_html_content(message, uid)
+    if (
+        "Daily Management Report" not in (subject_line or "")
+        and (not html_content or "Daily Management Report" not in html_content)
+    ):
+        return uid, None, "does not contain 'Daily Management Report'"
+    if not html_content:
+        return uid, None, "no HTML content found"
+    entries = extract_report_entries(html_content)
+    if not entries:
+        return uid, None, "no data extracted"
+    return uid, entries, ""
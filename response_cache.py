@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+"""Versioned cache of API responses, invalidated by ingests instead of timers.
+
+Every commit that changes a pharmacy's report data appends a row to its data_versions table
+(see record_data_change in main.py): the new data version and the earliest date it changed.
+A cached response is stored with the data version it was computed at and the last date of
+its range. It stays valid until a later version changes a date on or before that range end.
+Past months and years are therefore never recomputed when tomorrow's report arrives; only
+a reparse or re-import of their dates replaces them. Ranges that reach today are also keyed
+by today's date, so they are not reused after midnight.
+
+Two tiers, both keyed by (pharmacy, endpoint, params):
+  - an in-process LRU of RESPONSE_CACHE_SIZE entries (default 512);
+  - with RESPONSE_CACHE_DIR set, a shared on-disk tier of one file per entry, so every worker
+    of a multi-process deployment reuses responses the others computed. Stale files are
+    deleted when found, and each pharmacy keeps at most RESPONSE_CACHE_DISK_SIZE files
+    (default 2048; the least recently used go first). Deleting the directory at any time is safe.
+RESPONSE_CACHE=off turns both off. stats() returns hit/miss counters for /api/cache_stats.
+"""
+import bisect
+import datetime
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import Date, Integer, text
+
+import pharmacy_registry
+
+RESPONSE_CACHE_ENABLED = os.getenv('RESPONSE_CACHE', 'on').lower() != 'off'
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', '512'))
+RESPONSE_CACHE_DIR = os.getenv('RESPONSE_CACHE_DIR') or None
+RESPONSE_CACHE_DISK_SIZE = int(os.getenv('RESPONSE_CACHE_DISK_SIZE', '2048'))
+
+_CHANGES_SINCE = text(
+    "SELECT version, first_date FROM data_versions WHERE version > :version ORDER BY version"
+).columns(version=Integer, first_date=Date)
+
+_lock = threading.Lock()
+# (pharmacy, key) -> (version, range end, body), least recently used first
+_entries: 'OrderedDict[Tuple[str, str], Tuple[int, datetime.date, str]]' = OrderedDict()
+# Per pharmacy: the versions seen so far, and for each the earliest date it or any later version changed
+_versions: Dict[str, List[int]] = {}
+_changed_from: Dict[str, List[datetime.date]] = {}
+_stats = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'stale': 0, 'stores': 0, 'evictions': 0, 'disk_evictions': 0}
+
+
+def data_version(pharmacy) -> int:
+    """The pharmacy's current data version (0 before the first recorded change). Reads only
+    the data_versions rows this process hasn't seen yet: one indexed statement per call."""
+    pharmacy = pharmacy_registry.resolve_pharmacy(pharmacy)
+    known = _versions.get(pharmacy) or [0]
+    with pharmacy_registry.get_engine(pharmacy, read_only=True).connect() as conn:
+        rows = conn.execute(_CHANGES_SINCE, {'version': known[-1]}).all()
+    with _lock:
+        versions = _versions.setdefault(pharmacy, [])
+        changed_from = _changed_from.setdefault(pharmacy, [])
+        new = [(version, first_date) for version, first_date in rows if not versions or version > versions[-1]]
+        if new:
+            versions.extend(version for version, _ in new)
+            changed_from.extend(first_date for _, first_date in new)
+            for i in range(len(changed_from) - 2, -1, -1): # Suffix minimum
+                changed_from[i] = min(changed_from[i], changed_from[i + 1])
+        return versions[-1] if versions else 0
+
+
+def is_current(pharmacy, version: int, end: datetime.date) -> bool:
+    """True when no data version after version changed a date on or before end."""
+    with _lock:
+        versions = _versions.get(pharmacy, [])
+        i = bisect.bisect_right(versions, version)
+        return i == len(versions) or _changed_from[pharmacy][i] > end
+
+
+def cache_key(endpoint: str, params: Dict, end: datetime.date) -> str:
+    """endpoint plus its sorted params; ranges that reach today also carry today's date."""
+    params = sorted(params.items())
+    today = datetime.date.today()
+    if end >= today:
+        params.append(('_today', today.isoformat()))
+    return json.dumps([endpoint, params], separators=(',', ':'))
+
+
+def _disk_path(pharmacy, key: str) -> str:
+    return os.path.join(RESPONSE_CACHE_DIR, pharmacy, hashlib.sha256(key.encode()).hexdigest() + '.json')
+
+
+def _read_disk(pharmacy, key: str) -> Optional[Tuple[int, datetime.date, str]]:
+    try:
+        with open(_disk_path(pharmacy, key), encoding='utf-8') as f:
+            stored = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if stored.get('key') != key: # Hash collision
+        return None
+    return stored['version'], datetime.date.fromisoformat(stored['end']), stored['body']
+
+
+def _touch_disk(path):
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+def _remove_disk(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass # Already removed by another worker
+
+
+def _prune_disk(directory):
+    """Keeps directory at RESPONSE_CACHE_DISK_SIZE files by removing the least recently used
+    (oldest mtime; hits touch their file). Trims to 90% so it runs once per ~10% of writes."""
+    names = [name for name in os.listdir(directory) if name.endswith('.json')]
+    if len(names) <= RESPONSE_CACHE_DISK_SIZE:
+        return
+    mtimes = {}
+    for name in names:
+        try:
+            mtimes[name] = os.stat(os.path.join(directory, name)).st_mtime
+        except OSError:
+            pass
+    oldest = sorted(mtimes, key=mtimes.get)[:len(mtimes) - int(RESPONSE_CACHE_DISK_SIZE * 0.9)]
+    for name in oldest:
+        _remove_disk(os.path.join(directory, name))
+    with _lock:
+        _stats['disk_evictions'] += len(oldest)
+
+
+def _write_disk(pharmacy, key: str, version: int, end: datetime.date, body: str):
+    """Written to a temporary file and renamed into place, so readers never see half a file."""
+    path = _disk_path(pharmacy, key)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump({'key': key, 'version': version, 'end': end.isoformat(), 'body': body}, f)
+        os.replace(tmp, path)
+        _prune_disk(os.path.dirname(path))
+    except OSError as e:
+        print(f"Response cache: could not write {path}: {e}")
+
+
+def _remember(pharmacy, key: str, entry: Tuple[int, datetime.date, str]):
+    with _lock:
+        _entries[(pharmacy, key)] = entry
+        _entries.move_to_end((pharmacy, key))
+        while len(_entries) > RESPONSE_CACHE_SIZE:
+            _entries.popitem(last=False)
+            _stats['evictions'] += 1
+
+
+def lookup(pharmacy, key: str) -> Tuple[Optional[str], int]:
+    """(cached body or None, current data version). Pass the version to store() on a miss:
+    it is read before the response is computed, so a write that lands meanwhile makes the
+    stored entry stale rather than hiding it."""
+    pharmacy = pharmacy_registry.resolve_pharmacy(pharmacy)
+    version = data_version(pharmacy)
+    with _lock:
+        entry = _entries.get((pharmacy, key))
+        if entry is not None:
+            _entries.move_to_end((pharmacy, key))
+    if entry is not None:
+        if is_current(pharmacy, entry[0], entry[1]):
+            with _lock:
+                _stats['hits'] += 1
+            return entry[2], version
+        with _lock:
+            _entries.pop((pharmacy, key), None)
+            _stats['stale'] += 1
+    if RESPONSE_CACHE_DIR:
+        entry = _read_disk(pharmacy, key)
+        if entry is not None and is_current(pharmacy, entry[0], entry[1]):
+            _touch_disk(_disk_path(pharmacy, key))
+            _remember(pharmacy, key, entry)
+            with _lock:
+                _stats['disk_hits'] += 1
+            return entry[2], version
+        if entry is not None:
+            _remove_disk(_disk_path(pharmacy, key))
+            with _lock:
+                _stats['stale'] += 1
+    with _lock:
+        _stats['misses'] += 1
+    return None, version
+
+
+def store(pharmacy, key: str, version: int, end: datetime.date, body: str):
+    """Caches body, computed at data version version, for a range ending on end."""
+    pharmacy = pharmacy_registry.resolve_pharmacy(pharmacy)
+    _remember(pharmacy, key, (version, end, body))
+    if RESPONSE_CACHE_DIR:
+        _write_disk(pharmacy, key, version, end, body)
+    with _lock:
+        _stats['stores'] += 1
+
+
+def clear():
+    """Empties the in-process tier (the on-disk tier is left to its directory)."""
+    with _lock:
+        _entries.clear()
+
+
+def stats() -> Dict:
+    """Hit/miss counters, tier sizes and the data version each pharmacy was last seen at."""
+    with _lock:
+        lookups = _stats['hits'] + _stats['disk_hits'] + _stats['misses']
+        return {
+            **_stats,
+            'hit_ratio': (_stats['hits'] + _stats['disk_hits']) / lookups if lookups else None,
+            'entries': len(_entries),
+            'max_entries': RESPONSE_CACHE_SIZE,
+            'disk_dir': RESPONSE_CACHE_DIR,
+            'max_disk_entries': RESPONSE_CACHE_DISK_SIZE if RESPONSE_CACHE_DIR else None,
+            'enabled': RESPONSE_CACHE_ENABLED,
+            'data_versions': {pharmacy: versions[-1] for pharmacy, versions in _versions.items() if versions},
+        }
@@ -4,12 +4,15 @@ CREATE TABLE report_entries (
 	category VARCHAR NOT NULL, 
 	description VARCHAR NOT NULL, 
 	today_value FLOAT, 
+	metric_id INTEGER, 
 	PRIMARY KEY (id), 
-	CONSTRAINT _date_category_desc_uc UNIQUE (date, category, description)
+	CONSTRAINT _date_category_desc_uc UNIQUE (date, category, description), 
+	FOREIGN KEY(metric_id) REFERENCES metrics (id)
 );
 CREATE INDEX ix_report_entries_date ON report_entries (date);
 CREATE INDEX ix_report_entries_category ON report_entries (category);
 CREATE INDEX ix_report_entries_id ON report_entries (id);
+CREATE INDEX ix_report_entries_metric_id_date ON report_entries (metric_id, date, today_value);
 CREATE TABLE simple_monthly_totals (
 	id INTEGER NOT NULL, 
 	year INTEGER NOT NULL, 
@@ -40,3 +43,58 @@ CREATE TABLE activity_log (
 	timestamp DATE NOT NULL, 
 	PRIMARY KEY (id)
 );
+CREATE TABLE sync_state (
+	id INTEGER NOT NULL, 
+	folder VARCHAR NOT NULL, 
+	uidvalidity INTEGER NOT NULL, 
+	last_uid INTEGER NOT NULL, 
+	updated_at DATETIME, 
+	PRIMARY KEY (id), 
+	CONSTRAINT _sync_folder_uc UNIQUE (folder)
+);
+CREATE TABLE metrics (
+	id INTEGER NOT NULL, 
+	category VARCHAR NOT NULL, 
+	description VARCHAR NOT NULL, 
+	"key" VARCHAR, 
+	PRIMARY KEY (id), 
+	CONSTRAINT _metric_category_desc_uc UNIQUE (category, description)
+);
+CREATE INDEX ix_metrics_key ON metrics ("key");
+CREATE TABLE daily_metrics (
+	id INTEGER NOT NULL, 
+	date DATE NOT NULL, 
+	turnover FLOAT, 
+	cost_of_sales FLOAT, 
+	purchases FLOAT, 
+	adjustments FLOAT, 
+	opening_stock FLOAT, 
+	closing_stock FLOAT, 
+	dispensary_turnover FLOAT, 
+	scripts_total FLOAT, 
+	pos_transactions FLOAT, 
+	avg_basket_value FLOAT, 
+	avg_basket_size FLOAT, 
+	PRIMARY KEY (id), 
+	CONSTRAINT _daily_metrics_date_uc UNIQUE (date)
+);
+CREATE TABLE monthly_metrics (
+	id INTEGER NOT NULL, 
+	month VARCHAR NOT NULL, 
+	"key" VARCHAR NOT NULL, 
+	total FLOAT, 
+	average FLOAT, 
+	days INTEGER NOT NULL, 
+	first_date DATE, 
+	first_value FLOAT, 
+	last_date DATE, 
+	last_value FLOAT, 
+	PRIMARY KEY (id), 
+	CONSTRAINT _monthly_metrics_month_key_uc UNIQUE (month, "key")
+);
+CREATE TABLE data_versions (
+	version INTEGER NOT NULL, 
+	first_date DATE NOT NULL, 
+	committed_at DATETIME, 
+	PRIMARY KEY (version)
+);
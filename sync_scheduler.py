@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""Background mailbox sync: keeps every pharmacy's database current so API reads never wait on IMAP.
+
+Each pharmacy gets its own daemon thread that calls main.fetch_latest_report every
+SYNC_INTERVAL_MINUTES (plus random jitter so the pharmacies don't hit Gmail together).
+Failures retry with exponential backoff, starting at SYNC_RETRY_SECONDS and capped at
+SYNC_MAX_BACKOFF_SECONDS.
+
+Runs inside the Flask process (started by backend/app.py) or as a sidecar:
+    python main.py schedule
+"""
+import datetime
+import os
+import random
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional
+
+SYNC_SCHEDULER = os.getenv('SYNC_SCHEDULER', 'thread').lower()  # 'thread' or 'off'
+SYNC_INTERVAL_MINUTES = float(os.getenv('SYNC_INTERVAL_MINUTES', '30'))
+SYNC_JITTER_SECONDS = float(os.getenv('SYNC_JITTER_SECONDS', '120'))
+SYNC_RETRY_SECONDS = float(os.getenv('SYNC_RETRY_SECONDS', '60'))
+SYNC_MAX_BACKOFF_SECONDS = float(os.getenv('SYNC_MAX_BACKOFF_SECONDS', '3600'))
+SYNC_LOCK_FILE = os.getenv('SYNC_LOCK_FILE', os.path.join(tempfile.gettempdir(), 'dmr_sync_scheduler.lock'))
+
+# One lock per pharmacy so scheduled and on-demand (/api/fetch_reports) syncs never overlap
+_sync_locks: Dict[str, threading.Lock] = {}
+_sync_locks_guard = threading.Lock()
+
+
+def _pharmacy_lock(pharmacy: str) -> threading.Lock:
+    with _sync_locks_guard:
+        return _sync_locks.setdefault(pharmacy, threading.Lock())
+
+
+def run_sync(pharmacy: str) -> int:
+    """Runs one fetch_latest_report for pharmacy, serialised with any other sync of the same pharmacy."""
+    from main import fetch_latest_report  # main imports are heavy; keep this module cheap to import
+    with _pharmacy_lock(pharmacy):
+        return fetch_latest_report(pharmacy)
+
+
+class PharmacySyncJob:
+    """Schedule and last-run status for one pharmacy."""
+
+    def __init__(self, pharmacy: str, interval: float, jitter: float, retry: float, max_backoff: float):
+        self.pharmacy = pharmacy
+        self.interval = interval
+        self.jitter = jitter
+        self.retry = retry
+        self.max_backoff = max_backoff
+        self.failures = 0
+        self.last_run: Optional[datetime.datetime] = None
+        self.last_success: Optional[datetime.datetime] = None
+        self.last_error: Optional[str] = None
+        self.last_new_days = 0
+        self.last_duration = 0.0
+        self.next_run = time.time() + random.uniform(0, jitter)  # Stagger the first runs too
+
+    def next_delay(self) -> float:
+        """Seconds until the next run: interval + jitter after success, exponential backoff after failures."""
+        if self.failures:
+            return min(self.max_backoff, self.retry * 2 ** (self.failures - 1)) + random.uniform(0, self.jitter / 4)
+        return self.interval + random.uniform(-self.jitter, self.jitter)
+
+    def run(self):
+        started = time.perf_counter()
+        self.last_run = datetime.datetime.now()
+        try:
+            self.last_new_days = run_sync(self.pharmacy)
+            self.failures = 0
+            self.last_error = None
+            self.last_success = self.last_run
+        except Exception as e:
+            self.failures += 1
+            self.last_error = str(e)
+            print(f"--- Scheduled sync for {self.pharmacy} failed ({self.failures} in a row): {e} ---")
+        self.last_duration = time.perf_counter() - started
+        self.next_run = time.time() + max(0.0, self.next_delay())
+
+    def status(self) -> Dict:
+        iso = lambda dt: dt.isoformat(timespec='seconds') if dt else None
+        return {
+            'pharmacy': self.pharmacy,
+            'last_run': iso(self.last_run),
+            'last_success': iso(self.last_success),
+            'last_error': self.last_error,
+            'last_new_days': self.last_new_days,
+            'last_duration_seconds': round(self.last_duration, 2),
+            'consecutive_failures': self.failures,
+            'next_run': iso(datetime.datetime.fromtimestamp(self.next_run)),
+        }
+
+
+class SyncScheduler:
+    """One daemon thread per pharmacy running PharmacySyncJob on its schedule."""
+
+    def __init__(self, pharmacies: List[str], interval_minutes: float = SYNC_INTERVAL_MINUTES,
+                 jitter: float = SYNC_JITTER_SECONDS, retry: float = SYNC_RETRY_SECONDS,
+                 max_backoff: float = SYNC_MAX_BACKOFF_SECONDS):
+        self.interval_minutes = interval_minutes
+        self.jitter = jitter
+        self.jobs = {
+            p: PharmacySyncJob(p, interval_minutes * 60, jitter, retry, max_backoff) for p in pharmacies
+        }
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+
+    def _loop(self, job: PharmacySyncJob):
+        while not self._stop.is_set():
+            wait = job.next_run - time.time()
+            if wait > 0 and self._stop.wait(wait):
+                break
+            job.run()
+
+    def start(self):
+        for job in self.jobs.values():
+            t = threading.Thread(target=self._loop, args=(job,), name=f'sync-{job.pharmacy}', daemon=True)
+            t.start()
+            self._threads.append(t)
+        print(f"--- Sync scheduler started for {', '.join(self.jobs)} "
+              f"(every {self.interval_minutes:g} min, ±{self.jitter:g}s jitter) ---")
+        return self
+
+    def stop(self, timeout: Optional[float] = None):
+        self._stop.set()
+        for t in self._threads:
+            t.join(timeout)
+
+    def status(self) -> List[Dict]:
+        return [job.status() for job in self.jobs.values()]
+
+
+_scheduler: Optional[SyncScheduler] = None
+_lock_handle = None
+
+
+def _acquire_process_lock() -> bool:
+    """Only one process per host runs the scheduler (gunicorn workers, Flask reloader)."""
+    global _lock_handle
+    try:
+        import fcntl
+    except ImportError:  # Non-POSIX: no cross-process guard
+        return True
+    handle = open(SYNC_LOCK_FILE, 'w')
+    try:
+        fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        handle.close()
+        return False
+    _lock_handle = handle  # Keep the file open (and locked) for the life of the process
+    return True
+
+
+def start_scheduler(pharmacies: List[str], force: bool = False) -> Optional[SyncScheduler]:
+    """Starts the scheduler once per host, unless SYNC_SCHEDULER=off (force=True ignores that, for the sidecar)."""
+    global _scheduler
+    if (SYNC_SCHEDULER == 'off' and not force) or _scheduler is not None:
+        return _scheduler
+    if not _acquire_process_lock():
+        print("--- Sync scheduler already running in another process; not starting here ---")
+        return None
+    _scheduler = SyncScheduler(pharmacies).start()
+    return _scheduler
+
+
+def get_scheduler() -> Optional[SyncScheduler]:
+    return _scheduler